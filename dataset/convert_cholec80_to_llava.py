@@ -1,11 +1,18 @@
+import functools
 import json
 import os
 import re
 
+from streaming_convert import run_streaming_conversion
+
 
 def fix_and_parse_cholec80(file_path):
     """修复并解析非标准的cholec80_qa_dataset.jsonl文件"""
-    data = []
+    return list(iter_cholec80_records(file_path))
+
+
+def iter_cholec80_records(file_path):
+    """逐条解析非标准的cholec80_qa_dataset.jsonl文件，每解析完一个对象就返回，不整体载入内存"""
     current_object = {}
     current_key = None
     current_value = []
@@ -29,7 +36,7 @@ def fix_and_parse_cholec80(file_path):
                     # 处理最后一个键值对
                     value_str = ''.join(current_value).strip()
                     current_object[current_key] = parse_value(value_str)
-                data.append(current_object)
+                yield current_object
                 continue
 
             # 处理数组开始和结束
@@ -62,8 +69,6 @@ def fix_and_parse_cholec80(file_path):
                 # 键值对的值跨多行，继续累加
                 current_value.append(line)
 
-    return data
-
 
 def parse_value(value_str):
     """解析值并正确处理数组和字符串"""
@@ -179,6 +184,118 @@ def extract_id_from_path(frame_path, video_id):
                                                                                     cleaned_frame_path) else "000"
         return f"fallback_{fallback_video}_{fallback_frame}"
 
+def build_llava_record(idx, item):
+    """将一条cholec80数据转换为llava格式的多轮对话"""
+    # 提取关键信息
+    video_id = item.get('video_id', f"video_{idx}")
+    frame_id = item.get('frame_id', idx)
+    phase = item.get('phase', "Unknown")
+    frame_path = item.get('frame_path', "")
+
+    # 确保tools是列表
+    tools = item.get('tools', [])
+    if not isinstance(tools, list):
+        tools = [tools] if tools else []
+
+    # 确保present_classes是列表
+    present_classes = item.get('present_classes', [])
+    if not isinstance(present_classes, list):
+        present_classes = [present_classes] if present_classes else []
+
+    risk_level = item.get('risk_level', 0)
+    response = item.get('response', "")
+
+    # 生成ID（格式：25_00162_162）
+    unique_id = extract_id_from_path(frame_path, video_id)
+
+    # 使用完整frame_path作为image值
+    image_value = frame_path
+
+    # 创建多轮对话
+    conversations = []
+
+    # 第一轮：询问手术阶段和工具
+    conversations.append({
+        "from": "human",
+        "value": f"What is the current surgical phase and which tools are being used?\n<image>"
+    })
+
+    # AI回答
+    tools_str = ", ".join(tools) if tools else "No tools"
+    conversations.append({
+        "from": "gpt",
+        "value": f"The current surgical phase is {phase} and the tools being used are {tools_str}."
+    })
+
+    # 第二轮：询问解剖结构
+    conversations.append({
+        "from": "human",
+        "value": "What anatomical structures are present in the image?"
+    })
+
+    # AI回答 - 修复解剖结构列表显示
+    classes_str = ", ".join(present_classes) if present_classes else "No specific structures identified"
+    conversations.append({
+        "from": "gpt",
+        "value": f"The anatomical structures present are: {classes_str}."
+    })
+
+    # 第三轮：询问风险评估
+    conversations.append({
+        "from": "human",
+        "value": "What is the risk assessment for this surgical step?"
+    })
+
+    # 提取风险信息
+    risk_info = ""
+    if "<risk>" in response and "</risk>" in response:
+        risk_start = response.find("<risk>") + len("<risk>")
+        risk_end = response.find("</risk>")
+        risk_info = response[risk_start:risk_end]
+
+    risk_response = f"The risk level is {risk_level}. {risk_info}" if risk_info else f"The risk level is {risk_level}."
+    conversations.append({
+        "from": "gpt",
+        "value": risk_response
+    })
+
+    # 第四轮：询问下一步操作
+    conversations.append({
+        "from": "human",
+        "value": "What should be the next step in the surgery?"
+    })
+
+    # 提取下一步操作建议
+    next_step = "No specific next step provided."
+    if "\nNext step: " in response:
+        next_step_start = response.find("\nNext step: ") + len("\nNext step: ")
+        next_step = response[next_step_start:].strip()
+    elif "Next: " in response:
+        next_step_start = response.find("Next: ") + len("Next: ")
+        next_step = response[next_step_start:].split("\n<risk>")[0].strip()
+
+    conversations.append({
+        "from": "gpt",
+        "value": next_step
+    })
+
+    return {
+        "id": unique_id,
+        "image": image_value,  # 使用完整路径
+        "conversations": conversations
+    }
+
+
+def convert_record(idx, item, check_image=True):
+    """进程池中执行的单条转换：校验并转换，返回 (输出列表, 错误列表)"""
+    frame_path = str(item.get('frame_path', "")).strip().strip('",')
+    if not frame_path:
+        return [], [f"项目 {idx + 1}：缺少 frame_path"]
+    if check_image and not os.path.isfile(frame_path):
+        return [], [f"项目 {idx + 1}：图像文件不存在：{frame_path}"]
+    return [build_llava_record(idx, item)], []
+
+
 def convert_to_llava_format(cholec80_file, output_file):
     """将修复后的cholec80数据转换为llava格式"""
     # 修复并读取数据
@@ -186,108 +303,7 @@ def convert_to_llava_format(cholec80_file, output_file):
     print(f"成功解析 {len(cholec80_data)} 条数据")
 
     # 转换为llava格式
-    llava_format_data = []
-
-    for idx, item in enumerate(cholec80_data):
-        # 提取关键信息
-        video_id = item.get('video_id', f"video_{idx}")
-        frame_id = item.get('frame_id', idx)
-        phase = item.get('phase', "Unknown")
-        frame_path = item.get('frame_path', "")
-
-        # 确保tools是列表
-        tools = item.get('tools', [])
-        if not isinstance(tools, list):
-            tools = [tools] if tools else []
-
-        # 确保present_classes是列表
-        present_classes = item.get('present_classes', [])
-        if not isinstance(present_classes, list):
-            present_classes = [present_classes] if present_classes else []
-
-        risk_level = item.get('risk_level', 0)
-        response = item.get('response', "")
-
-        # 生成ID（格式：25_00162_162）
-        unique_id = extract_id_from_path(frame_path, video_id)
-
-        # 使用完整frame_path作为image值
-        image_value = frame_path
-
-        # 创建多轮对话
-        conversations = []
-
-        # 第一轮：询问手术阶段和工具
-        conversations.append({
-            "from": "human",
-            "value": f"What is the current surgical phase and which tools are being used?\n<image>"
-        })
-
-        # AI回答
-        tools_str = ", ".join(tools) if tools else "No tools"
-        conversations.append({
-            "from": "gpt",
-            "value": f"The current surgical phase is {phase} and the tools being used are {tools_str}."
-        })
-
-        # 第二轮：询问解剖结构
-        conversations.append({
-            "from": "human",
-            "value": "What anatomical structures are present in the image?"
-        })
-
-        # AI回答 - 修复解剖结构列表显示
-        classes_str = ", ".join(present_classes) if present_classes else "No specific structures identified"
-        conversations.append({
-            "from": "gpt",
-            "value": f"The anatomical structures present are: {classes_str}."
-        })
-
-        # 第三轮：询问风险评估
-        conversations.append({
-            "from": "human",
-            "value": "What is the risk assessment for this surgical step?"
-        })
-
-        # 提取风险信息
-        risk_info = ""
-        if "<risk>" in response and "</risk>" in response:
-            risk_start = response.find("<risk>") + len("<risk>")
-            risk_end = response.find("</risk>")
-            risk_info = response[risk_start:risk_end]
-
-        risk_response = f"The risk level is {risk_level}. {risk_info}" if risk_info else f"The risk level is {risk_level}."
-        conversations.append({
-            "from": "gpt",
-            "value": risk_response
-        })
-
-        # 第四轮：询问下一步操作
-        conversations.append({
-            "from": "human",
-            "value": "What should be the next step in the surgery?"
-        })
-
-        # 提取下一步操作建议
-        next_step = "No specific next step provided."
-        if "\nNext step: " in response:
-            next_step_start = response.find("\nNext step: ") + len("\nNext step: ")
-            next_step = response[next_step_start:].strip()
-        elif "Next: " in response:
-            next_step_start = response.find("Next: ") + len("Next: ")
-            next_step = response[next_step_start:].split("\n<risk>")[0].strip()
-
-        conversations.append({
-            "from": "gpt",
-            "value": next_step
-        })
-
-        # 添加到结果中
-        llava_format_data.append({
-            "id": unique_id,
-            "image": image_value,  # 使用完整路径
-            "conversations": conversations
-        })
+    llava_format_data = [build_llava_record(idx, item) for idx, item in enumerate(cholec80_data)]
 
     # 保存转换后的数据
     with open(output_file, 'w', encoding='utf-8') as f:
@@ -296,11 +312,25 @@ def convert_to_llava_format(cholec80_file, output_file):
     print(f"转换完成，已保存到 {output_file}")
 
 
+def convert_to_llava_jsonl(cholec80_file, output_file, error_log_file=None, num_workers=None, check_image=True):
+    """
+    流式并行转换为llava格式的JSONL：边解析边转换，图像存在性检查在进程池中完成，
+    按原顺序写出，中断后重新运行会从进度文件处继续。
+    """
+    return run_streaming_conversion(
+        iter_cholec80_records(cholec80_file),
+        functools.partial(convert_record, check_image=check_image),
+        output_file,
+        error_log_path=error_log_file,
+        num_workers=num_workers,
+    )
+
 
 if __name__ == "__main__":
     # 输入和输出文件路径
     cholec80_file = "/media/user/data3/toky/Datasets/Cholec80QA/cholec80_qa_dataset.json"
-    output_file = "/media/user/data3/toky/Datasets/Cholec80QA/converted_cholec80_to_llava.json"
+    output_file = "/media/user/data3/toky/Datasets/Cholec80QA/converted_cholec80_to_llava.jsonl"
+    error_log_file = "/media/user/data3/toky/Datasets/Cholec80QA/converted_cholec80_errors.log"
 
     # 执行转换
-    convert_to_llava_format(cholec80_file, output_file)
+    convert_to_llava_jsonl(cholec80_file, output_file, error_log_file)
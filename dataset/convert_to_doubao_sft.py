@@ -5,6 +5,8 @@
 from PIL import Image
 from io import BytesIO
 
+from streaming_convert import iter_json_records, run_streaming_conversion
+
 
 
 
@@ -60,213 +62,143 @@ def clean_text(text):
     return cleaned.strip()
 
 
-def generate_target_jsonl(source_data):
-    """生成目标格式的JSONL数据（每行一个JSON对象）"""
-    error_log = []
+def convert_item_with_image(item_idx, item):
+    """进程池中执行：图像存在性检查、缩放和 base64 编码，返回 (输出列表, 错误列表)"""
+    item_idx += 1
+    outputs, error_log = [], []
 
-    with open(OUTPUT_JSON_PATH, "w", encoding="utf-8") as f_out:
-        for item_idx, item in enumerate(source_data, 1):
-            try:
-                # 1. 提取并清理图像路径
-                image_path_str = item.get("image", "")
-                image_path = clean_image_path(image_path_str)
-                if not image_path:
-                    error_log.append(f"项目 {item_idx}：无效的图像路径")
-                    continue
+    # 1. 提取并清理图像路径
+    image_path_str = item.get("image", "")
+    image_path = clean_image_path(image_path_str)
+    if not image_path:
+        return [], [f"项目 {item_idx}：无效的图像路径"]
 
-                # 2. 将图像转换为 base64 编码
-                image_base64 = image_to_base64(image_path)
-                if not image_base64:
-                    error_log.append(f"项目 {item_idx}：图像编码失败，路径：{image_path}")
-                    continue
+    # 2. 提取人类的问题（从 conversations 中），没有问题时不必编码图像
+    conversations = item.get("conversations", [])
+    if not conversations:
+        return [], [f"项目 {item_idx}：没有对话内容"]
 
-                # 3. 提取人类的问题（从 conversations 中）
-                conversations = item.get("conversations", [])
-                if not conversations:
-                    error_log.append(f"项目 {item_idx}：没有对话内容")
-                    continue
+    # 3. 将图像转换为 base64 编码，同一条数据的多个问题共用一次编码
+    image_base64 = image_to_base64(image_path)
+    if not image_base64:
+        return [], [f"项目 {item_idx}：图像编码失败，路径：{image_path}"]
 
-                for conv_idx, conv in enumerate(conversations, 1):
-                    try:
-                        if conv.get("from") == "human" and "<image>" not in conv.get("value", ""):
-                            # 清理问题文本
-                            question_text = clean_text(conv.get("value", ""))
-                            if not question_text:
-                                continue
-
-                            # 4. 构建目标 JSON 结构
-                            target_json = {
-                                "messages": [
-                                    {
-                                        "role": "user",
-                                        "content": [
-                                            {"type": "text", "text": question_text},
-                                            {
-                                                "type": "image_url",
-                                                "image_url": {"url": image_base64}
-                                            }
-                                        ]
-                                    }
-                                ]
-                            }
+    for conv_idx, conv in enumerate(conversations, 1):
+        try:
+            if conv.get("from") == "human" and "<image>" not in conv.get("value", ""):
+                # 清理问题文本
+                question_text = clean_text(conv.get("value", ""))
+                if not question_text:
+                    continue
 
-                            # 5. 写入JSONL文件（每行一个JSON对象）
-                            # 使用json.dump确保格式正确
-                            json.dump(target_json, f_out, ensure_ascii=False)
-                            f_out.write("\n")  # 每行一个对象
+                # 4. 构建目标 JSON 结构
+                outputs.append({
+                    "messages": [
+                        {
+                            "role": "user",
+                            "content": [
+                                {"type": "text", "text": question_text},
+                                {
+                                    "type": "image_url",
+                                    "image_url": {"url": image_base64}
+                                }
+                            ]
+                        }
+                    ]
+                })
 
-                    except Exception as e:
-                        error_log.append(f"项目 {item_idx} 对话 {conv_idx} 处理失败：{str(e)}")
-                        continue
+        except Exception as e:
+            error_log.append(f"项目 {item_idx} 对话 {conv_idx} 处理失败：{str(e)}")
+            continue
 
-            except Exception as e:
-                error_log.append(f"项目 {item_idx} 整体处理失败：{str(e)}")
-                continue
+    return outputs, error_log
 
-    # 保存错误日志
-    if error_log:
-        with open(ERROR_LOG_PATH, "w", encoding="utf-8") as f_err:
-            for err in error_log:
-                f_err.write(err + "\n")
-        print(f"处理完成，共 {len(error_log)} 条错误记录，详情见：{ERROR_LOG_PATH}")
 
-    return len(error_log)
+def convert_item_no_image(item_idx, item):
+    """成对处理对话（human -> assistant），返回 (输出列表, 错误列表)"""
+    item_idx += 1
+    outputs, error_log = [], []
 
+    # 提取对话内容
+    conversations = item.get("conversations", [])
+    if not conversations:
+        return [], [f"项目 {item_idx}：没有对话内容"]
 
-def gen_chole_with_imageurl():
-    try:
-        # 加载源数据
-        with open(SOURCE_JSON_PATH, "r", encoding="utf-8") as f:
-            try:
-                source_data = json.load(f)
-                # 确保源数据是列表（若为单个对象则包装为列表）
-                if not isinstance(source_data, list):
-                    source_data = [source_data]
-                print(f"成功加载源数据，共 {len(source_data)} 条记录")
-            except json.JSONDecodeError as e:
-                print(f"源数据JSON解析失败：{str(e)}")
-                print("请先修复源数据文件的JSON格式错误")
-                exit(1)
-
-        # 生成目标格式数据（JSONL）
-        error_count = generate_target_jsonl(source_data)
-
-        # 统计输出文件中的记录数
+    i = 0
+    while i < len(conversations) - 1:
         try:
-            with open(OUTPUT_JSON_PATH, "r", encoding="utf-8") as f:
-                line_count = sum(1 for line in f if line.strip())
-            print(f"生成完成！共处理 {line_count} 条有效数据，保存至：{OUTPUT_JSON_PATH}")
-            if error_count > 0:
-                print(f"注意：有 {error_count} 条记录处理失败，详情见错误日志")
+            human_conv = conversations[i]
+            assistant_conv = conversations[i + 1]
+
+            # 检查是否为有效的对话对
+            if (human_conv.get("from") == "human" and
+                assistant_conv.get("from") == "gpt"):
+
+                # 清理问题和回答文本
+                question_text = clean_text(human_conv.get("value", ""))
+                answer_text = clean_text(assistant_conv.get("value", ""))
+
+                if question_text and answer_text:
+                    # 构建目标 JSON 结构（不包含图像）
+                    outputs.append({
+                        "messages": [
+                            {
+                                "role": "user",
+                                "content": question_text
+                            },
+                            {
+                                "role": "assistant",
+                                "content": answer_text
+                            }
+                        ]
+                    })
+
+                i += 2  # 处理下一对对话
+            else:
+                i += 1
+
         except Exception as e:
-            print(f"生成完成，但统计有效记录数失败：{str(e)}")
-            print(f"输出文件保存至：{OUTPUT_JSON_PATH}")
+            error_log.append(f"项目 {item_idx} 对话处理失败：{str(e)}")
+            i += 1
+            continue
+
+    return outputs, error_log
 
+
+def generate_target_jsonl(convert_fn):
+    """流式读取源数据（JSON 或 JSONL），在进程池中转换并按顺序写出 JSONL，支持断点续跑"""
+    try:
+        line_count, error_count = run_streaming_conversion(
+            iter_json_records(SOURCE_JSON_PATH),
+            convert_fn,
+            OUTPUT_JSON_PATH,
+            error_log_path=ERROR_LOG_PATH,
+        )
+    except json.JSONDecodeError as e:
+        print(f"源数据JSON解析失败：{str(e)}")
+        print("请先修复源数据文件的JSON格式错误")
+        exit(1)
     except Exception as e:
         print(f"程序运行失败：{str(e)}")
         exit(1)
 
+    print(f"生成完成！共处理 {line_count} 条有效数据，保存至：{OUTPUT_JSON_PATH}")
+    if error_count > 0:
+        print(f"注意：有 {error_count} 条记录处理失败，详情见：{ERROR_LOG_PATH}")
+    return error_count
 
-def gen_chole_no_imageurl():
-    try:
-        # 加载源数据
-        with open(SOURCE_JSON_PATH, "r", encoding="utf-8") as f:
-            try:
-                source_data = json.load(f)
-                # 确保源数据是列表（若为单个对象则包装为列表）
-                if not isinstance(source_data, list):
-                    source_data = [source_data]
-                print(f"成功加载源数据，共 {len(source_data)} 条记录")
-            except json.JSONDecodeError as e:
-                print(f"源数据JSON解析失败：{str(e)}")
-                print("请先修复源数据文件的JSON格式错误")
-                exit(1)
-
-        error_log = []
-
-        with open(OUTPUT_JSON_PATH, "w", encoding="utf-8") as f_out:
-            for item_idx, item in enumerate(source_data, 1):
-                try:
-                    # 提取对话内容
-                    conversations = item.get("conversations", [])
-                    if not conversations:
-                        error_log.append(f"项目 {item_idx}：没有对话内容")
-                        continue
-
-                    # 成对处理对话（human -> assistant）
-                    i = 0
-                    while i < len(conversations) - 1:
-                        try:
-                            human_conv = conversations[i]
-                            assistant_conv = conversations[i + 1]
-
-                            # 检查是否为有效的对话对
-                            if (human_conv.get("from") == "human" and
-                                assistant_conv.get("from") == "gpt"):
-
-                                # 清理问题和回答文本
-                                question_text = clean_text(human_conv.get("value", ""))
-                                answer_text = clean_text(assistant_conv.get("value", ""))
-
-                                if question_text and answer_text:
-                                    # 构建目标 JSON 结构（不包含图像）
-                                    target_json = {
-                                        "messages": [
-                                            {
-                                                "role": "user",
-                                                "content": question_text
-                                            },
-                                            {
-                                                "role": "assistant",
-                                                "content": answer_text
-                                            }
-                                        ]
-                                    }
-
-                                    # 写入JSONL文件
-                                    json.dump(target_json, f_out, ensure_ascii=False)
-                                    f_out.write("\n")
-
-                                i += 2  # 处理下一对对话
-                            else:
-                                i += 1
-
-                        except Exception as e:
-                            error_log.append(f"项目 {item_idx} 对话处理失败：{str(e)}")
-                            i += 1
-                            continue
-
-                except Exception as e:
-                    error_log.append(f"项目 {item_idx} 整体处理失败：{str(e)}")
-                    continue
-
-        # 保存错误日志
-        if error_log:
-            with open(ERROR_LOG_PATH, "w", encoding="utf-8") as f_err:
-                for err in error_log:
-                    f_err.write(err + "\n")
-            print(f"处理完成，共 {len(error_log)} 条错误记录，详情见：{ERROR_LOG_PATH}")
 
-        # 统计输出文件中的记录数
-        try:
-            with open(OUTPUT_JSON_PATH, "r", encoding="utf-8") as f:
-                line_count = sum(1 for line in f if line.strip())
-            print(f"生成完成！共处理 {line_count} 条有效数据，保存至：{OUTPUT_JSON_PATH}")
-            if error_log:
-                print(f"注意：有 {len(error_log)} 条记录处理失败，详情见错误日志")
-        except Exception as e:
-            print(f"生成完成，但统计有效记录数失败：{str(e)}")
-            print(f"输出文件保存至：{OUTPUT_JSON_PATH}")
+def gen_chole_with_imageurl():
+    return generate_target_jsonl(convert_item_with_image)
 
-    except Exception as e:
-        print(f"程序运行失败：{str(e)}")
-        exit(1)
 
+def gen_chole_no_imageurl():
+    return generate_target_jsonl(convert_item_no_image)
 
 
 if __name__ == "__main__":
     # 源数据路径（请替换为你的实际路径）
-    SOURCE_JSON_PATH = "/media/user/data3/toky/Datasets/Cholec80QA/converted_cholec80_to_llava.json"
+    SOURCE_JSON_PATH = "/media/user/data3/toky/Datasets/Cholec80QA/converted_cholec80_to_llava.jsonl"
     # 输出结果路径（JSONL格式）
     OUTPUT_JSON_PATH = "/media/user/data3/toky/Datasets/Cholec80QA/convert_to_doubao_sft_no_image.jsonl"
     # 错误日志路径
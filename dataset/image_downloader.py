@@ -0,0 +1,169 @@
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import BytesIO
+
+import requests
+from PIL import Image
+
+
+MANIFEST_NAME = '.download_manifest.jsonl'
+FAILURES_NAME = '.download_failures.jsonl'
+
+_local = threading.local()
+
+
+def _session(pool_size):
+    # 每个线程一个 Session，按主机复用 keep-alive 连接
+    if getattr(_local, 'session', None) is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _local.session = session
+    return _local.session
+
+
+def validate_image(content, min_side=1):
+    """校验图像可以完整解码且尺寸合法，返回 (宽, 高)"""
+    with Image.open(BytesIO(content)) as img:
+        img.verify()
+    # verify() 之后需要重新打开才能读取像素
+    with Image.open(BytesIO(content)) as img:
+        img.load()
+        width, height = img.size
+    if min(width, height) < min_side:
+        raise ValueError(f'图像尺寸过小：{width}x{height}')
+    return width, height
+
+
+def normalize_image(content, max_side):
+    """将图像等比缩放到最长边不超过 max_side，返回 (新内容, 宽, 高)"""
+    with Image.open(BytesIO(content)) as img:
+        if max(img.size) <= max_side:
+            return content, img.size[0], img.size[1]
+        fmt = img.format or 'JPEG'
+        img = img.convert('RGB') if fmt == 'JPEG' and img.mode not in ('RGB', 'L') else img
+        img.thumbnail((max_side, max_side), Image.BICUBIC)
+        buffer = BytesIO()
+        img.save(buffer, format=fmt, quality=95)
+        return buffer.getvalue(), img.size[0], img.size[1]
+
+
+def download_one(key, url, output_file, max_retries=5, timeout=30, min_side=1, max_side=None, pool_size=8):
+    """下载单个图像：带指数退避的重试、解码与尺寸校验、可选缩放，原子写入"""
+    # 清单之外但已存在的文件（例如旧版脚本下载的）校验通过即可计入清单
+    if os.path.isfile(output_file) and os.path.getsize(output_file) > 0:
+        try:
+            with open(output_file, 'rb') as f:
+                content = f.read()
+            width, height = validate_image(content, min_side)
+            return {'key': key, 'file': os.path.basename(output_file), 'bytes': len(content), 'width': width, 'height': height}
+        except Exception:
+            pass
+
+    last_error = None
+    for attempt in range(max_retries):
+        try:
+            response = _session(pool_size).get(url, timeout=timeout)
+            response.raise_for_status()
+            content = response.content
+            expected = response.headers.get('content-length')
+            if expected is not None and 'content-encoding' not in response.headers and int(expected) != len(content):
+                raise IOError(f'内容不完整：{len(content)}/{expected} 字节')
+            width, height = validate_image(content, min_side)
+            if max_side is not None:
+                content, width, height = normalize_image(content, max_side)
+
+            tmp_file = output_file + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_file, output_file)
+            return {'key': key, 'file': os.path.basename(output_file), 'bytes': len(content), 'width': width, 'height': height}
+        except requests.HTTPError as e:
+            last_error = e
+            # 404 等客户端错误重试无意义
+            if e.response is not None and 400 <= e.response.status_code < 500 and e.response.status_code != 429:
+                break
+        except Exception as e:
+            last_error = e
+        time.sleep(min(30.0, 2 ** attempt) * (0.5 + random.random()))
+    raise RuntimeError(f'{url}：{last_error}')
+
+
+def _load_manifest(path):
+    done = {}
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 中断时写了一半的行
+                    continue
+                done[entry['key']] = entry
+    return done
+
+
+def download_images(items, output_dir, num_workers=32, max_retries=5, timeout=30, min_side=1, max_side=None,
+                    max_in_flight=None, log_interval=1000):
+    """
+    并行下载图像。
+
+    已完成的文件记录在 `<output_dir>/.download_manifest.jsonl` 中，重启时直接按 key 跳过，
+    不需要逐个检查文件；失败的记录写入 `.download_failures.jsonl`，重新运行时会再次尝试。
+
+    Args:
+        items: 可迭代的 (key, url, 文件名)。
+        max_side: 若设置，下载时把图像缩放到最长边不超过该值。
+
+    Returns:
+        tuple: (成功数, 跳过数, 失败数)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    done = _load_manifest(manifest_path)
+    max_in_flight = max_in_flight or num_workers * 4
+
+    num_ok, num_skipped, num_failed = 0, 0, 0
+    start = time.time()
+    with open(manifest_path, 'a') as f_manifest, \
+            open(os.path.join(output_dir, FAILURES_NAME), 'w') as f_failures, \
+            ThreadPoolExecutor(num_workers) as executor:
+        in_flight = {}
+
+        def drain(return_when):
+            nonlocal num_ok, num_failed
+            finished, _ = wait(in_flight, return_when=return_when)
+            for future in finished:
+                key, url = in_flight.pop(future)
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    num_failed += 1
+                    f_failures.write(json.dumps({'key': key, 'url': url, 'error': str(e)}, ensure_ascii=False) + '\n')
+                    continue
+                num_ok += 1
+                f_manifest.write(json.dumps(entry) + '\n')
+                if (num_ok + num_failed) % log_interval == 0:
+                    f_manifest.flush()
+                    speed = (num_ok + num_failed) / (time.time() - start)
+                    print(f'已下载 {num_ok}，失败 {num_failed}，跳过 {num_skipped}，{speed:.1f} 张/秒')
+
+        for key, url, filename in items:
+            if key in done:
+                num_skipped += 1
+                continue
+            future = executor.submit(download_one, key, url, os.path.join(output_dir, filename), max_retries=max_retries,
+                                     timeout=timeout, min_side=min_side, max_side=max_side, pool_size=num_workers)
+            in_flight[future] = (key, url)
+            if len(in_flight) >= max_in_flight:
+                drain(FIRST_COMPLETED)
+        if in_flight:
+            drain(ALL_COMPLETED)
+
+    print(f'下载完成：成功 {num_ok}，跳过 {num_skipped}，失败 {num_failed}，用时 {time.time() - start:.1f} 秒')
+    return num_ok, num_skipped, num_failed
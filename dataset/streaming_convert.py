@@ -0,0 +1,112 @@
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+
+def iter_json_records(file_path):
+    """逐条读取源数据：JSONL 按行流式解析，JSON 数组整体加载后逐条返回"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        if file_path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        data = json.load(f)
+    if not isinstance(data, list):
+        data = [data]
+    yield from data
+
+
+def _convert_one(convert_fn, indexed_record):
+    idx, record = indexed_record
+    try:
+        outputs, errors = convert_fn(idx, record)
+    except Exception as e:
+        outputs, errors = [], [f"项目 {idx + 1} 整体处理失败：{str(e)}"]
+    return [json.dumps(obj, ensure_ascii=False) + "\n" for obj in outputs], errors
+
+
+def _save_progress(progress_path, progress):
+    tmp_path = progress_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, progress_path)
+
+
+def run_streaming_conversion(records, convert_fn, output_path, error_log_path=None, num_workers=None,
+                             chunk_size=64, checkpoint_interval=5000, resume=True):
+    """
+    流式转换：`records` 逐条产生源数据，`convert_fn(idx, record)` 在进程池中执行，
+    返回 (输出对象列表, 错误信息列表)。输出按源数据顺序写入 JSONL。
+
+    每处理 `checkpoint_interval` 条记录写一次 `<output_path>.progress`，记录已完成的
+    条数和输出文件偏移；中断后重新运行会截断到该偏移并从下一条继续。全部完成后删除进度文件。
+
+    Args:
+        records: 可迭代的源数据（如 `iter_json_records`），不需要整体载入内存。
+        convert_fn: 模块顶层函数（需可被 pickle），图像检查、缩放、base64 编码等都放在这里。
+        num_workers: 进程数，默认 CPU 核数；0 表示在当前进程中执行（便于调试）。
+
+    Returns:
+        tuple: (输出行数, 错误条数)
+    """
+    progress_path = output_path + '.progress'
+    progress = {'num_records': 0, 'num_outputs': 0, 'num_errors': 0, 'output_bytes': 0, 'error_bytes': 0}
+    if resume and os.path.isfile(progress_path) and os.path.isfile(output_path):
+        with open(progress_path, 'r') as f:
+            progress = json.load(f)
+        print(f"从第 {progress['num_records']} 条记录继续转换")
+
+    f_out = open(output_path, 'a+b' if progress['output_bytes'] > 0 else 'wb')
+    f_out.truncate(progress['output_bytes'])
+    f_out.seek(progress['output_bytes'])
+    f_err = None
+    if error_log_path is not None:
+        f_err = open(error_log_path, 'a+b' if progress['error_bytes'] > 0 else 'wb')
+        f_err.truncate(progress['error_bytes'])
+        f_err.seek(progress['error_bytes'])
+
+    tasks = itertools.islice(enumerate(records), progress['num_records'], None)
+    worker = functools.partial(_convert_one, convert_fn)
+    pool = None
+    if num_workers == 0:
+        results = map(worker, tasks)
+    else:
+        pool = multiprocessing.Pool(num_workers)
+        results = pool.imap(worker, tasks, chunksize=chunk_size)
+
+    start, start_records = time.time(), progress['num_records']
+    try:
+        for lines, errors in results:
+            f_out.write(''.join(lines).encode('utf-8'))
+            if f_err is not None and errors:
+                f_err.write(''.join(err + "\n" for err in errors).encode('utf-8'))
+            progress['num_records'] += 1
+            progress['num_outputs'] += len(lines)
+            progress['num_errors'] += len(errors)
+
+            if progress['num_records'] % checkpoint_interval == 0:
+                for f in (f_out, f_err):
+                    if f is not None:
+                        f.flush()
+                        os.fsync(f.fileno())
+                progress['output_bytes'] = f_out.tell()
+                progress['error_bytes'] = f_err.tell() if f_err is not None else 0
+                _save_progress(progress_path, progress)
+                speed = (progress['num_records'] - start_records) / (time.time() - start)
+                print(f"已处理 {progress['num_records']} 条记录，输出 {progress['num_outputs']} 行，{speed:.1f} 条/秒")
+    finally:
+        if pool is not None:
+            pool.terminate()
+        f_out.close()
+        if f_err is not None:
+            f_err.close()
+
+    if os.path.isfile(progress_path):
+        os.remove(progress_path)
+    print(f"转换完成：{progress['num_records']} 条记录，输出 {progress['num_outputs']} 行，"
+          f"{progress['num_errors']} 条错误，用时 {time.time() - start:.1f} 秒")
+    return progress['num_outputs'], progress['num_errors']
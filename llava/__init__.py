@@ -1 +1,15 @@
-from .model.language_model.llava_llama import LlavaLlamaForCausalLM
+import importlib
+
+# Model classes are resolved on first access so that `import llava` (and light
+# entry points such as the eval scorers) do not pull in torch and transformers.
+_LAZY_ATTRS = {
+    "LlavaLlamaForCausalLM": ".model.language_model.llava_llama",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        value = getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
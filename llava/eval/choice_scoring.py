@@ -0,0 +1,118 @@
+"""
+Likelihood scoring of multiple-choice answers.
+
+Instead of generating an answer and parsing the text, every candidate answer
+is scored by its log-probability after the prompt and the most likely one is
+the prediction. When every candidate is a single token (option letters,
+Yes/No) a question costs one forward pass, read at the last position and
+without computing logits anywhere else. Longer candidates are appended to the
+prompt, one row per candidate, and their token log-probabilities summed.
+Questions are batched with left padding.
+"""
+import re
+
+import torch
+
+
+_LETTER_LINE = re.compile(r'^([A-Z])\. ', re.MULTILINE)
+_LETTER_PAREN = re.compile(r'\(([A-Z])\) ')
+
+
+def option_letters(text):
+    """
+    Option letters listed in a question, either one per line (`A. cat`, as in
+    MMBench and SEED) or inline (`(A) cat (B) dog`, as in ScienceQA).
+    """
+    letters = _LETTER_LINE.findall(text) or _LETTER_PAREN.findall(text)
+    return list(dict.fromkeys(letters))
+
+
+class ChoiceScorer:
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+        self._candidate_ids = {}
+
+    def candidate_ids(self, candidate):
+        """Token ids of `candidate` as the start of the assistant's reply."""
+        ids = self._candidate_ids.get(candidate)
+        if ids is None:
+            ids = self._candidate_ids[candidate] = self.tokenizer(candidate, add_special_tokens=False).input_ids
+        return ids
+
+    @torch.inference_mode()
+    def score(self, input_ids, images, image_sizes, candidates):
+        """
+        Args:
+            input_ids: Prompt ids of each question, from `tokenizer_image_token`.
+            images: Preprocessed image tensor of each question, None for text-only questions.
+            image_sizes: Original image size of each question, None for text-only questions.
+            candidates: Candidate answer strings of each question.
+
+        Returns:
+            list: (index of the most likely candidate, log-probability of every candidate) per question.
+        """
+        candidate_ids = [[self.candidate_ids(c) for c in cands] for cands in candidates]
+        single_token = all(len(ids) == 1 for cands in candidate_ids for ids in cands)
+        scores = [None] * len(input_ids)
+
+        # Questions with and without an image go through separate forward passes
+        with_image = [i for i in range(len(input_ids)) if images[i] is not None]
+        without_image = [i for i in range(len(input_ids)) if images[i] is None]
+        for group in (with_image, without_image):
+            if not group:
+                continue
+            if single_token:
+                rows = [(i, None) for i in group]
+                sequences = [input_ids[i] for i in group]
+                num_tail = 1
+            else:
+                rows = [(i, k) for i in group for k in range(len(candidate_ids[i]))]
+                sequences = [torch.cat([input_ids[i], torch.tensor(candidate_ids[i][k], dtype=input_ids[i].dtype)])
+                             for i, k in rows]
+                num_tail = max(len(candidate_ids[i][k]) for i, k in rows) + 1
+            log_probs = self._tail_log_probs(
+                sequences,
+                [images[i] for i, _ in rows] if group is with_image else None,
+                [image_sizes[i] for i, _ in rows] if group is with_image else None,
+                num_tail).cpu()
+
+            for row, (i, k) in enumerate(rows):
+                if single_token:
+                    scores[i] = log_probs[row, -1, [ids[0] for ids in candidate_ids[i]]].tolist()
+                    continue
+                ids = candidate_ids[i][k]
+                # The logits at position p predict the token at p + 1
+                start = num_tail - len(ids) - 1
+                if scores[i] is None:
+                    scores[i] = [None] * len(candidate_ids[i])
+                scores[i][k] = sum(log_probs[row, start + j, t].item() for j, t in enumerate(ids))
+
+        return [(max(range(len(s)), key=s.__getitem__), s) for s in scores]
+
+    def _tail_log_probs(self, sequences, images, image_sizes, num_tail):
+        """Next-token log-probabilities at the last `num_tail` positions of each left-padded sequence."""
+        model = self.model
+        max_len = max(len(ids) for ids in sequences)
+        input_ids = torch.full((len(sequences), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+        for b, ids in enumerate(sequences):
+            input_ids[b, max_len - len(ids):] = ids
+            attention_mask[b, max_len - len(ids):] = 1
+        # Passing position ids also makes the image splice return its own, and the
+        # image features are spliced in after the left padding
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+        input_ids = input_ids.to(model.device)
+        if images is not None:
+            images = [image.to(model.device, dtype=model.dtype) for image in images]
+        _, position_ids, attention_mask, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(
+            input_ids, position_ids.to(model.device), attention_mask.to(model.device), None, None,
+            images, image_sizes=image_sizes, padding_side='left')
+        if inputs_embeds is None:
+            inputs_embeds = model.get_model().embed_tokens(input_ids)
+        hidden_states = model.get_model()(
+            inputs_embeds=inputs_embeds, attention_mask=attention_mask, position_ids=position_ids,
+            use_cache=False).last_hidden_state
+        return torch.log_softmax(model.lm_head(hidden_states[:, -num_tail:]).float(), dim=-1)
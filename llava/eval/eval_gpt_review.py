@@ -2,38 +2,7 @@
 import json
 import os
 
-import openai
-import tqdm
-import ray
-import time
-
-NUM_SECONDS_TO_SLEEP = 3
-
-@ray.remote(num_cpus=4)
-def get_eval(content: str, max_tokens: int):
-    while True:
-        try:
-            response = openai.ChatCompletion.create(
-                model='gpt-4',
-                messages=[{
-                    'role': 'system',
-                    'content': 'You are a helpful and precise assistant for checking the quality of the answer.'
-                }, {
-                    'role': 'user',
-                    'content': content,
-                }],
-                temperature=0.2,  # TODO: figure out which temperature is best for evaluation
-                max_tokens=max_tokens,
-            )
-            break
-        except openai.error.RateLimitError:
-            pass
-        except Exception as e:
-            print(e)
-        time.sleep(NUM_SECONDS_TO_SLEEP)
-
-    print('success!')
-    return response['choices'][0]['message']['content']
+from llava.eval.judge_client import add_judge_args, review_all
 
 
 def parse_score(review):
@@ -60,19 +29,15 @@ def parse_score(review):
     parser.add_argument('-r', '--rule')
     parser.add_argument('-o', '--output')
     parser.add_argument('--max-tokens', type=int, default=1024, help='maximum number of tokens produced in the output')
+    add_judge_args(parser, default_model='gpt-4')
     args = parser.parse_args()
 
-    ray.init()
-
     f_q = open(os.path.expanduser(args.question))
     f_ans1 = open(os.path.expanduser(args.answer_list[0]))
     f_ans2 = open(os.path.expanduser(args.answer_list[1]))
     rule_dict = json.load(open(os.path.expanduser(args.rule), 'r'))
 
-    review_file = open(f'{args.output}', 'w')
-
-    js_list = []
-    handles = []
+    jobs = []
     idx = 0
     for ques_js, ans1_js, ans2_js in zip(f_q, f_ans1, f_ans2):
         # if idx == 1:
@@ -93,21 +58,13 @@ def parse_score(review):
                    f'[{role} 1]\n{ans1["text"]}\n\n[End of {role} 1]\n\n'
                    f'[{role} 2]\n{ans2["text"]}\n\n[End of {role} 2]\n\n'
                    f'[System]\n{prompt}\n\n')
-        js_list.append({
+        cur_js = {
             'id': idx+1,
             'question_id': ques['question_id'],
             'answer1_id': ans1['answer_id'],
             'answer2_id': ans2['answer_id'],
-            'category': category})
+            'category': category}
         idx += 1
-        handles.append(get_eval.remote(content, args.max_tokens))
-        # To avoid the rate limit set by OpenAI
-        time.sleep(NUM_SECONDS_TO_SLEEP)
+        jobs.append((cur_js, content))
 
-    reviews = ray.get(handles)
-    for idx, review in enumerate(reviews):
-        scores = parse_score(review)
-        js_list[idx]['content'] = review
-        js_list[idx]['tuple'] = scores
-        review_file.write(json.dumps(js_list[idx]) + '\n')
-    review_file.close()
+    review_all(jobs, args.output, args, parse_score)
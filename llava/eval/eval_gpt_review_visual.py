@@ -2,35 +2,7 @@
 import json
 import os
 
-import openai
-import time
-
-NUM_SECONDS_TO_SLEEP = 0.5
-
-
-def get_eval(content: str, max_tokens: int):
-    while True:
-        try:
-            response = openai.ChatCompletion.create(
-                model='gpt-4-0314',
-                messages=[{
-                    'role': 'system',
-                    'content': 'You are a helpful and precise assistant for checking the quality of the answer.'
-                }, {
-                    'role': 'user',
-                    'content': content,
-                }],
-                temperature=0.2,  # TODO: figure out which temperature is best for evaluation
-                max_tokens=max_tokens,
-            )
-            break
-        except openai.error.RateLimitError:
-            pass
-        except Exception as e:
-            print(e)
-        time.sleep(NUM_SECONDS_TO_SLEEP)
-
-    return response['choices'][0]['message']['content']
+from llava.eval.judge_client import add_judge_args, review_all
 
 
 def parse_score(review):
@@ -57,6 +29,7 @@ def parse_score(review):
     parser.add_argument('-r', '--rule')
     parser.add_argument('-o', '--output')
     parser.add_argument('--max-tokens', type=int, default=1024, help='maximum number of tokens produced in the output')
+    add_judge_args(parser, default_model='gpt-4-0314')
     args = parser.parse_args()
 
     f_q = open(os.path.expanduser(args.question))
@@ -64,17 +37,10 @@ def parse_score(review):
     f_ans2 = open(os.path.expanduser(args.answer_list[1]))
     rule_dict = json.load(open(os.path.expanduser(args.rule), 'r'))
 
-    if os.path.isfile(os.path.expanduser(args.output)):
-        cur_reviews = [json.loads(line) for line in open(os.path.expanduser(args.output))]
-    else:
-        cur_reviews = []
-
-    review_file = open(f'{args.output}', 'a')
-
     context_list = [json.loads(line) for line in open(os.path.expanduser(args.context))]
     image_to_context = {context['image']: context for context in context_list}
 
-    handles = []
+    jobs = []
     idx = 0
     for ques_js, ans1_js, ans2_js in zip(f_q, f_ans1, f_ans2):
         ques = json.loads(ques_js)
@@ -104,15 +70,7 @@ def parse_score(review):
             'answer2_id': ans2.get('answer_id', ans2['answer_id']),
             'category': category
         }
-        if idx >= len(cur_reviews):
-            review = get_eval(content, args.max_tokens)
-            scores = parse_score(review)
-            cur_js['content'] = review
-            cur_js['tuple'] = scores
-            review_file.write(json.dumps(cur_js) + '\n')
-            review_file.flush()
-        else:
-            print(f'Skipping {idx} as we already have it.')
+        jobs.append((cur_js, content))
         idx += 1
-        print(idx)
-    review_file.close()
+
+    review_all(jobs, args.output, args, parse_score)
@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+
+import httpx
+
+
+DEFAULT_SYSTEM_PROMPT = 'You are a helpful and precise assistant for checking the quality of the answer.'
+RETRY_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Allow `rate` requests per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ResponseCache:
+    """Append-only JSONL cache of judge responses keyed by a hash of the full request."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if path is not None and os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a write interrupted mid-line
+                        continue
+                    self.entries[entry['key']] = entry['response']
+
+    @staticmethod
+    def key(payload):
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, response):
+        self.entries[key] = response
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'key': key, 'response': response}) + '\n')
+
+
+class JudgeClient:
+    """
+    Asynchronous client for an OpenAI-compatible `/chat/completions` judge.
+
+    At most `concurrency` requests are in flight and a token bucket keeps the
+    request rate under `requests_per_minute`. Rate-limit, timeout and server
+    errors are retried with exponential backoff and jitter, honouring
+    `Retry-After`. Responses are cached on disk, so rerunning an evaluation
+    only pays for requests that never completed. `base_url` can point at a
+    local stub server (see `scripts/judge_stub_server.py`).
+    """
+
+    def __init__(self, model, base_url=None, api_key=None, concurrency=8, requests_per_minute=60,
+                 max_retries=8, timeout=120, cache_path=None):
+        self.model = model
+        self.base_url = (base_url or os.environ.get('OPENAI_API_BASE', 'https://api.openai.com/v1')).rstrip('/')
+        self.api_key = api_key if api_key is not None else os.environ.get('OPENAI_API_KEY', '')
+        self.concurrency = concurrency
+        self.requests_per_minute = requests_per_minute
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.cache = ResponseCache(cache_path)
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.bucket = TokenBucket(self.requests_per_minute / 60.0, capacity=self.concurrency)
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={'Authorization': f'Bearer {self.api_key}'},
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.concurrency),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.aclose()
+
+    async def complete(self, content, max_tokens, system_prompt=DEFAULT_SYSTEM_PROMPT, temperature=0.2):
+        payload = {
+            'model': self.model,
+            'messages': [{
+                'role': 'system',
+                'content': system_prompt,
+            }, {
+                'role': 'user',
+                'content': content,
+            }],
+            'temperature': temperature,
+            'max_tokens': max_tokens,
+        }
+        key = ResponseCache.key(payload)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        async with self.semaphore:
+            response = await self._post(payload)
+        text = response['choices'][0]['message']['content']
+        self.cache.put(key, text)
+        return text
+
+    async def _post(self, payload):
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            delay = min(60.0, 2 ** attempt) * (0.5 + random.random())
+            try:
+                response = await self.client.post('/chat/completions', json=payload)
+            except httpx.TransportError as e:
+                print(f'judge request failed ({type(e).__name__}), retrying in {delay:.1f}s')
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                retry_after = response.headers.get('retry-after')
+                if retry_after is not None:
+                    try:
+                        delay = max(delay, float(retry_after))
+                    except ValueError:
+                        pass
+                print(f'judge returned {response.status_code}, retrying in {delay:.1f}s')
+            if attempt < self.max_retries:
+                await asyncio.sleep(delay)
+        raise RuntimeError(f'Judge request failed after {self.max_retries + 1} attempts')
+
+
+def add_judge_args(parser, default_model):
+    parser.add_argument('--judge-model', type=str, default=default_model)
+    parser.add_argument('--judge-base-url', type=str, default=None,
+                        help='OpenAI-compatible API base URL, defaults to $OPENAI_API_BASE or the OpenAI API')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests-per-minute', type=float, default=60)
+    parser.add_argument('--max-retries', type=int, default=8)
+    parser.add_argument('--cache', type=str, default=None,
+                        help='JSONL response cache, defaults to <output>.cache.jsonl')
+    return parser
+
+
+async def _review_all(jobs, output, args, parse_score):
+    if os.path.isfile(output):
+        with open(output) as f:
+            num_done = sum(1 for line in f if line.strip())
+    else:
+        num_done = 0
+    if num_done > 0:
+        print(f'Skipping the first {num_done} reviews as we already have them.')
+    pending = jobs[num_done:]
+
+    cache_path = args.cache if args.cache is not None else output + '.cache.jsonl'
+    async with JudgeClient(args.judge_model, base_url=args.judge_base_url, concurrency=args.concurrency,
+                           requests_per_minute=args.requests_per_minute, max_retries=args.max_retries,
+                           cache_path=cache_path) as client:
+        tasks = [asyncio.ensure_future(client.complete(content, args.max_tokens)) for _, content in pending]
+        # Reviews finish out of order but are appended in job order, so the
+        # output is always a prefix of the jobs and a rerun resumes after it.
+        with open(output, 'a') as review_file:
+            try:
+                for idx, ((record, _), task) in enumerate(zip(pending, tasks)):
+                    review = await task
+                    record = dict(record, content=review, tuple=parse_score(review))
+                    review_file.write(json.dumps(record) + '\n')
+                    review_file.flush()
+                    print(f'{num_done + idx + 1}/{len(jobs)}')
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+
+def review_all(jobs, output, args, parse_score):
+    """
+    Judge every `(record, content)` job concurrently and append `record` with the
+    review `content` and parsed score `tuple` to the `output` JSONL, in job order.
+    Reviews already in `output` are skipped.
+    """
+    asyncio.run(_review_all(jobs, os.path.expanduser(output), args, parse_score))
@@ -10,6 +10,7 @@
 from llava.model.builder import load_pretrained_model
 from llava.utils import disable_torch_init
 from llava.mm_utils import tokenizer_image_token, process_images, get_model_name_from_path
+from llava.eval.choice_scoring import ChoiceScorer, option_letters
 from torch.utils.data import Dataset, DataLoader
 
 from PIL import Image
@@ -68,12 +69,18 @@ def collate_fn(batch):
     return input_ids, image_tensors, image_sizes
 
 
+def collate_list_fn(batch):
+    # Prompts differ in length, `ChoiceScorer` pads them
+    input_ids, image_tensors, image_sizes = zip(*batch)
+    return list(input_ids), list(image_tensors), list(image_sizes)
+
+
 # DataLoader
 def create_data_loader(questions, image_folder, tokenizer, image_processor, model_config, batch_size=1, num_workers=4):
-    assert batch_size == 1, "batch_size must be 1"
     dataset = CustomDataset(questions, image_folder, tokenizer, image_processor, model_config)
-    data_loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False, collate_fn=collate_fn)
-    return data_loader
+    if batch_size == 1:
+        return DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False, collate_fn=collate_fn)
+    return DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False, collate_fn=collate_list_fn)
 
 
 def eval_model(args):
@@ -93,6 +100,11 @@ def eval_model(args):
         args.conv_mode = args.conv_mode + '_mmtag'
         print(f'It seems that this is a plain model, but it is not using a mmtag prompt, auto switching to {args.conv_mode}.')
 
+    if args.scoring == 'likelihood':
+        score_choices(args, questions, tokenizer, model, image_processor, ans_file, model_name)
+        ans_file.close()
+        return
+
     data_loader = create_data_loader(questions, args.image_folder, tokenizer, image_processor, model.config)
 
     for (input_ids, image_tensor, image_sizes), line in tqdm(zip(data_loader, questions), total=len(questions)):
@@ -125,6 +137,29 @@ def eval_model(args):
         # ans_file.flush()
     ans_file.close()
 
+
+def score_choices(args, questions, tokenizer, model, image_processor, ans_file, model_name):
+    """Answer with the most likely candidate, `--batch-size` questions per forward pass."""
+    scorer = ChoiceScorer(model, tokenizer)
+    fixed_candidates = args.candidates.split(',') if args.candidates else None
+    data_loader = create_data_loader(questions, args.image_folder, tokenizer, image_processor, model.config,
+                                     batch_size=args.batch_size)
+    batches = (questions[i:i + args.batch_size] for i in range(0, len(questions), args.batch_size))
+    with tqdm(total=len(questions)) as progress:
+        for (input_ids, image_tensors, image_sizes), lines in zip(data_loader, batches):
+            candidates = [fixed_candidates or option_letters(line["text"]) for line in lines]
+            for line, cands, (best, scores) in zip(lines, candidates,
+                                                   scorer.score(input_ids, image_tensors, image_sizes, candidates)):
+                ans_file.write(json.dumps({"question_id": line["question_id"],
+                                           "prompt": line["text"],
+                                           "text": cands[best],
+                                           "answer_id": shortuuid.uuid(),
+                                           "model_id": model_name,
+                                           "metadata": {"scoring": "likelihood",
+                                                        "log_probs": dict(zip(cands, scores))}}) + "\n")
+            progress.update(len(lines))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--model-path", type=str, default="facebook/opt-350m")
@@ -139,6 +174,12 @@ def eval_model(args):
     parser.add_argument("--top_p", type=float, default=None)
     parser.add_argument("--num_beams", type=int, default=1)
     parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument("--scoring", type=str, default="generate", choices=["generate", "likelihood"],
+                        help="`likelihood` picks the candidate answer with the highest log-probability instead of generating")
+    parser.add_argument("--candidates", type=str, default=None,
+                        help="comma-separated answers for --scoring likelihood, e.g. `Yes,No` for POPE; "
+                             "defaults to the option letters listed in each question")
+    parser.add_argument("--batch-size", type=int, default=16, help="questions per forward pass with --scoring likelihood")
     args = parser.parse_args()
 
     eval_model(args)
@@ -11,6 +11,7 @@
 from llava.model.builder import load_pretrained_model
 from llava.utils import disable_torch_init
 from llava.mm_utils import tokenizer_image_token, process_images, load_image_from_base64, get_model_name_from_path
+from llava.eval.choice_scoring import ChoiceScorer
 
 from PIL import Image
 import math
@@ -68,6 +69,24 @@ def eval_model(args):
         args.conv_mode = args.conv_mode + '_mmtag'
         print(f'It seems that this is a plain model, but it is not using a mmtag prompt, auto switching to {args.conv_mode}.')
 
+    scorer = ChoiceScorer(model, tokenizer) if args.scoring == 'likelihood' else None
+    pending = []
+
+    def write_answer(record, outputs, metadata):
+        ans_file.write(json.dumps({**record,
+                                   "text": outputs,
+                                   "answer_id": shortuuid.uuid(),
+                                   "model_id": model_name,
+                                   "metadata": metadata}) + "\n")
+
+    def flush_pending():
+        input_ids, images, image_sizes, candidates, records = zip(*pending)
+        for record, cands, (best, scores) in zip(records, candidates,
+                                                 scorer.score(input_ids, images, image_sizes, candidates)):
+            write_answer(record, cands[best], {"scoring": "likelihood", "log_probs": dict(zip(cands, scores))})
+        ans_file.flush()
+        pending.clear()
+
     for index, row in tqdm(questions.iterrows(), total=len(questions)):
         options = get_options(row, all_options)
         cur_option_char = all_options[:len(options)]
@@ -103,40 +122,45 @@ def eval_model(args):
             conv.append_message(conv.roles[1], None)
             prompt = conv.get_prompt()
 
-            input_ids = tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).cuda()
-
             image_tensor = process_images([image], image_processor, model.config)[0]
-
-            with torch.inference_mode():
-                output_ids = model.generate(
-                    input_ids,
-                    images=image_tensor.unsqueeze(0).half().cuda(),
-                    image_sizes=[image.size],
-                    do_sample=True if args.temperature > 0 else False,
-                    temperature=args.temperature,
-                    top_p=args.top_p,
-                    num_beams=args.num_beams,
-                    # no_repeat_ngram_size=3,
-                    max_new_tokens=1024,
-                    use_cache=True)
-
-            outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
-
-            ans_id = shortuuid.uuid()
-            ans_file.write(json.dumps({"question_id": idx,
-                                    "round_id": round_idx,
-                                    "prompt": cur_prompt,
-                                    "text": outputs,
-                                    "options": options,
-                                    "option_char": cur_option_char,
-                                    "answer_id": ans_id,
-                                    "model_id": model_name,
-                                    "metadata": {}}) + "\n")
-            ans_file.flush()
+            record = {"question_id": idx,
+                      "round_id": round_idx,
+                      "prompt": cur_prompt,
+                      "options": options,
+                      "option_char": cur_option_char}
+
+            if scorer is not None:
+                # The options are always listed as A, B, ... in the prompt
+                pending.append((tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt'),
+                                image_tensor, image.size, all_options[:len(options)], record))
+                if len(pending) >= args.batch_size:
+                    flush_pending()
+            else:
+                input_ids = tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).cuda()
+
+                with torch.inference_mode():
+                    output_ids = model.generate(
+                        input_ids,
+                        images=image_tensor.unsqueeze(0).half().cuda(),
+                        image_sizes=[image.size],
+                        do_sample=True if args.temperature > 0 else False,
+                        temperature=args.temperature,
+                        top_p=args.top_p,
+                        num_beams=args.num_beams,
+                        # no_repeat_ngram_size=3,
+                        max_new_tokens=1024,
+                        use_cache=True)
+
+                outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
+
+                write_answer(record, outputs, {})
+                ans_file.flush()
 
             # rotate options
             options = options[1:] + options[:1]
             cur_option_char = cur_option_char[1:] + cur_option_char[:1]
+    if pending:
+        flush_pending()
     ans_file.close()
 
 if __name__ == "__main__":
@@ -155,6 +179,9 @@ def eval_model(args):
     parser.add_argument("--all-rounds", action="store_true")
     parser.add_argument("--single-pred-prompt", action="store_true")
     parser.add_argument("--lang", type=str, default="en")
+    parser.add_argument("--scoring", type=str, default="generate", choices=["generate", "likelihood"],
+                        help="`likelihood` picks the option letter with the highest log-probability instead of generating")
+    parser.add_argument("--batch-size", type=int, default=16, help="questions per forward pass with --scoring likelihood")
     args = parser.parse_args()
 
     eval_model(args)
@@ -10,6 +10,7 @@
 from llava.model.builder import load_pretrained_model
 from llava.utils import disable_torch_init
 from llava.mm_utils import tokenizer_image_token, process_images, get_model_name_from_path
+from llava.eval.choice_scoring import ChoiceScorer, option_letters
 
 from PIL import Image
 import math
@@ -38,6 +39,26 @@ def eval_model(args):
     answers_file = os.path.expanduser(args.answers_file)
     os.makedirs(os.path.dirname(answers_file), exist_ok=True)
     ans_file = open(answers_file, "w")
+
+    scorer = ChoiceScorer(model, tokenizer) if args.scoring == 'likelihood' else None
+    pending = []
+
+    def write_answer(idx, cur_prompt, outputs, metadata):
+        ans_file.write(json.dumps({"question_id": idx,
+                                   "prompt": cur_prompt,
+                                   "text": outputs,
+                                   "answer_id": shortuuid.uuid(),
+                                   "model_id": model_name,
+                                   "metadata": metadata}) + "\n")
+
+    def flush_pending():
+        input_ids, images, image_sizes, candidates, records = zip(*pending)
+        for (idx, cur_prompt), cands, (best, scores) in zip(records, candidates,
+                                                            scorer.score(input_ids, images, image_sizes, candidates)):
+            write_answer(idx, cur_prompt, cands[best], {"scoring": "likelihood", "log_probs": dict(zip(cands, scores))})
+        ans_file.flush()
+        pending.clear()
+
     for i, line in enumerate(tqdm(questions)):
         idx = line["id"]
         question = line['conversations'][0]
@@ -50,14 +71,17 @@ def eval_model(args):
             image_tensor = process_images([image], image_processor, model.config)[0]
             images = image_tensor.unsqueeze(0).half().cuda()
             image_sizes = [image.size]
+            image_size = image.size
             if getattr(model.config, 'mm_use_im_start_end', False):
                 qs = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n' + qs
             else:
                 qs = DEFAULT_IMAGE_TOKEN + '\n' + qs
             cur_prompt = '<image>' + '\n' + cur_prompt
         else:
+            image_tensor = None
             images = None
             image_sizes = None
+            image_size = None
 
         if args.single_pred_prompt:
             qs = qs + '\n' + "Answer with the option's letter from the given choices directly."
@@ -68,6 +92,14 @@ def eval_model(args):
         conv.append_message(conv.roles[1], None)
         prompt = conv.get_prompt()
 
+        if scorer is not None:
+            candidates = option_letters(question['value']) or args.options
+            pending.append((tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt'),
+                            image_tensor, image_size, candidates, (idx, cur_prompt)))
+            if len(pending) >= args.batch_size:
+                flush_pending()
+            continue
+
         input_ids = tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).cuda()
 
         with torch.inference_mode():
@@ -83,14 +115,10 @@ def eval_model(args):
 
         outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
 
-        ans_id = shortuuid.uuid()
-        ans_file.write(json.dumps({"question_id": idx,
-                                   "prompt": cur_prompt,
-                                   "text": outputs,
-                                   "answer_id": ans_id,
-                                   "model_id": model_name,
-                                   "metadata": {}}) + "\n")
+        write_answer(idx, cur_prompt, outputs, {})
         ans_file.flush()
+    if pending:
+        flush_pending()
     ans_file.close()
 
 if __name__ == "__main__":
@@ -106,6 +134,10 @@ def eval_model(args):
     parser.add_argument("--temperature", type=float, default=0.2)
     parser.add_argument("--answer-prompter", action="store_true")
     parser.add_argument("--single-pred-prompt", action="store_true")
+    parser.add_argument("--scoring", type=str, default="generate", choices=["generate", "likelihood"],
+                        help="`likelihood` picks the option letter with the highest log-probability instead of generating")
+    parser.add_argument("--batch-size", type=int, default=16, help="questions per forward pass with --scoring likelihood")
+    parser.add_argument("--options", type=list, default=["A", "B", "C", "D", "E"])
     args = parser.parse_args()
 
     eval_model(args)
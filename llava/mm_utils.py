@@ -4,6 +4,8 @@
 import torch
 import math
 import ast
+import weakref
+from collections import OrderedDict
 
 from transformers import StoppingCriteria
 from llava.constants import IMAGE_TOKEN_INDEX
@@ -182,20 +184,59 @@ def process_images(images, image_processor, model_cfg):
     return new_images
 
 
-def tokenizer_image_token(prompt, tokenizer, image_token_index=IMAGE_TOKEN_INDEX, return_tensors=None):
-    prompt_chunks = [tokenizer(chunk).input_ids for chunk in prompt.split('<image>')]
+_TOKENIZER_CHUNK_CACHE_SIZE = 65536
+# Per tokenizer: (vocabulary size the entries were computed with, LRU of chunk -> ids)
+_tokenizer_chunk_cache = weakref.WeakKeyDictionary()
+
 
-    def insert_separator(X, sep):
-        return [ele for sublist in zip(X, [sep]*len(X)) for ele in sublist][:-1]
+def _tokenize_chunks(chunks, tokenizer):
+    """
+    Tokenize a list of text chunks, returning one list of ids per chunk.
 
+    Fast tokenizers handle the whole list in a single batched call. Slow
+    (sentencepiece) tokenizers, as loaded with `use_fast=False` in `builder.py`,
+    go through a bounded LRU cache per tokenizer instead, so chunks that repeat
+    across samples, such as a system prompt before the image, are tokenized once.
+    """
+    if getattr(tokenizer, 'is_fast', False):
+        return tokenizer(chunks).input_ids if len(chunks) > 0 else []
+
+    # Adding tokens changes `len(tokenizer)` and invalidates the cache.
+    vocab_size, cache = _tokenizer_chunk_cache.get(tokenizer, (None, None))
+    if vocab_size != len(tokenizer):
+        cache = OrderedDict()
+        _tokenizer_chunk_cache[tokenizer] = (len(tokenizer), cache)
+    chunk_ids = []
+    for chunk in chunks:
+        ids = cache.get(chunk)
+        if ids is None:
+            ids = tuple(tokenizer(chunk).input_ids)
+            cache[chunk] = ids
+            if len(cache) > _TOKENIZER_CHUNK_CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(chunk)
+        chunk_ids.append(ids)
+    return chunk_ids
+
+
+def _join_image_chunks(prompt_chunks, bos_token_id, image_token_index):
     input_ids = []
     offset = 0
-    if len(prompt_chunks) > 0 and len(prompt_chunks[0]) > 0 and prompt_chunks[0][0] == tokenizer.bos_token_id:
+    if len(prompt_chunks) > 0 and len(prompt_chunks[0]) > 0 and prompt_chunks[0][0] == bos_token_id:
         offset = 1
         input_ids.append(prompt_chunks[0][0])
 
-    for x in insert_separator(prompt_chunks, [image_token_index] * (offset + 1)):
-        input_ids.extend(x[offset:])
+    for i, chunk in enumerate(prompt_chunks):
+        if i > 0:
+            input_ids.append(image_token_index)
+        input_ids.extend(chunk[offset:])
+    return input_ids
+
+
+def tokenizer_image_token(prompt, tokenizer, image_token_index=IMAGE_TOKEN_INDEX, return_tensors=None):
+    prompt_chunks = _tokenize_chunks(prompt.split('<image>'), tokenizer)
+    input_ids = _join_image_chunks(prompt_chunks, tokenizer.bos_token_id, image_token_index)
 
     if return_tensors is not None:
         if return_tensors == 'pt':
@@ -204,6 +245,68 @@ def insert_separator(X, sep):
     return input_ids
 
 
+def tokenizer_image_token_batch(prompts, tokenizer, image_token_index=IMAGE_TOKEN_INDEX, padding_value=None, padding_side=None, return_tensors='pt'):
+    """
+    Batched version of `tokenizer_image_token`.
+
+    The `<image>` markers of every prompt are located by character offset and all
+    text chunks of the batch are tokenized in one tokenizer call, so the ids are
+    identical to calling `tokenizer_image_token` on each prompt separately.
+
+    Args:
+        prompts (list): A list of prompts, each may contain any number of `<image>` markers.
+        tokenizer: The tokenizer to use.
+        image_token_index (int): The id placed at each `<image>` marker.
+        padding_value (int): The id used for padding. Defaults to `tokenizer.pad_token_id`.
+        padding_side (str): 'left' or 'right'. Defaults to `tokenizer.padding_side`.
+        return_tensors (str): 'pt' for padded tensors, None for lists of ids.
+
+    Returns:
+        dict: `input_ids` and `attention_mask`, padded to the longest prompt when `return_tensors='pt'`.
+    """
+    chunks = []
+    chunk_spans = []
+    for prompt in prompts:
+        start = len(chunks)
+        char_offset = 0
+        while True:
+            marker = prompt.find('<image>', char_offset)
+            if marker == -1:
+                chunks.append(prompt[char_offset:])
+                break
+            chunks.append(prompt[char_offset:marker])
+            char_offset = marker + len('<image>')
+        chunk_spans.append((start, len(chunks)))
+
+    chunk_ids = _tokenize_chunks(chunks, tokenizer)
+    batch_ids = [_join_image_chunks(chunk_ids[start:end], tokenizer.bos_token_id, image_token_index)
+                 for start, end in chunk_spans]
+
+    if return_tensors is None:
+        return dict(input_ids=batch_ids, attention_mask=[[1] * len(ids) for ids in batch_ids])
+    if return_tensors != 'pt':
+        raise ValueError(f'Unsupported tensor type: {return_tensors}')
+
+    if padding_value is None:
+        padding_value = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    if padding_side is None:
+        padding_side = getattr(tokenizer, 'padding_side', 'right')
+
+    max_len = max((len(ids) for ids in batch_ids), default=0)
+    input_ids = torch.full((len(batch_ids), max_len), padding_value, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch_ids), max_len), dtype=torch.bool)
+    for i, ids in enumerate(batch_ids):
+        if len(ids) == 0:
+            continue
+        if padding_side == 'left':
+            input_ids[i, -len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, -len(ids):] = True
+        else:
+            input_ids[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, :len(ids)] = True
+    return dict(input_ids=input_ids, attention_mask=attention_mask)
+
+
 def get_model_name_from_path(model_path):
     model_path = model_path.strip("/")
     model_paths = model_path.split("/")
@@ -212,7 +315,60 @@ def get_model_name_from_path(model_path):
     else:
         return model_paths[-1]
 
+# Per tokenizer: (vocabulary size the entries were computed with, last character -> token ids)
+_keyword_tail_token_cache = weakref.WeakKeyDictionary()
+
+
+def _token_strings(tokenizer):
+    """Surface form of every token in the vocabulary, with sentencepiece and byte-fallback markers resolved."""
+    tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    strings = []
+    for token in tokens:
+        if token is None:
+            strings.append('')
+        elif len(token) == 6 and token.startswith('<0x') and token.endswith('>'):
+            strings.append(chr(int(token[3:5], 16)))
+        else:
+            strings.append(token.replace('\u2581', ' '))
+    return strings
+
+
+def keyword_tail_token_ids(tokenizer, keyword):
+    """
+    Ids of all tokens that could be the last token of a generation ending in `keyword`.
+
+    A keyword can only complete on a step whose new token contains the keyword's
+    last character. Returns None when the candidates cannot be determined from
+    token strings (e.g. byte-level vocabularies with non-ASCII keywords), in which
+    case every token has to be treated as a candidate.
+    """
+    last_char = keyword[-1:]
+    if not last_char or not last_char.isascii() or last_char.isspace():
+        return None
+    vocab_size, cache = _keyword_tail_token_cache.get(tokenizer, (None, None))
+    if vocab_size != len(tokenizer):
+        cache = {}
+        _keyword_tail_token_cache[tokenizer] = (len(tokenizer), cache)
+    if last_char not in cache:
+        strings = _token_strings(tokenizer)
+        cache[last_char] = torch.tensor(
+            [i for i, token in enumerate(strings) if last_char in token], dtype=torch.long)
+    return cache[last_char]
+
+
 class KeywordsStoppingCriteria(StoppingCriteria):
+    """
+    Stop generation once every sequence in the batch has produced one of `keywords`.
+
+    Keyword token sequences are precomputed and matched against the suffix of the
+    whole batch on device. Only sequences whose newest token could end a keyword
+    under a different tokenization get a small window decoded and searched as a
+    string. `__call__` returns True only once every sequence has matched, since
+    `generate` takes a single stop flag for the batch; `self.finished` records
+    which sequences already matched, so a keyword seen earlier is not forgotten
+    while the rest of the batch keeps generating. Use `call_for_batch` for the
+    per-sequence result of a single step.
+    """
     def __init__(self, keywords, tokenizer, input_ids):
         self.keywords = keywords
         self.keyword_ids = []
@@ -226,22 +382,61 @@ def __init__(self, keywords, tokenizer, input_ids):
             self.keyword_ids.append(torch.tensor(cur_keyword_ids))
         self.tokenizer = tokenizer
         self.start_len = input_ids.shape[1]
-    
-    def call_for_batch(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        offset = min(output_ids.shape[1] - self.start_len, self.max_keyword_len)
-        self.keyword_ids = [keyword_id.to(output_ids.device) for keyword_id in self.keyword_ids]
+
+        tail_ids = [keyword_tail_token_ids(tokenizer, keyword) for keyword in keywords]
+        if any(x is None for x in tail_ids):
+            self.tail_ids = None
+        else:
+            self.tail_ids = torch.unique(torch.cat(tail_ids)) if len(tail_ids) > 0 else torch.zeros(0, dtype=torch.long)
+        self.finished = None
+        self._last_len = 0
+        self._device = None
+
+    def _to(self, device):
+        if self._device != device:
+            self.keyword_ids = [keyword_id.to(device) for keyword_id in self.keyword_ids]
+            if self.tail_ids is not None:
+                self.tail_ids = self.tail_ids.to(device)
+            self._device = device
+
+    def call_for_batch(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        """Returns a bool tensor of shape (batch,) marking sequences that end with a keyword at this step."""
+        self._to(output_ids.device)
+        generated_len = output_ids.shape[1] - self.start_len
+        matched = torch.zeros(output_ids.shape[0], dtype=torch.bool, device=output_ids.device)
+        if generated_len <= 0:
+            return matched
+
         for keyword_id in self.keyword_ids:
-            truncated_output_ids = output_ids[0, -keyword_id.shape[0]:]
-            if torch.equal(truncated_output_ids, keyword_id):
-                return True
-        outputs = self.tokenizer.batch_decode(output_ids[:, -offset:], skip_special_tokens=True)[0]
-        for keyword in self.keywords:
-            if keyword in outputs:
-                return True
-        return False
-    
+            if 0 < keyword_id.shape[0] <= generated_len:
+                matched |= (output_ids[:, -keyword_id.shape[0]:] == keyword_id).all(dim=1)
+
+        # Keywords may be tokenized differently in context, so fall back to decoding a
+        # short window, but only for rows whose newest token could complete a keyword.
+        if self.tail_ids is None:
+            candidates = ~matched
+        else:
+            candidates = ~matched & torch.isin(output_ids[:, -1], self.tail_ids)
+        candidate_rows = candidates.nonzero(as_tuple=True)[0].tolist()
+        if len(candidate_rows) > 0:
+            offset = min(generated_len, self.max_keyword_len)
+            outputs = self.tokenizer.batch_decode(output_ids[candidate_rows, -offset:], skip_special_tokens=True)
+            for row, output in zip(candidate_rows, outputs):
+                if any(keyword in output for keyword in self.keywords):
+                    matched[row] = True
+        return matched
+
     def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        outputs = []
-        for i in range(output_ids.shape[0]):
-            outputs.append(self.call_for_batch(output_ids[i].unsqueeze(0), scores))
-        return all(outputs)
+        # Each step adds one token, so a sequence that did not grow means a new `generate` call
+        if (self.finished is None or self.finished.shape[0] != output_ids.shape[0]
+                or output_ids.shape[1] <= self._last_len):
+            self.finished = torch.zeros(output_ids.shape[0], dtype=torch.bool, device=output_ids.device)
+        self._last_len = output_ids.shape[1]
+        active = ~self.finished
+        if active.all():
+            self.finished |= self.call_for_batch(output_ids, scores)
+        else:
+            rows = active.nonzero(as_tuple=True)[0]
+            if len(rows) > 0:
+                self.finished[rows] |= self.call_for_batch(output_ids[rows], scores)
+        return bool(self.finished.all())
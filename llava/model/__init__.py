@@ -1,6 +1,22 @@
-try:
-    from .language_model.llava_llama import LlavaLlamaForCausalLM, LlavaConfig
-    from .language_model.llava_mpt import LlavaMptForCausalLM, LlavaMptConfig
-    from .language_model.llava_mistral import LlavaMistralForCausalLM, LlavaMistralConfig
-except:
-    pass
+import importlib
+
+# Each architecture is imported only when one of its classes is accessed, so
+# loading a LLaMA checkpoint does not import the MPT or Mistral code paths.
+_LAZY_ATTRS = {
+    "LlavaLlamaForCausalLM": ".language_model.llava_llama",
+    "LlavaConfig": ".language_model.llava_llama",
+    "LlavaMptForCausalLM": ".language_model.llava_mpt",
+    "LlavaMptConfig": ".language_model.llava_mpt",
+    "LlavaMistralForCausalLM": ".language_model.llava_mistral",
+    "LlavaMistralConfig": ".language_model.llava_mistral",
+}
+
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        value = getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -14,16 +14,126 @@
 
 
 import os
+import json
 import warnings
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 from transformers import AutoTokenizer, AutoModelForCausalLM, AutoConfig, BitsAndBytesConfig
 import torch
-from llava.model import *
 from llava.constants import DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 
 
+SERVING_SNAPSHOT_FILE = 'serving_snapshot.json'
+
+
+def is_serving_snapshot(model_path):
+    return os.path.isfile(os.path.join(model_path, SERVING_SNAPSHOT_FILE))
+
+
+def save_serving_snapshot(model, tokenizer, output_dir, max_shard_size="2GB", dtype=torch.float16):
+    """
+    Save a merged, pre-cast model as a serving snapshot.
+
+    The language model and projector are written as safetensors shards in the
+    regular HF layout, so the snapshot also loads through `from_pretrained`. The
+    vision tower and its image processor go to a `vision_tower` subfolder, so
+    serving does not need to reach the original CLIP checkpoint.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    model = model.to(dtype)
+
+    vision_tower = model.get_vision_tower() if hasattr(model, 'get_vision_tower') else None
+    vision_tower_folder = None
+    select_layer = getattr(model.config, 'mm_vision_select_layer', None)
+    if vision_tower is not None and vision_tower.is_loaded:
+        vision_tower_folder = 'vision_tower'
+        vision_tower.vision_tower.save_pretrained(os.path.join(output_dir, vision_tower_folder), safe_serialization=True)
+        vision_tower.image_processor.save_pretrained(os.path.join(output_dir, vision_tower_folder))
+        if hasattr(vision_tower, 'num_select_layers'):
+            # The saved tower may be truncated at the selected layer, where a negative index would pick another one
+            model.config.mm_vision_select_layer = vision_tower.num_select_layers
+
+    state_dict = {k: v for k, v in model.state_dict().items() if not k.startswith('model.vision_tower.')}
+    try:
+        model.save_pretrained(output_dir, state_dict=state_dict, safe_serialization=True, max_shard_size=max_shard_size)
+    finally:
+        if select_layer is not None:
+            model.config.mm_vision_select_layer = select_layer
+    tokenizer.save_pretrained(output_dir)
+
+    with open(os.path.join(output_dir, SERVING_SNAPSHOT_FILE), 'w') as f:
+        json.dump({
+            'architecture': type(model).__name__,
+            'dtype': str(dtype).replace('torch.', ''),
+            'use_fast_tokenizer': getattr(tokenizer, 'is_fast', False),
+            'vision_tower': vision_tower_folder,
+        }, f, indent=2)
+
+
+def load_serving_snapshot(model_path, device="cuda", num_workers=8):
+    """
+    Load a snapshot written by `save_serving_snapshot`.
+
+    The model is built on the meta device and the safetensors shards are read
+    in parallel (memory-mapped on CPU) and assigned in place, without random
+    init, dtype casts or LoRA merging.
+    """
+    from accelerate import init_empty_weights
+    from safetensors.torch import load_file
+    from transformers import GenerationConfig
+    import llava.model
+
+    with open(os.path.join(model_path, SERVING_SNAPSHOT_FILE)) as f:
+        snapshot = json.load(f)
+    model_cls = getattr(llava.model, snapshot['architecture'])
+    dtype = getattr(torch, snapshot['dtype'])
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=snapshot['use_fast_tokenizer'])
+    config = AutoConfig.from_pretrained(model_path)
+    if snapshot['vision_tower'] is not None:
+        config.mm_vision_tower = os.path.join(model_path, snapshot['vision_tower'])
+
+    with init_empty_weights():
+        model = model_cls(config)
+
+    index_file = os.path.join(model_path, 'model.safetensors.index.json')
+    if os.path.isfile(index_file):
+        with open(index_file) as f:
+            shard_files = sorted(set(json.load(f)['weight_map'].values()))
+    else:
+        shard_files = ['model.safetensors']
+    shard_files = [os.path.join(model_path, x) for x in shard_files]
+
+    with ThreadPoolExecutor(max_workers=min(num_workers, len(shard_files))) as executor:
+        for state_dict in executor.map(lambda x: load_file(x, device=str(device)), shard_files):
+            model.load_state_dict(state_dict, strict=False, assign=True)
+
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if len(missing) > 0:
+        raise ValueError(f'Serving snapshot at {model_path} is missing weights: {missing[:10]}')
+
+    model.tie_weights()
+    model.to(device=device, dtype=dtype)
+    if os.path.isfile(os.path.join(model_path, 'generation_config.json')):
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    model.eval()
+    return tokenizer, model
+
+
 def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, load_4bit=False, device_map="auto", device="cuda", use_flash_attn=False, **kwargs):
+    if is_serving_snapshot(model_path) and not (load_8bit or load_4bit or use_flash_attn) \
+            and (device != "cuda" or device_map != "auto" or torch.cuda.device_count() <= 1):
+        if device_map == "auto":
+            snapshot_device = device
+        elif isinstance(device_map, dict):
+            snapshot_device = device_map.get("", device)
+        else:
+            snapshot_device = device_map
+        print(f'Loading serving snapshot from {model_path}...')
+        tokenizer, model = load_serving_snapshot(model_path, device=snapshot_device)
+        return _finalize_llava_model(tokenizer, model, model_name, snapshot_device)
+
     kwargs = {"device_map": device_map, **kwargs}
 
     if device != "cuda":
@@ -50,7 +160,7 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
         if 'lora' in model_name.lower() and model_base is None:
             warnings.warn('There is `lora` in model name but no `model_base` is provided. If you are loading a LoRA model, please provide the `model_base` argument. Detailed instruction: https://github.com/haotian-liu/LLaVA#launch-a-model-worker-lora-weights-unmerged.')
         if 'lora' in model_name.lower() and model_base is not None:
-            from llava.model.language_model.llava_llama import LlavaConfig
+            from llava.model.language_model.llava_llama import LlavaConfig, LlavaLlamaForCausalLM
             lora_cfg_pretrained = LlavaConfig.from_pretrained(model_path)
             tokenizer = AutoTokenizer.from_pretrained(model_base, use_fast=False)
             print('Loading LLaVA from base model...')
@@ -105,12 +215,14 @@ def load_from_hf(repo_id, filename, subfolder=None):
             # this may be mm projector only
             print('Loading LLaVA from base model...')
             if 'mpt' in model_name.lower():
+                from llava.model.language_model.llava_mpt import LlavaMptForCausalLM
                 if not os.path.isfile(os.path.join(model_path, 'configuration_mpt.py')):
                     shutil.copyfile(os.path.join(model_base, 'configuration_mpt.py'), os.path.join(model_path, 'configuration_mpt.py'))
                 tokenizer = AutoTokenizer.from_pretrained(model_base, use_fast=True)
                 cfg_pretrained = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
                 model = LlavaMptForCausalLM.from_pretrained(model_base, low_cpu_mem_usage=True, config=cfg_pretrained, **kwargs)
             else:
+                from llava.model.language_model.llava_llama import LlavaLlamaForCausalLM
                 tokenizer = AutoTokenizer.from_pretrained(model_base, use_fast=False)
                 cfg_pretrained = AutoConfig.from_pretrained(model_path)
                 model = LlavaLlamaForCausalLM.from_pretrained(model_base, low_cpu_mem_usage=True, config=cfg_pretrained, **kwargs)
@@ -120,9 +232,11 @@ def load_from_hf(repo_id, filename, subfolder=None):
             model.load_state_dict(mm_projector_weights, strict=False)
         else:
             if 'mpt' in model_name.lower():
+                from llava.model.language_model.llava_mpt import LlavaMptForCausalLM
                 tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
                 model = LlavaMptForCausalLM.from_pretrained(model_path, low_cpu_mem_usage=True, **kwargs)
             elif 'mistral' in model_name.lower():
+                from llava.model.language_model.llava_mistral import LlavaMistralForCausalLM
                 tokenizer = AutoTokenizer.from_pretrained(model_path)
                 model = LlavaMistralForCausalLM.from_pretrained(
                     model_path,
@@ -130,6 +244,7 @@ def load_from_hf(repo_id, filename, subfolder=None):
                     **kwargs
                 )
             else:
+                from llava.model.language_model.llava_llama import LlavaLlamaForCausalLM
                 tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
                 model = LlavaLlamaForCausalLM.from_pretrained(
                     model_path,
@@ -158,6 +273,10 @@ def load_from_hf(repo_id, filename, subfolder=None):
                 tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
                 model = AutoModelForCausalLM.from_pretrained(model_path, low_cpu_mem_usage=True, **kwargs)
 
+    return _finalize_llava_model(tokenizer, model, model_name, device_map)
+
+
+def _finalize_llava_model(tokenizer, model, model_name, device_map):
     image_processor = None
 
     if 'llava' in model_name.lower():
@@ -173,7 +292,7 @@ def load_from_hf(repo_id, filename, subfolder=None):
         if not vision_tower.is_loaded:
             vision_tower.load_model(device_map=device_map)
         if device_map != 'auto':
-            vision_tower.to(device=device_map, dtype=torch.float16)
+            vision_tower.to(device=device_map, dtype=model.dtype)
         image_processor = vision_tower.image_processor
 
     if hasattr(model.config, "max_sequence_length"):
@@ -107,6 +107,7 @@ def generate(
         inputs: Optional[torch.Tensor] = None,
         images: Optional[torch.Tensor] = None,
         image_sizes: Optional[torch.Tensor] = None,
+        padding_side: Optional[str] = None,
         **kwargs,
     ) -> Union[GenerateOutput, torch.LongTensor]:
         position_ids = kwargs.pop("position_ids", None)
@@ -129,7 +130,8 @@ def generate(
                 None,
                 None,
                 images,
-                image_sizes=image_sizes
+                image_sizes=image_sizes,
+                padding_side=padding_side
             )
         else:
             inputs_embeds = self.get_model().embed_tokens(inputs)
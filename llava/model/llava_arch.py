@@ -142,14 +142,149 @@ def encode_images(self, images):
         image_features = self.get_model().mm_projector(image_features)
         return image_features
 
+    @staticmethod
+    def _launch_token_counts(input_ids, attention_mask):
+        """Start copying the per-sample (valid token, image token) counts to host memory."""
+        valid = attention_mask.bool() if attention_mask is not None else torch.ones_like(input_ids, dtype=torch.bool)
+        counts = torch.stack((valid.sum(1), ((input_ids == IMAGE_TOKEN_INDEX) & valid).sum(1)))
+        if counts.device.type != 'cuda':
+            return counts, None
+        host_counts = torch.empty(counts.shape, dtype=counts.dtype, pin_memory=True)
+        host_counts.copy_(counts, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record(torch.cuda.current_stream(counts.device))
+        return host_counts, event
+
+    def _splice_image_features(self, input_ids, attention_mask, labels, image_features, token_counts,
+                               padding_side=None):
+        """
+        Replace every image token with its image features, drop padding, truncate to
+        `tokenizer_model_max_length` and re-pad on `padding_side` (defaults to
+        `config.tokenizer_padding_side`).
+
+        Output positions come from a cumulative sum of per-token sizes (1 for text,
+        the feature length for image tokens) computed on the device. Text is embedded
+        with a single `embed_tokens` call, and text and image rows are placed with
+        `index_copy_`. Rows that are dropped (padding, truncation, and the dummy
+        image of a sample without image tokens) go to a spare column per sample
+        that is sliced off, so every shape is known up front and the only host
+        read is the counts from `_launch_token_counts`.
+        """
+        host_counts, event = token_counts
+        if event is not None:
+            event.synchronize()
+        num_tokens, num_images = host_counts.tolist()
+
+        if isinstance(image_features, torch.Tensor):
+            feature_lens = [image_features.shape[1]] * image_features.shape[0]
+            image_features = image_features.flatten(0, 1)
+        else:
+            feature_lens = [x.shape[0] for x in image_features]
+            image_features = torch.cat(list(image_features))
+
+        # Samples take image features in order. A sample without image tokens still
+        # takes one (the zero image the collator adds) and drops it.
+        batch_size, seq_len = input_ids.shape
+        image_start, image_sample, image_placed, out_lens = [], [], [], []
+        for b in range(batch_size):
+            k = num_images[b]
+            image_start.append(len(image_sample))
+            if len(image_sample) + k > len(feature_lens):
+                raise ValueError(f"Sample {b} has {k} image tokens but only {len(feature_lens) - len(image_sample)} images are left")
+            out_lens.append(num_tokens[b] - k + sum(feature_lens[len(image_sample):len(image_sample) + k]))
+            num_taken = min(max(k, 1), len(feature_lens) - len(image_sample))
+            image_sample.extend([b] * num_taken)
+            image_placed.extend([k > 0] * num_taken)
+        # Features nobody takes are dropped too.
+        num_untaken = len(feature_lens) - len(image_sample)
+        image_sample.extend([0] * num_untaken)
+        image_placed.extend([False] * num_untaken)
+
+        max_len = max(out_lens)
+        tokenizer_model_max_length = getattr(self.config, 'tokenizer_model_max_length', None)
+        if tokenizer_model_max_length is not None:
+            max_len = min(max_len, tokenizer_model_max_length)
+        out_lens = [min(x, max_len) for x in out_lens]
+
+        embed_tokens = self.get_model().embed_tokens
+        device = embed_tokens.weight.device
+
+        def to_device(values):
+            values = values if torch.is_tensor(values) else torch.tensor(values, dtype=torch.long)
+            if device.type == 'cuda':
+                values = values.pin_memory()
+            return values.to(device, non_blocking=True)
+
+        feature_lens_cpu = torch.tensor(feature_lens + [0], dtype=torch.long)
+        feature_offsets = torch.cumsum(feature_lens_cpu, 0) - feature_lens_cpu
+        num_rows = int(feature_offsets[-1])
+        row_image = torch.repeat_interleave(torch.arange(len(feature_lens) + 1), feature_lens_cpu)
+        row_local = torch.arange(num_rows) - feature_offsets[row_image]
+        image_sample_cpu = torch.tensor(image_sample + [0], dtype=torch.long)
+        image_placed_cpu = torch.tensor(image_placed + [False], dtype=torch.bool)
+
+        out_lens_d = to_device(out_lens)
+        feature_lens_d = to_device(feature_lens_cpu)
+        image_start_d = to_device(image_start)
+        row_image_d, row_local_d = to_device(row_image), to_device(row_local)
+        row_sample_d = to_device(image_sample_cpu[row_image])
+        row_placed_d = to_device(image_placed_cpu[row_image])
+
+        input_ids = input_ids.to(device)
+        valid = attention_mask.bool().to(device) if attention_mask is not None else torch.ones_like(input_ids, dtype=torch.bool)
+        is_image = (input_ids == IMAGE_TOKEN_INDEX) & valid
+        is_text = valid & ~is_image
+
+        # Global index of the image behind each image token; other tokens point at the empty sentinel.
+        image_idx = torch.where(is_image, torch.cumsum(is_image.long(), 1) - 1 + image_start_d[:, None], len(feature_lens))
+        sizes = torch.where(is_image, feature_lens_d[image_idx], is_text.long())
+        pos = torch.cumsum(sizes, 1) - sizes
+
+        left_padding = (padding_side or getattr(self.config, 'tokenizer_padding_side', 'right')) == "left"
+        stride = max_len + 1
+        shift = (max_len - out_lens_d) if left_padding else torch.zeros_like(out_lens_d)
+        row_base = torch.arange(batch_size, device=device) * stride
+        spare = row_base + max_len
+
+        text_dst = torch.where(is_text & (pos < out_lens_d[:, None]),
+                               row_base[:, None] + shift[:, None] + pos, spare[:, None]).flatten()
+        image_pos = torch.zeros(len(feature_lens) + 1, dtype=torch.long, device=device)
+        image_pos.scatter_(0, image_idx.flatten(), pos.flatten())
+        row_pos = image_pos[row_image_d] + row_local_d
+        image_dst = torch.where(row_placed_d & (row_pos < out_lens_d[row_sample_d]),
+                                row_base[row_sample_d] + shift[row_sample_d] + row_pos, spare[row_sample_d])
+
+        text_embeds = embed_tokens(torch.where(is_text, input_ids, 0)).flatten(0, 1)
+        new_input_embeds = text_embeds.new_zeros(batch_size * stride, text_embeds.shape[-1])
+        new_input_embeds.index_copy_(0, text_dst, text_embeds)
+        new_input_embeds.index_copy_(0, image_dst, image_features.to(device=device, dtype=text_embeds.dtype))
+        new_input_embeds = new_input_embeds.view(batch_size, stride, -1)[:, :max_len]
+
+        if labels is not None:
+            new_labels = torch.full((batch_size * stride,), IGNORE_INDEX, dtype=labels.dtype, device=device)
+            new_labels.index_copy_(0, text_dst, labels.to(device).flatten())
+            new_labels = new_labels.view(batch_size, stride)[:, :max_len]
+        else:
+            new_labels = None
+
+        ar = torch.arange(max_len, device=device)[None]
+        new_position_ids = ar - shift[:, None]
+        new_attention_mask = (new_position_ids >= 0) & (new_position_ids < out_lens_d[:, None])
+        new_position_ids = torch.where(new_attention_mask, new_position_ids, 0)
+        return new_input_embeds, new_labels, new_attention_mask, new_position_ids
+
     def prepare_inputs_labels_for_multimodal(
         self, input_ids, position_ids, attention_mask, past_key_values, labels,
-        images, image_sizes=None
+        images, image_sizes=None, padding_side=None
     ):
         vision_tower = self.get_vision_tower()
         if vision_tower is None or images is None or input_ids.shape[1] == 1:
             return input_ids, position_ids, attention_mask, past_key_values, None, labels
 
+        # Queued before the vision tower, so reading the counts later waits for
+        # this copy only and does not drain the GPU queue.
+        token_counts = self._launch_token_counts(input_ids, attention_mask)
+
         if type(images) is list or images.ndim == 5:
             if type(images) is list:
                 images = [x.unsqueeze(0) if x.ndim == 3 else x for x in images]
@@ -205,113 +340,14 @@ def prepare_inputs_labels_for_multimodal(
         if getattr(self.config, 'tune_mm_mlp_adapter', False) and getattr(self.config, 'mm_use_im_start_end', False):
             raise NotImplementedError
 
-        # Let's just add dummy tensors if they do not exist,
-        # it is a headache to deal with None all the time.
-        # But it is not ideal, and if you have a better idea,
-        # please open an issue / submit a PR, thanks.
         _labels = labels
         _position_ids = position_ids
         _attention_mask = attention_mask
-        if attention_mask is None:
-            attention_mask = torch.ones_like(input_ids, dtype=torch.bool)
-        else:
-            attention_mask = attention_mask.bool()
-        if position_ids is None:
-            position_ids = torch.arange(0, input_ids.shape[1], dtype=torch.long, device=input_ids.device)
-        if labels is None:
-            labels = torch.full_like(input_ids, IGNORE_INDEX)
-
-        # remove the padding using attention_mask -- FIXME
-        _input_ids = input_ids
-        input_ids = [cur_input_ids[cur_attention_mask] for cur_input_ids, cur_attention_mask in zip(input_ids, attention_mask)]
-        labels = [cur_labels[cur_attention_mask] for cur_labels, cur_attention_mask in zip(labels, attention_mask)]
-
-        new_input_embeds = []
-        new_labels = []
-        cur_image_idx = 0
-        for batch_idx, cur_input_ids in enumerate(input_ids):
-            num_images = (cur_input_ids == IMAGE_TOKEN_INDEX).sum()
-            if num_images == 0:
-                cur_image_features = image_features[cur_image_idx]
-                cur_input_embeds_1 = self.get_model().embed_tokens(cur_input_ids)
-                cur_input_embeds = torch.cat([cur_input_embeds_1, cur_image_features[0:0]], dim=0)
-                new_input_embeds.append(cur_input_embeds)
-                new_labels.append(labels[batch_idx])
-                cur_image_idx += 1
-                continue
-
-            image_token_indices = [-1] + torch.where(cur_input_ids == IMAGE_TOKEN_INDEX)[0].tolist() + [cur_input_ids.shape[0]]
-            cur_input_ids_noim = []
-            cur_labels = labels[batch_idx]
-            cur_labels_noim = []
-            for i in range(len(image_token_indices) - 1):
-                cur_input_ids_noim.append(cur_input_ids[image_token_indices[i]+1:image_token_indices[i+1]])
-                cur_labels_noim.append(cur_labels[image_token_indices[i]+1:image_token_indices[i+1]])
-            split_sizes = [x.shape[0] for x in cur_labels_noim]
-            cur_input_embeds = self.get_model().embed_tokens(torch.cat(cur_input_ids_noim))
-            cur_input_embeds_no_im = torch.split(cur_input_embeds, split_sizes, dim=0)
-            cur_new_input_embeds = []
-            cur_new_labels = []
-
-            for i in range(num_images + 1):
-                cur_new_input_embeds.append(cur_input_embeds_no_im[i])
-                cur_new_labels.append(cur_labels_noim[i])
-                if i < num_images:
-                    cur_image_features = image_features[cur_image_idx]
-                    cur_image_idx += 1
-                    cur_new_input_embeds.append(cur_image_features)
-                    cur_new_labels.append(torch.full((cur_image_features.shape[0],), IGNORE_INDEX, device=cur_labels.device, dtype=cur_labels.dtype))
-
-            cur_new_input_embeds = [x.to(self.device) for x in cur_new_input_embeds]
-
-            cur_new_input_embeds = torch.cat(cur_new_input_embeds)
-            cur_new_labels = torch.cat(cur_new_labels)
-
-            new_input_embeds.append(cur_new_input_embeds)
-            new_labels.append(cur_new_labels)
-
-        # Truncate sequences to max length as image embeddings can make the sequence longer
-        tokenizer_model_max_length = getattr(self.config, 'tokenizer_model_max_length', None)
-        if tokenizer_model_max_length is not None:
-            new_input_embeds = [x[:tokenizer_model_max_length] for x in new_input_embeds]
-            new_labels = [x[:tokenizer_model_max_length] for x in new_labels]
-
-        # Combine them
-        max_len = max(x.shape[0] for x in new_input_embeds)
-        batch_size = len(new_input_embeds)
-
-        new_input_embeds_padded = []
-        new_labels_padded = torch.full((batch_size, max_len), IGNORE_INDEX, dtype=new_labels[0].dtype, device=new_labels[0].device)
-        attention_mask = torch.zeros((batch_size, max_len), dtype=attention_mask.dtype, device=attention_mask.device)
-        position_ids = torch.zeros((batch_size, max_len), dtype=position_ids.dtype, device=position_ids.device)
-
-        for i, (cur_new_embed, cur_new_labels) in enumerate(zip(new_input_embeds, new_labels)):
-            cur_len = cur_new_embed.shape[0]
-            if getattr(self.config, 'tokenizer_padding_side', 'right') == "left":
-                new_input_embeds_padded.append(torch.cat((
-                    torch.zeros((max_len - cur_len, cur_new_embed.shape[1]), dtype=cur_new_embed.dtype, device=cur_new_embed.device),
-                    cur_new_embed
-                ), dim=0))
-                if cur_len > 0:
-                    new_labels_padded[i, -cur_len:] = cur_new_labels
-                    attention_mask[i, -cur_len:] = True
-                    position_ids[i, -cur_len:] = torch.arange(0, cur_len, dtype=position_ids.dtype, device=position_ids.device)
-            else:
-                new_input_embeds_padded.append(torch.cat((
-                    cur_new_embed,
-                    torch.zeros((max_len - cur_len, cur_new_embed.shape[1]), dtype=cur_new_embed.dtype, device=cur_new_embed.device)
-                ), dim=0))
-                if cur_len > 0:
-                    new_labels_padded[i, :cur_len] = cur_new_labels
-                    attention_mask[i, :cur_len] = True
-                    position_ids[i, :cur_len] = torch.arange(0, cur_len, dtype=position_ids.dtype, device=position_ids.device)
-
-        new_input_embeds = torch.stack(new_input_embeds_padded, dim=0)
+        new_input_embeds, new_labels, attention_mask, position_ids = self._splice_image_features(
+            input_ids, attention_mask, labels, image_features, token_counts, padding_side=padding_side)
 
         if _labels is None:
             new_labels = None
-        else:
-            new_labels = new_labels_padded
 
         if _attention_mask is None:
             attention_mask = None
@@ -320,6 +356,8 @@ def prepare_inputs_labels_for_multimodal(
 
         if _position_ids is None:
             position_ids = None
+        else:
+            position_ids = position_ids.to(dtype=_position_ids.dtype)
 
         return None, position_ids, attention_mask, past_key_values, new_input_embeds, new_labels
 
@@ -13,6 +13,7 @@ def __init__(self, vision_tower, args, delay_load=False):
         self.vision_tower_name = vision_tower
         self.select_layer = args.mm_vision_select_layer
         self.select_feature = getattr(args, 'mm_vision_select_feature', 'patch')
+        self.unfreeze_mm_vision_tower = getattr(args, 'unfreeze_mm_vision_tower', False)
 
         if not delay_load:
             self.load_model()
@@ -29,11 +30,32 @@ def load_model(self, device_map=None):
         self.image_processor = CLIPImageProcessor.from_pretrained(self.vision_tower_name)
         self.vision_tower = CLIPVisionModel.from_pretrained(self.vision_tower_name, device_map=device_map)
         self.vision_tower.requires_grad_(False)
+        self.setup_early_exit()
 
         self.is_loaded = True
 
-    def feature_select(self, image_forward_outs):
-        image_features = image_forward_outs.hidden_states[self.select_layer]
+    def setup_early_exit(self):
+        """
+        Resolve `select_layer` to the number of encoder layers that actually need to run.
+
+        `hidden_states[0]` is the embedding output and `hidden_states[i]` the output of
+        layer i, so only the first `num_select_layers` layers matter. When the tower
+        is frozen, the remaining layers and the unused post-layernorm are dropped and
+        `config.num_hidden_layers` is updated, so a saved tower reloads as the truncated
+        model; `num_select_layers` then selects its last layer.
+        """
+        encoder_layers = self.vision_tower.vision_model.encoder.layers
+        num_layers = len(encoder_layers)
+        self.num_select_layers = self.select_layer if self.select_layer >= 0 else num_layers + 1 + self.select_layer
+        if not 0 <= self.num_select_layers <= num_layers:
+            raise ValueError(f'Unexpected mm_vision_select_layer {self.select_layer} for a {num_layers}-layer vision tower')
+
+        if not self.unfreeze_mm_vision_tower:
+            self.vision_tower.vision_model.encoder.layers = encoder_layers[:self.num_select_layers]
+            self.vision_tower.vision_model.post_layernorm = nn.Identity()
+            self.vision_tower.config.num_hidden_layers = self.num_select_layers
+
+    def select_patch_features(self, image_features):
         if self.select_feature == 'patch':
             image_features = image_features[:, 1:]
         elif self.select_feature == 'cls_patch':
@@ -42,17 +64,24 @@ def feature_select(self, image_forward_outs):
             raise ValueError(f'Unexpected select feature: {self.select_feature}')
         return image_features
 
+    def forward_early_exit(self, images):
+        """Run the encoder only up to the selected layer and return its (feature-selected) output."""
+        vision_model = self.vision_tower.vision_model
+        hidden_states = vision_model.embeddings(images)
+        hidden_states = vision_model.pre_layrnorm(hidden_states)
+        for encoder_layer in vision_model.encoder.layers[:self.num_select_layers]:
+            hidden_states = encoder_layer(hidden_states, None, None)[0]
+        return self.select_patch_features(hidden_states)
+
     @torch.no_grad()
     def forward(self, images):
         if type(images) is list:
             image_features = []
             for image in images:
-                image_forward_out = self.vision_tower(image.to(device=self.device, dtype=self.dtype).unsqueeze(0), output_hidden_states=True)
-                image_feature = self.feature_select(image_forward_out).to(image.dtype)
+                image_feature = self.forward_early_exit(image.to(device=self.device, dtype=self.dtype).unsqueeze(0)).to(image.dtype)
                 image_features.append(image_feature)
         else:
-            image_forward_outs = self.vision_tower(images.to(device=self.device, dtype=self.dtype), output_hidden_states=True)
-            image_features = self.feature_select(image_forward_outs).to(images.dtype)
+            image_features = self.forward_early_exit(images.to(device=self.device, dtype=self.dtype)).to(images.dtype)
 
         return image_features
 
@@ -118,6 +147,7 @@ def load_model(self, device_map=None):
         self.image_processor = CLIPImageProcessor.from_pretrained(self.vision_tower_name)
         self.vision_tower = CLIPVisionModel.from_pretrained(self.vision_tower_name, device_map=device_map)
         self.vision_tower.requires_grad_(False)
+        self.setup_early_exit()
 
         self.image_processor.size['shortest_edge'] = self.s2_image_size
         self.image_processor.crop_size['height'] = self.image_processor.crop_size['width'] = self.s2_image_size
@@ -126,8 +156,7 @@ def load_model(self, device_map=None):
 
     @torch.no_grad()
     def forward_feature(self, images):
-        image_forward_outs = self.vision_tower(images.to(device=self.device, dtype=self.dtype), output_hidden_states=True)
-        image_features = self.feature_select(image_forward_outs).to(images.dtype)
+        image_features = self.forward_early_exit(images.to(device=self.device, dtype=self.dtype)).to(images.dtype)
         return image_features
 
     @torch.no_grad()
@@ -0,0 +1,209 @@
+"""
+Admission control for the model worker.
+
+Requests wait in a priority queue and are admitted while the prompt tokens of
+the running requests fit in a token budget. Requests whose deadline passes in
+the queue, or whose predicted wait already exceeds the queueing SLO or their
+deadline on arrival, are rejected instead of being served late.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class AdmissionRejected(Exception):
+    """Raised by `AdmissionController.acquire` when a request is shed. `reason` is `overloaded` or `deadline`."""
+
+    def __init__(self, reason, predicted_wait=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.predicted_wait = predicted_wait
+
+
+class Ticket:
+    __slots__ = ("cost", "priority", "deadline", "seq", "future", "enqueued", "admitted", "cancelled")
+
+    def __init__(self, cost, priority, deadline, seq, future):
+        self.cost = cost
+        self.priority = priority
+        self.deadline = deadline
+        self.seq = seq
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.admitted = None
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionController:
+    """
+    Priority queue in front of the model, bounded by in-flight prompt tokens.
+
+    Lower `priority` values are served first, FIFO within a priority. The head
+    of the queue is admitted once its prompt tokens fit in `max_inflight_tokens`
+    (a request larger than the whole budget runs alone) and fewer than
+    `max_concurrency` requests are running. Later requests never overtake a
+    head that does not fit, so large prompts are not starved.
+
+    The wait of a new request is predicted from the requests queued ahead of it
+    and a moving average of service time: every `max_inflight_tokens` tokens
+    ahead cost roughly one service time, and so does every `max_concurrency`
+    requests running or waiting ahead. The larger of the two is used.
+
+    `acquire` and `release` must be called from the event loop thread;
+    `queue_length` and `queue_state` may be read from any thread.
+    """
+
+    def __init__(self, max_inflight_tokens, max_concurrency=None, slo=None, ema_alpha=0.2):
+        if max_inflight_tokens <= 0:
+            raise ValueError(f"max_inflight_tokens must be positive, got {max_inflight_tokens}")
+        self.max_inflight_tokens = max_inflight_tokens
+        self.max_concurrency = max_concurrency
+        self.slo = slo
+        self.ema_alpha = ema_alpha
+
+        self.heap = []
+        self.seq = itertools.count()
+        self.running = 0
+        self.inflight_tokens = 0
+        self.waiting = 0
+        self.waiting_tokens = 0
+        self.service_time = None
+        self.num_rejected = {"overloaded": 0, "deadline": 0}
+
+    def _queued_ahead(self, priority):
+        """Number and prompt tokens of the waiting requests that are served before a new one at `priority`."""
+        ahead = [t.cost for t in self.heap if not t.cancelled and t.priority <= priority]
+        return len(ahead), sum(ahead)
+
+    def predicted_wait(self, cost=0, priority=0):
+        """Predicted queueing delay in seconds for a request of `cost` tokens arriving now."""
+        if self.service_time is None:
+            return 0.0
+        num_ahead, tokens_ahead = self._queued_ahead(priority)
+        overflow = self.inflight_tokens + tokens_ahead + cost - self.max_inflight_tokens
+        wait = max(overflow, 0) / self.max_inflight_tokens * self.service_time
+        if self.max_concurrency is not None:
+            # Slots free up one service time per wave of `max_concurrency` requests
+            waves = (self.running + num_ahead) // self.max_concurrency
+            wait = max(wait, waves * self.service_time)
+        return wait
+
+    def _fits(self, ticket):
+        if self.max_concurrency is not None and self.running >= self.max_concurrency:
+            return False
+        return self.running == 0 or self.inflight_tokens + ticket.cost <= self.max_inflight_tokens
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.heap:
+            head = self.heap[0]
+            if head.cancelled:
+                heapq.heappop(self.heap)
+                continue
+            if head.deadline is not None and head.deadline <= now:
+                heapq.heappop(self.heap)
+                self._drop(head)
+                head.future.set_exception(AdmissionRejected("deadline"))
+                continue
+            if not self._fits(head):
+                break
+            heapq.heappop(self.heap)
+            self.waiting -= 1
+            self.waiting_tokens -= head.cost
+            self.running += 1
+            self.inflight_tokens += head.cost
+            head.admitted = now
+            head.future.set_result(head)
+
+    def _drop(self, ticket):
+        ticket.cancelled = True
+        self.waiting -= 1
+        self.waiting_tokens -= ticket.cost
+        self.num_rejected["deadline"] += 1
+
+    async def acquire(self, cost, priority=0, deadline=None):
+        """
+        Wait until the request is admitted.
+
+        Args:
+            cost: Prompt tokens of the request, including image tokens.
+            priority: Lower is more urgent.
+            deadline: `time.monotonic()` value after which the request is no longer worth serving.
+
+        Returns:
+            Ticket: pass it to `release` when the request finishes.
+        """
+        predicted = self.predicted_wait(cost, priority)
+        budget = self.slo
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            budget = remaining if budget is None else min(budget, remaining)
+        if budget is not None and predicted > budget:
+            self.num_rejected["overloaded"] += 1
+            raise AdmissionRejected("overloaded", predicted)
+
+        ticket = Ticket(cost, priority, deadline, next(self.seq), asyncio.get_running_loop().create_future())
+        heapq.heappush(self.heap, ticket)
+        self.waiting += 1
+        self.waiting_tokens += cost
+        self._dispatch()
+
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            return await asyncio.wait_for(asyncio.shield(ticket.future), timeout)
+        except asyncio.TimeoutError:
+            if ticket.future.done() and not ticket.future.exception():
+                # admitted just as the deadline passed; give the slot back
+                self.release(ticket)
+            elif not ticket.future.done():
+                self._drop(ticket)
+                ticket.future.cancel()
+                self._dispatch()
+            raise AdmissionRejected("deadline")
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled() and ticket.future.exception() is None:
+                self.release(ticket)
+            elif not ticket.future.done():
+                ticket.cancelled = True
+                self.waiting -= 1
+                self.waiting_tokens -= ticket.cost
+                ticket.future.cancel()
+                self._dispatch()
+            raise
+
+    def release(self, ticket, update_service_time=True):
+        """
+        Give back the budget of an admitted request. Pass `update_service_time=False`
+        for work that is not an interactive request (e.g. a batch job), so it does
+        not skew the predicted waits.
+        """
+        self.running -= 1
+        self.inflight_tokens -= ticket.cost
+        if update_service_time:
+            elapsed = time.monotonic() - ticket.admitted
+            if self.service_time is None:
+                self.service_time = elapsed
+            else:
+                self.service_time += self.ema_alpha * (elapsed - self.service_time)
+        self._dispatch()
+
+    def queue_length(self):
+        """Requests running or waiting."""
+        return self.running + self.waiting
+
+    def queue_state(self):
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "inflight_tokens": self.inflight_tokens,
+            "waiting_tokens": self.waiting_tokens,
+            "max_inflight_tokens": self.max_inflight_tokens,
+            "max_concurrency": self.max_concurrency,
+            "service_time": self.service_time,
+            "predicted_wait": self.predicted_wait(),
+            "rejected": dict(self.num_rejected),
+        }
@@ -0,0 +1,405 @@
+"""
+Offline batch jobs for the model worker, in the style of the OpenAI Batch API.
+
+A batch is a JSONL file of image+prompt jobs, one per line. The worker runs
+them as large batched `generate` calls in the background, but only starts one
+while no interactive request is running or waiting. Each call holds a
+lowest-priority admission ticket whose token cost is capped below the budget,
+so chat requests that arrive meanwhile are still admitted and at most share
+the GPU with the call in progress.
+
+Every batch is persisted under `<storage_dir>/<batch_id>/`:
+    input.jsonl    the normalized jobs
+    output.jsonl   one line per finished job, appended after every call
+    errors.jsonl   one line per failed job
+    batch.json     the batch object returned by the API
+
+Jobs finish in input order, so a batch interrupted by a restart resumes after
+the jobs already recorded in `output.jsonl` and `errors.jsonl`.
+
+Input lines are `{"custom_id": ..., "body": {...}}`, or the body fields at the
+top level. Body fields:
+    prompt          the full prompt, as for `/worker_generate_stream`, or the
+                    user message if the batch sets `conv_mode`
+    images          base64 encoded images
+    image           image path(s) on the worker, relative to the batch `image_folder`
+    max_new_tokens, temperature, top_p, stop
+"""
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from llava.constants import DEFAULT_IMAGE_TOKEN
+from llava.conversation import conv_templates, SeparatorStyle
+from llava.serve.admission import AdmissionRejected
+
+
+logger = logging.getLogger(__name__)
+
+# Larger than any interactive priority, so batch calls are admitted last
+BATCH_PRIORITY = 1 << 30
+
+FINAL_STATUSES = ("completed", "failed", "cancelled")
+
+
+def parse_job(entry, index, conv_mode=None, image_folder=None, max_new_tokens=256, temperature=0.0):
+    """Validate one input line and return the job as stored in `input.jsonl`."""
+    if not isinstance(entry, dict):
+        raise ValueError("expected a JSON object")
+    body = entry.get("body", entry)
+    if not isinstance(body, dict):
+        raise ValueError("`body` must be an object")
+    prompt = body.get("prompt")
+    if not isinstance(prompt, str) or not prompt:
+        raise ValueError("missing `prompt`")
+
+    images = body.get("images") or []
+    image_files = body.get("image") or []
+    images = [images] if isinstance(images, str) else list(images)
+    image_files = [image_files] if isinstance(image_files, str) else list(image_files)
+    if image_folder is not None:
+        image_files = [os.path.join(image_folder, path) for path in image_files]
+    num_images = len(images) + len(image_files)
+
+    stop = body.get("stop")
+    if conv_mode is not None:
+        if num_images > 0 and DEFAULT_IMAGE_TOKEN not in prompt:
+            prompt = (DEFAULT_IMAGE_TOKEN + "\n") * num_images + prompt
+        conv = conv_templates[conv_mode].copy()
+        conv.append_message(conv.roles[0], prompt)
+        conv.append_message(conv.roles[1], None)
+        prompt = conv.get_prompt()
+        if stop is None:
+            stop = conv.sep if conv.sep_style in [SeparatorStyle.SINGLE, SeparatorStyle.MPT] else conv.sep2
+    if num_images != prompt.count(DEFAULT_IMAGE_TOKEN):
+        raise ValueError(f"{num_images} images but {prompt.count(DEFAULT_IMAGE_TOKEN)} {DEFAULT_IMAGE_TOKEN} tokens in the prompt")
+
+    return {
+        "custom_id": str(entry.get("custom_id", f"request-{index}")),
+        "prompt": prompt,
+        "images": images,
+        "image_files": image_files,
+        "max_new_tokens": min(int(body.get("max_new_tokens", max_new_tokens)), 1024),
+        "temperature": float(body.get("temperature", temperature)),
+        "top_p": float(body.get("top_p", 1.0)),
+        "stop": stop,
+    }
+
+
+def _write_json(path, obj):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp, path)
+
+
+def _count_lines(path):
+    """Complete lines in `path`, dropping a partial last line left by a crash."""
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    return data.count(b"\n", 0, end)
+
+
+class _Batch:
+    __slots__ = ("info", "dir", "offset", "pending", "running")
+
+    def __init__(self, info, batch_dir, offset=0):
+        self.info = info
+        self.dir = batch_dir
+        self.offset = offset
+        self.pending = None
+        self.running = False
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+
+class BatchJobManager:
+    """
+    Stores batches and runs their jobs through `run_jobs` when the worker is idle.
+
+    Args:
+        storage_dir: Directory for the batch files.
+        run_jobs: Blocking callable taking a list of jobs that share `temperature`
+            and `top_p` and returning one result per job: `{"text", "finish_reason",
+            "num_prompt_tokens", "num_generated_tokens"}`, or `{"error": message}`.
+        estimate_tokens: Prompt tokens of a job, including image tokens.
+        admission: The worker's `AdmissionController`.
+        max_batch_size: Jobs per `run_jobs` call.
+        max_batch_tokens: Bound on `jobs x (longest prompt + max_new_tokens)` per
+            call. Defaults to half the admission budget.
+        idle_interval: Seconds between checks while interactive requests are queued.
+
+    All methods except `run_jobs` must be called from the event loop thread.
+    """
+
+    def __init__(self, storage_dir, run_jobs, estimate_tokens, admission,
+                 max_batch_size=32, max_batch_tokens=None, idle_interval=0.25):
+        self.storage_dir = storage_dir
+        self.run_jobs = run_jobs
+        self.estimate_tokens = estimate_tokens
+        self.admission = admission
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens or admission.max_inflight_tokens // 2
+        self.idle_interval = idle_interval
+
+        self.batches = {}
+        self.wakeup = None
+        os.makedirs(storage_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        infos = []
+        for name in os.listdir(self.storage_dir):
+            info_file = os.path.join(self.storage_dir, name, "batch.json")
+            if os.path.exists(info_file):
+                with open(info_file) as f:
+                    infos.append((json.load(f), os.path.dirname(info_file)))
+        # Batches run in creation order
+        for info, batch_dir in sorted(infos, key=lambda x: x[0]["created_at"]):
+            batch = _Batch(info, batch_dir)
+            if info["status"] not in FINAL_STATUSES:
+                completed = _count_lines(batch.path("output.jsonl"))
+                failed = _count_lines(batch.path("errors.jsonl"))
+                info["request_counts"].update(completed=completed, failed=failed)
+                with open(batch.path("input.jsonl"), "rb") as f:
+                    for _ in range(completed + failed):
+                        f.readline()
+                    batch.offset = f.tell()
+                if info["status"] == "cancelling":
+                    self._set_status(batch, "cancelled")
+                else:
+                    logger.info(f"Resuming batch {info['id']} after {completed + failed} of "
+                                f"{info['request_counts']['total']} jobs")
+                    _write_json(batch.path("batch.json"), info)
+            self.batches[info["id"]] = batch
+
+    def _write_input(self, lines, options):
+        """Validate and store the jobs of a new batch. Blocking, runs in an executor."""
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        batch_dir = os.path.join(self.storage_dir, batch_id)
+        tmp_dir = batch_dir + ".tmp"
+        os.makedirs(tmp_dir)
+        try:
+            job_args = {k: options[k] for k in ("conv_mode", "image_folder", "max_new_tokens", "temperature")
+                        if options.get(k) is not None}
+            seen = set()
+            total = 0
+            with open(os.path.join(tmp_dir, "input.jsonl"), "w") as f:
+                for i, line in enumerate(lines):
+                    if isinstance(line, (str, bytes)):
+                        if not line.strip():
+                            continue
+                        try:
+                            line = json.loads(line)
+                        except json.JSONDecodeError as e:
+                            raise ValueError(f"line {i + 1}: {e}")
+                    try:
+                        job = parse_job(line, total, **job_args)
+                    except (ValueError, TypeError, KeyError) as e:
+                        raise ValueError(f"line {i + 1}: {e}")
+                    if job["custom_id"] in seen:
+                        raise ValueError(f"line {i + 1}: duplicate custom_id {job['custom_id']}")
+                    seen.add(job["custom_id"])
+                    f.write(json.dumps(job) + "\n")
+                    total += 1
+            if total == 0:
+                raise ValueError("no requests in the batch")
+
+            info = {
+                "id": batch_id,
+                "object": "batch",
+                "status": "in_progress",
+                "created_at": int(time.time()),
+                "in_progress_at": None,
+                "completed_at": None,
+                "cancelled_at": None,
+                "request_counts": {"total": total, "completed": 0, "failed": 0},
+                "output_file": os.path.join(batch_dir, "output.jsonl"),
+                "error_file": os.path.join(batch_dir, "errors.jsonl"),
+                "metadata": options.get("metadata"),
+            }
+            _write_json(os.path.join(tmp_dir, "batch.json"), info)
+            os.rename(tmp_dir, batch_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        return _Batch(info, batch_dir)
+
+    async def create(self, lines, options=None):
+        """
+        Store a new batch and queue its jobs.
+
+        Args:
+            lines: Iterable of JSONL lines or already parsed objects.
+            options: Batch settings `conv_mode`, `image_folder`, and defaults for
+                `max_new_tokens` and `temperature`, plus free-form `metadata`.
+
+        Raises:
+            ValueError: if a line is invalid; nothing is stored then.
+        """
+        batch = await asyncio.get_running_loop().run_in_executor(None, self._write_input, lines, options or {})
+        self.batches[batch.info["id"]] = batch
+        if self.wakeup is not None:
+            self.wakeup.set()
+        logger.info(f"Created batch {batch.info['id']} with {batch.info['request_counts']['total']} jobs")
+        return batch.info
+
+    def get(self, batch_id):
+        batch = self.batches.get(batch_id)
+        return batch.info if batch is not None else None
+
+    def list(self):
+        return [batch.info for batch in self.batches.values()]
+
+    def cancel(self, batch_id):
+        """Stop scheduling the jobs of a batch. A call already running finishes first."""
+        batch = self.batches.get(batch_id)
+        if batch is None:
+            return None
+        if batch.info["status"] == "in_progress":
+            self._set_status(batch, "cancelling" if batch.running else "cancelled")
+        return batch.info
+
+    def _set_status(self, batch, status):
+        batch.info["status"] = status
+        if status in ("completed", "cancelled"):
+            batch.info[f"{status}_at"] = int(time.time())
+        _write_json(batch.path("batch.json"), batch.info)
+
+    def _peek(self, batch):
+        """Next job of `batch` and its prompt tokens, without consuming it."""
+        if batch.pending is None:
+            with open(batch.path("input.jsonl"), "rb") as f:
+                f.seek(batch.offset)
+                line = f.readline()
+                offset = f.tell()
+            if not line:
+                return None
+            job = json.loads(line)
+            batch.pending = (job, self.estimate_tokens(job), offset)
+        return batch.pending
+
+    def _take_jobs(self, batch):
+        """
+        Consecutive jobs with the same sampling settings, up to `max_batch_size`
+        and `max_batch_tokens`. Returns the jobs and their padded prompt tokens.
+        """
+        jobs = []
+        longest_prompt = longest_total = 0
+        while len(jobs) < self.max_batch_size:
+            pending = self._peek(batch)
+            if pending is None:
+                break
+            job, num_tokens, offset = pending
+            if jobs:
+                if (job["temperature"], job["top_p"]) != (jobs[0]["temperature"], jobs[0]["top_p"]):
+                    break
+                total = max(longest_total, num_tokens + job["max_new_tokens"])
+                if (len(jobs) + 1) * total > self.max_batch_tokens:
+                    break
+            jobs.append(job)
+            longest_prompt = max(longest_prompt, num_tokens)
+            longest_total = max(longest_total, num_tokens + job["max_new_tokens"])
+            batch.pending = None
+            batch.offset = offset
+        return jobs, len(jobs) * longest_prompt
+
+    def _next_batch(self):
+        for batch in self.batches.values():
+            if batch.info["status"] == "in_progress":
+                return batch
+        return None
+
+    def _record(self, batch, jobs, results):
+        outputs, errors = [], []
+        for job, result in zip(jobs, results):
+            line = {"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": job["custom_id"]}
+            if result.get("error") is not None:
+                line.update(response=None, error={"message": result["error"]})
+                errors.append(json.dumps(line) + "\n")
+            else:
+                line.update(response={
+                    "text": result["text"],
+                    "finish_reason": result["finish_reason"],
+                    "usage": {"prompt_tokens": result["num_prompt_tokens"],
+                              "completion_tokens": result["num_generated_tokens"]},
+                }, error=None)
+                outputs.append(json.dumps(line) + "\n")
+        for name, lines in (("output.jsonl", outputs), ("errors.jsonl", errors)):
+            if lines:
+                with open(batch.path(name), "a") as f:
+                    f.write("".join(lines))
+        counts = batch.info["request_counts"]
+        counts["completed"] += len(outputs)
+        counts["failed"] += len(errors)
+
+        if batch.info["status"] == "cancelling":
+            self._set_status(batch, "cancelled")
+        elif counts["completed"] + counts["failed"] >= counts["total"]:
+            self._set_status(batch, "completed")
+            logger.info(f"Batch {batch.info['id']} completed: {counts}")
+        else:
+            _write_json(batch.path("batch.json"), batch.info)
+
+    async def run(self):
+        """Schedule batch jobs forever. Start it as a task on the worker's event loop."""
+        loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            if self.admission.queue_length() > 0:
+                # Interactive traffic first
+                await asyncio.sleep(self.idle_interval)
+                continue
+
+            offset, pending = batch.offset, batch.pending
+            try:
+                jobs, cost = self._take_jobs(batch)
+            except Exception as e:
+                logger.error(f"Failing batch {batch.info['id']}: cannot read its input: {e}")
+                batch.info["errors"] = {"message": str(e)}
+                self._set_status(batch, "failed")
+                continue
+            if not jobs:
+                self._set_status(batch, "completed")
+                continue
+
+            try:
+                # A call larger than the budget is admitted alone, like any request
+                ticket = await self.admission.acquire(min(cost, self.admission.max_inflight_tokens),
+                                                      priority=BATCH_PRIORITY)
+            except AdmissionRejected:
+                batch.offset, batch.pending = offset, pending
+                await asyncio.sleep(self.idle_interval)
+                continue
+            if batch.info["status"] != "in_progress":
+                # Cancelled while waiting for admission
+                self.admission.release(ticket, update_service_time=False)
+                continue
+
+            if batch.info["in_progress_at"] is None:
+                batch.info["in_progress_at"] = int(time.time())
+            batch.running = True
+            try:
+                results = await loop.run_in_executor(None, self.run_jobs, jobs)
+            except Exception as e:
+                logger.exception(f"Batch {batch.info['id']}: {len(jobs)} jobs failed")
+                results = [{"error": f"{type(e).__name__}: {e}"}] * len(jobs)
+            finally:
+                batch.running = False
+                self.admission.release(ticket, update_service_time=False)
+            self._record(batch, jobs, results)
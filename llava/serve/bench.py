@@ -0,0 +1,293 @@
+"""
+Load-test `/worker_generate_stream`, either on a model worker directly or
+relayed through the controller, and report throughput, latency percentiles
+and error rates as JSON.
+
+Requests come from a synthetic workload (prompt lengths, images per request
+and output lengths drawn from ranges) or from a JSONL trace. Arrivals follow a
+Poisson process at `--request-rate`, or the trace timestamps.
+
+Trace lines may contain `timestamp` (seconds since the start), `prompt` or
+`prompt_len` (words), `num_images` or `images` (image paths) and
+`max_new_tokens`; missing fields fall back to the synthetic settings.
+
+Example (CPU only, see `llava.serve.tiny_model`):
+    python -m llava.serve.tiny_model --output-dir ./checkpoints/llava-tiny-random
+    python -m llava.serve.controller --port 21001 &
+    python -m llava.serve.model_worker --model-path ./checkpoints/llava-tiny-random --device cpu &
+    python -m llava.serve.bench --controller-address http://localhost:21001 \\
+        --model-name llava-tiny-random --num-requests 50 --request-rate 2 --num-images 0-1 --output bench.json
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+from io import BytesIO
+
+import httpx
+from PIL import Image
+
+from llava.conversation import conv_templates, SeparatorStyle
+from llava.constants import DEFAULT_IMAGE_TOKEN
+
+
+_WORDS = (
+    "describe the image in detail what is shown here please explain how many people are there which color is "
+    "the car where was this picture taken is there anything unusual about this scene read the text in the sign"
+).split()
+
+
+def parse_range(value):
+    """`"8"` -> (8, 8), `"4-16"` -> (4, 16)."""
+    low, _, high = str(value).partition("-")
+    return int(low), int(high or low)
+
+
+def percentiles(values, ps=(50, 90, 95, 99)):
+    if not values:
+        return None
+    values = sorted(values)
+    result = {"mean": sum(values) / len(values), "min": values[0], "max": values[-1]}
+    for p in ps:
+        k = (len(values) - 1) * p / 100
+        lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+        result[f"p{p}"] = values[lo] + (values[hi] - values[lo]) * (k - lo)
+    return result
+
+
+def random_image_base64(rng, size):
+    num_bytes = size * size * 3
+    image = Image.frombytes("RGB", (size, size), rng.getrandbits(num_bytes * 8).to_bytes(num_bytes, "little"))
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
+def file_image_base64(path):
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode()
+
+
+def build_prompt(conv_mode, text, num_images):
+    conv = conv_templates[conv_mode].copy()
+    if num_images > 0:
+        text = (DEFAULT_IMAGE_TOKEN + "\n") * num_images + text
+    conv.append_message(conv.roles[0], text)
+    conv.append_message(conv.roles[1], None)
+    stop = conv.sep if conv.sep_style in [SeparatorStyle.SINGLE, SeparatorStyle.MPT] else conv.sep2
+    return conv.get_prompt(), stop
+
+
+def build_workload(args):
+    """
+    Returns:
+        list: (arrival offset in seconds, request payload) in arrival order.
+    """
+    rng = random.Random(args.seed)
+    image_pool = [random_image_base64(rng, args.image_size) for _ in range(args.image_pool_size)]
+
+    if args.trace is not None:
+        with open(args.trace) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        if args.num_requests is not None:
+            entries = entries[:args.num_requests]
+    else:
+        entries = [{} for _ in range(args.num_requests or 100)]
+
+    workload = []
+    t = 0.0
+    for entry in entries:
+        if "timestamp" in entry:
+            t = float(entry["timestamp"]) * args.time_scale
+        elif args.request_rate != float("inf"):
+            t += rng.expovariate(args.request_rate)
+
+        if "images" in entry:
+            image_files = entry["images"] if isinstance(entry["images"], list) else [entry["images"]]
+            images = [file_image_base64(path) for path in image_files]
+        else:
+            num_images = entry.get("num_images", rng.randint(*parse_range(args.num_images)))
+            images = [rng.choice(image_pool) for _ in range(num_images)]
+        text = entry.get("prompt")
+        if text is None:
+            prompt_len = entry.get("prompt_len", rng.randint(*parse_range(args.prompt_len)))
+            text = " ".join(rng.choice(_WORDS) for _ in range(prompt_len))
+        prompt, stop = build_prompt(args.conv_mode, text, len(images))
+
+        workload.append((t, {
+            "model": args.model_name,
+            "prompt": prompt,
+            "temperature": args.temperature,
+            "top_p": 1.0,
+            "max_new_tokens": int(entry.get("max_new_tokens", rng.randint(*parse_range(args.max_new_tokens)))),
+            "stop": stop,
+            "images": images,
+            "stream_format": args.stream_format,
+        }))
+    return workload
+
+
+async def send_request(client, url, payload, timeout):
+    record = {"num_images": len(payload["images"]), "max_new_tokens": payload["max_new_tokens"],
+              "prompt_chars": len(payload["prompt"]), "response_bytes": 0, "error": None}
+    start = time.perf_counter()
+    chunk_times = []
+    text = ""
+    delta_format = payload.get("stream_format") == "delta"
+    try:
+        async with client.stream("POST", url, json=payload, timeout=timeout) as response:
+            if response.status_code != 200:
+                record["error"] = f"http_{response.status_code}"
+                return record
+            buffer = b""
+            async for data in response.aiter_bytes():
+                record["response_bytes"] += len(data)
+                buffer += data
+                *chunks, buffer = buffer.split(b"\0")
+                for chunk in chunks:
+                    if not chunk:
+                        continue
+                    message = json.loads(chunk)
+                    if message.get("error_code", 0) != 0:
+                        record["error"] = f"error_code_{message['error_code']}"
+                        return record
+                    if message.get("done"):
+                        record["output_tokens"] = message["num_generated_tokens"]
+                        record["finish_reason"] = message["finish_reason"]
+                        continue
+                    chunk_times.append(time.perf_counter())
+                    text = text + message["delta"] if delta_format else message["text"]
+    except httpx.TimeoutException:
+        record["error"] = "timeout"
+        return record
+    except httpx.HTTPError as e:
+        record["error"] = type(e).__name__
+        return record
+    finally:
+        record["latency"] = time.perf_counter() - start
+
+    if delta_format:
+        record["output_text"] = text
+    else:
+        record["output_text"] = text[len(payload["prompt"]):] if text.startswith(payload["prompt"]) else text
+    record["num_chunks"] = len(chunk_times)
+    if chunk_times:
+        record["ttft"] = chunk_times[0] - start
+        record["chunk_gaps"] = [b - a for a, b in zip(chunk_times, chunk_times[1:])]
+        record["decode_time"] = chunk_times[-1] - chunk_times[0]
+    return record
+
+
+async def run_workload(args, workload):
+    url = (args.worker_address or args.controller_address).rstrip("/") + "/worker_generate_stream"
+    semaphore = asyncio.Semaphore(args.max_concurrency) if args.max_concurrency else None
+    limits = httpx.Limits(max_connections=args.max_concurrency or None, max_keepalive_connections=None)
+
+    async with httpx.AsyncClient(limits=limits) as client:
+        async def issue(offset, payload):
+            await asyncio.sleep(max(0.0, offset - (time.perf_counter() - start)))
+            if semaphore is None:
+                return await send_request(client, url, payload, args.timeout)
+            async with semaphore:
+                return await send_request(client, url, payload, args.timeout)
+
+        start = time.perf_counter()
+        records = await asyncio.gather(*[issue(offset, payload) for offset, payload in workload])
+        duration = time.perf_counter() - start
+    return records, duration
+
+
+def count_tokens(records, tokenizer_path):
+    """
+    Output tokens come from the worker's summary frame in the delta format.
+    Otherwise they are counted with the model's tokenizer, or one token per
+    streamed chunk without one.
+    """
+    pending = [r for r in records if "output_tokens" not in r]
+    if not pending:
+        return "worker"
+    if tokenizer_path is None:
+        for record in pending:
+            record["output_tokens"] = record.get("num_chunks", 0)
+        return "chunks"
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, use_fast=False)
+    for record in pending:
+        record["output_tokens"] = len(tokenizer(record.get("output_text", ""), add_special_tokens=False).input_ids)
+    return "tokenizer"
+
+
+def summarize(args, records, duration, token_count_method):
+    ok = [r for r in records if r["error"] is None]
+    errors = {}
+    for r in records:
+        if r["error"] is not None:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    output_tokens = sum(r["output_tokens"] for r in ok)
+    tpot = [r["decode_time"] / (r["output_tokens"] - 1) for r in ok if r["output_tokens"] > 1 and "decode_time" in r]
+    return {
+        "target": args.worker_address or args.controller_address,
+        "via": "worker" if args.worker_address else "controller",
+        "workload": args.trace or "synthetic",
+        "request_rate": args.request_rate,
+        "max_concurrency": args.max_concurrency,
+        "num_requests": len(records),
+        "completed": len(ok),
+        "errors": errors,
+        "error_rate": 1 - len(ok) / max(len(records), 1),
+        "duration_s": duration,
+        "request_throughput": len(ok) / duration,
+        "output_token_throughput": output_tokens / duration,
+        "output_tokens": output_tokens,
+        "output_tokens_counted_by": token_count_method,
+        "stream_format": args.stream_format,
+        "response_bytes_per_request": sum(r["response_bytes"] for r in ok) / max(len(ok), 1),
+        "ttft_s": percentiles([r["ttft"] for r in ok if "ttft" in r]),
+        "tpot_s": percentiles(tpot),
+        "inter_chunk_latency_s": percentiles([g for r in ok for g in r.get("chunk_gaps", [])]),
+        "e2e_latency_s": percentiles([r["latency"] for r in ok]),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--worker-address", type=str, help="send requests to this model worker directly")
+    target.add_argument("--controller-address", type=str, help="send requests through the controller")
+    parser.add_argument("--model-name", type=str, required=True)
+    parser.add_argument("--trace", type=str, default=None, help="JSONL workload trace")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="multiply trace timestamps by this factor")
+    parser.add_argument("--num-requests", type=int, default=None)
+    parser.add_argument("--request-rate", type=float, default=float("inf"),
+                        help="Poisson arrival rate in requests/s, inf sends everything at once")
+    parser.add_argument("--max-concurrency", type=int, default=None)
+    parser.add_argument("--prompt-len", type=str, default="16-64", help="prompt words, N or MIN-MAX")
+    parser.add_argument("--num-images", type=str, default="1", help="images per request, N or MIN-MAX")
+    parser.add_argument("--max-new-tokens", type=str, default="128", help="N or MIN-MAX")
+    parser.add_argument("--image-size", type=int, default=336)
+    parser.add_argument("--image-pool-size", type=int, default=8)
+    parser.add_argument("--conv-mode", type=str, default="llava_v1")
+    parser.add_argument("--stream-format", type=str, choices=["delta", "full"], default="delta")
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--tokenizer", type=str, default=None, help="model path used to count output tokens")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="write the JSON summary here")
+    parser.add_argument("--output-details", type=str, default=None, help="write per-request records as JSONL")
+    args = parser.parse_args()
+
+    workload = build_workload(args)
+    records, duration = asyncio.run(run_workload(args, workload))
+    token_count_method = count_tokens(records, args.tokenizer)
+    summary = summarize(args, records, duration, token_count_method)
+
+    print(json.dumps(summary, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+    if args.output_details is not None:
+        with open(args.output_details, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
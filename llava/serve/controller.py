@@ -6,6 +6,7 @@
 import asyncio
 import dataclasses
 from enum import Enum, auto
+import heapq
 import json
 import logging
 import time
@@ -14,15 +15,42 @@
 
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
-import numpy as np
+import httpx
 import requests
 import uvicorn
 
 from llava.constants import CONTROLLER_HEART_BEAT_EXPIRATION
-from llava.utils import build_logger, server_error_msg
+from llava.utils import build_logger, server_error_msg, RateLimitedLog
+from llava.serve.metrics import Registry, add_process_metrics, instrument_app
+from llava.serve.dispatch import LotteryDispatcher, ShortestQueueDispatcher
 
 
 logger = build_logger("controller", "controller.log")
+# Heart beats and dispatch decisions arrive on every request; log a sample of them
+heart_beat_log = RateLimitedLog(logger, interval=60.0)
+dispatch_log = RateLimitedLog(logger, interval=10.0)
+
+metrics = Registry("llava_controller")
+add_process_metrics(metrics)
+dispatch_total = metrics.counter("dispatch_total", "Worker address lookups by model and outcome.", ("model", "outcome"))
+heart_beats_total = metrics.counter("heart_beats_total", "Heart beats received by outcome.", ("outcome",))
+workers_gauge = metrics.gauge("workers", "Registered workers per model.", ("model",))
+worker_queue_length = metrics.gauge("worker_queue_length", "Queue length last reported by each worker.", ("worker",))
+relay_first_chunk_seconds = metrics.histogram(
+    "relay_time_to_first_chunk_seconds", "Time until the first streamed chunk when relaying /worker_generate_stream.")
+relay_errors_total = metrics.counter("relay_errors_total", "Relayed generation requests that failed.", ("reason",))
+
+
+@metrics.add_collector
+def collect_worker_state():
+    workers_gauge.clear()
+    worker_queue_length.clear()
+    if controller is None:
+        return
+    for model_name, workers in list(controller.model_workers.items()):
+        workers_gauge.set(len(workers), model=model_name)
+    for w_name, w_info in list(controller.worker_info.items()):
+        worker_queue_length.set(w_info.queue_length, worker=w_name)
 
 
 class DispatchMethod(Enum):
@@ -46,19 +74,29 @@ class WorkerInfo:
     queue_length: int
     check_heart_beat: bool
     last_heart_beat: str
+    # Admission queue details reported by the worker (running, waiting, tokens, predicted wait)
+    queue_state: dict = None
 
 
 def heart_beat_controller(controller):
     while True:
-        time.sleep(CONTROLLER_HEART_BEAT_EXPIRATION)
-        controller.remove_stable_workers_by_expiration()
+        time.sleep(controller.remove_expired_workers())
 
 
 class Controller:
-    def __init__(self, dispatch_method: str):
+    def __init__(self, dispatch_method: str, probe_concurrency: int = 128, probe_timeout: float = 5):
         # Dict[str -> WorkerInfo]
         self.worker_info = {}
+        # Dict[model name -> Dict[worker name -> None]], insertion ordered
+        self.model_workers = {}
+        # Dict[model name -> LotteryDispatcher | ShortestQueueDispatcher]
+        self.dispatchers = {}
+        # (expire time, worker name), one entry per worker that checks heart beats
+        self.expiry_heap = []
+        self.lock = threading.RLock()
         self.dispatch_method = DispatchMethod.from_str(dispatch_method)
+        self.probe_concurrency = probe_concurrency
+        self.probe_timeout = probe_timeout
 
         self.heart_beat_thread = threading.Thread(
             target=heart_beat_controller, args=(self,), daemon=True)
@@ -78,16 +116,71 @@ def register_worker(self, worker_name: str, check_heart_beat: bool,
         if not worker_status:
             return False
 
-        self.worker_info[worker_name] = WorkerInfo(
-            worker_status["model_names"], worker_status["speed"], worker_status["queue_length"],
-            check_heart_beat, time.time())
+        with self.lock:
+            w_info = self.worker_info.get(worker_name)
+            if w_info is None:
+                w_info = WorkerInfo([], worker_status["speed"], worker_status["queue_length"],
+                                    check_heart_beat, time.time())
+                self.worker_info[worker_name] = w_info
+                if check_heart_beat:
+                    heapq.heappush(self.expiry_heap, (w_info.last_heart_beat + CONTROLLER_HEART_BEAT_EXPIRATION, worker_name))
+            else:
+                if check_heart_beat and not w_info.check_heart_beat:
+                    heapq.heappush(self.expiry_heap, (time.time() + CONTROLLER_HEART_BEAT_EXPIRATION, worker_name))
+                w_info.check_heart_beat = check_heart_beat
+                w_info.last_heart_beat = time.time()
+            self.update_worker(worker_name, worker_status)
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
         return True
 
+    def update_worker(self, worker_name: str, worker_status: dict):
+        """Apply a status reported by a registered worker, touching only the index entries that changed."""
+        with self.lock:
+            w_info = self.worker_info[worker_name]
+            old_models = set(w_info.model_names)
+            new_models = set(worker_status["model_names"])
+            for model_name in old_models - new_models:
+                self._unindex(model_name, worker_name)
+            for model_name in new_models - old_models:
+                self.model_workers.setdefault(model_name, {})[worker_name] = None
+            w_info.model_names = list(worker_status["model_names"])
+            w_info.speed = worker_status["speed"]
+            w_info.queue_length = worker_status["queue_length"]
+            if worker_status.get("queue_state") is not None:
+                w_info.queue_state = worker_status["queue_state"]
+            self._update_dispatchers(worker_name, w_info)
+
+    def _new_dispatcher(self):
+        if self.dispatch_method == DispatchMethod.LOTTERY:
+            return LotteryDispatcher()
+        elif self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
+            return ShortestQueueDispatcher()
+        else:
+            raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
+
+    def _update_dispatchers(self, worker_name, w_info):
+        for model_name in w_info.model_names:
+            dispatcher = self.dispatchers.get(model_name)
+            if dispatcher is None:
+                dispatcher = self.dispatchers[model_name] = self._new_dispatcher()
+            dispatcher.update(worker_name, w_info.speed, w_info.queue_length)
+
+    def _unindex(self, model_name, worker_name):
+        workers = self.model_workers.get(model_name)
+        if workers is not None:
+            workers.pop(worker_name, None)
+            if not workers:
+                del self.model_workers[model_name]
+        dispatcher = self.dispatchers.get(model_name)
+        if dispatcher is not None:
+            dispatcher.remove(worker_name)
+            if len(dispatcher) == 0:
+                del self.dispatchers[model_name]
+
     def get_worker_status(self, worker_name: str):
         try:
-            r = requests.post(worker_name + "/worker_get_status", timeout=5)
+            r = requests.post(worker_name + "/worker_get_status", timeout=self.probe_timeout)
         except requests.exceptions.RequestException as e:
             logger.error(f"Get status fails: {worker_name}, {e}")
             return None
@@ -98,116 +191,148 @@ def get_worker_status(self, worker_name: str):
 
         return r.json()
 
-    def remove_worker(self, worker_name: str):
-        del self.worker_info[worker_name]
-
-    def refresh_all_workers(self):
-        old_info = dict(self.worker_info)
-        self.worker_info = {}
+    async def probe_workers(self, worker_names):
+        """
+        Fetch `/worker_get_status` from many workers concurrently.
+
+        Returns:
+            dict: worker name -> status, or None if the worker did not answer.
+        """
+        semaphore = asyncio.Semaphore(self.probe_concurrency)
+        limits = httpx.Limits(max_connections=self.probe_concurrency, max_keepalive_connections=self.probe_concurrency)
+
+        async with httpx.AsyncClient(timeout=self.probe_timeout, limits=limits) as client:
+            async def probe(worker_name):
+                async with semaphore:
+                    try:
+                        r = await client.post(worker_name + "/worker_get_status")
+                    except httpx.HTTPError as e:
+                        logger.error(f"Get status fails: {worker_name}, {e}")
+                        return None
+                if r.status_code != 200:
+                    logger.error(f"Get status fails: {worker_name}, {r}")
+                    return None
+                return r.json()
+
+            statuses = await asyncio.gather(*[probe(w_name) for w_name in worker_names])
+        return dict(zip(worker_names, statuses))
 
-        for w_name, w_info in old_info.items():
-            if not self.register_worker(w_name, w_info.check_heart_beat, None):
-                logger.info(f"Remove stale worker: {w_name}")
+    def remove_worker(self, worker_name: str):
+        with self.lock:
+            w_info = self.worker_info.pop(worker_name, None)
+            if w_info is None:
+                return
+            for model_name in w_info.model_names:
+                self._unindex(model_name, worker_name)
+
+    async def refresh_all_workers(self):
+        """Probe every worker concurrently, update the ones that answer and remove the rest."""
+        statuses = await self.probe_workers(list(self.worker_info))
+        with self.lock:
+            for w_name, status in statuses.items():
+                if w_name not in self.worker_info:
+                    continue
+                if status is None:
+                    logger.info(f"Remove stale worker: {w_name}")
+                    self.remove_worker(w_name)
+                else:
+                    self.update_worker(w_name, status)
+        return statuses
 
     def list_models(self):
-        model_names = set()
-
-        for w_name, w_info in self.worker_info.items():
-            model_names.update(w_info.model_names)
-
-        return list(model_names)
+        return list(self.model_workers)
 
     def get_worker_address(self, model_name: str):
-        if self.dispatch_method == DispatchMethod.LOTTERY:
-            worker_names = []
-            worker_speeds = []
-            for w_name, w_info in self.worker_info.items():
-                if model_name in w_info.model_names:
-                    worker_names.append(w_name)
-                    worker_speeds.append(w_info.speed)
-            worker_speeds = np.array(worker_speeds, dtype=np.float32)
-            norm = np.sum(worker_speeds)
-            if norm < 1e-4:
+        with self.lock:
+            dispatcher = self.dispatchers.get(model_name)
+            if dispatcher is None:
                 return ""
-            worker_speeds = worker_speeds / norm
-            if True:  # Directly return address
-                pt = np.random.choice(np.arange(len(worker_names)),
-                    p=worker_speeds)
-                worker_name = worker_names[pt]
-                return worker_name
-
-            # Check status before returning
-            while True:
-                pt = np.random.choice(np.arange(len(worker_names)),
-                    p=worker_speeds)
-                worker_name = worker_names[pt]
-
-                if self.get_worker_status(worker_name):
-                    break
-                else:
-                    self.remove_worker(worker_name)
-                    worker_speeds[pt] = 0
-                    norm = np.sum(worker_speeds)
-                    if norm < 1e-4:
-                        return ""
-                    worker_speeds = worker_speeds / norm
-                    continue
-            return worker_name
-        elif self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
-            worker_names = []
-            worker_qlen = []
-            for w_name, w_info in self.worker_info.items():
-                if model_name in w_info.model_names:
-                    worker_names.append(w_name)
-                    worker_qlen.append(w_info.queue_length / w_info.speed)
-            if len(worker_names) == 0:
-                return ""
-            min_index = np.argmin(worker_qlen)
-            w_name = worker_names[min_index]
-            self.worker_info[w_name].queue_length += 1
-            logger.info(f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}")
-            return w_name
-        else:
-            raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
-
-    def receive_heart_beat(self, worker_name: str, queue_length: int):
-        if worker_name not in self.worker_info:
+            w_name = dispatcher.pick()
+            if w_name and self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
+                # Count the request until the worker's next heart beat reports it
+                self.worker_info[w_name].queue_length += 1
+        if w_name:
+            dispatch_log(model_name, f"model: {model_name}, workers: {len(dispatcher)}, ret: {w_name}",
+                         model=model_name, worker=w_name)
+        return w_name
+
+    def receive_heart_beat(self, worker_name: str, queue_length: int, queue_state: dict = None):
+        w_info = self.worker_info.get(worker_name)
+        if w_info is None:
             logger.info(f"Receive unknown heart beat. {worker_name}")
+            heart_beats_total.inc(outcome="unknown")
             return False
 
-        self.worker_info[worker_name].queue_length = queue_length
-        self.worker_info[worker_name].last_heart_beat = time.time()
-        logger.info(f"Receive heart beat. {worker_name}")
+        with self.lock:
+            w_info.queue_length = queue_length
+            if queue_state is not None:
+                w_info.queue_state = queue_state
+            if self.dispatch_method == DispatchMethod.SHORTEST_QUEUE and worker_name in self.worker_info:
+                self._update_dispatchers(worker_name, w_info)
+        # The expiry heap entry is not touched; it is pushed back when it comes up
+        w_info.last_heart_beat = time.time()
+        heart_beats_total.inc(outcome="ok")
+        heart_beat_log(worker_name, f"Receive heart beat. {worker_name}",
+                       worker=worker_name, queue_length=queue_length)
         return True
 
-    def remove_stable_workers_by_expiration(self):
-        expire = time.time() - CONTROLLER_HEART_BEAT_EXPIRATION
-        to_delete = []
-        for worker_name, w_info in self.worker_info.items():
-            if w_info.check_heart_beat and w_info.last_heart_beat < expire:
-                to_delete.append(worker_name)
-
-        for worker_name in to_delete:
-            self.remove_worker(worker_name)
+    def remove_expired_workers(self):
+        """
+        Remove workers whose last heart beat is older than the expiration.
+
+        Only heap entries that are due are examined. An entry whose worker has
+        sent a heart beat since it was pushed is pushed again with the new
+        expiry time.
+
+        Returns:
+            float: seconds until the next entry is due.
+        """
+        now = time.time()
+        with self.lock:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                _, worker_name = heapq.heappop(self.expiry_heap)
+                w_info = self.worker_info.get(worker_name)
+                if w_info is None or not w_info.check_heart_beat:
+                    continue
+                expire_at = w_info.last_heart_beat + CONTROLLER_HEART_BEAT_EXPIRATION
+                if expire_at <= now:
+                    logger.info(f"Remove expired worker: {worker_name}")
+                    self.remove_worker(worker_name)
+                else:
+                    heapq.heappush(self.expiry_heap, (expire_at, worker_name))
+            if not self.expiry_heap:
+                return CONTROLLER_HEART_BEAT_EXPIRATION
+            return min(CONTROLLER_HEART_BEAT_EXPIRATION, max(0.01, self.expiry_heap[0][0] - now))
 
     def worker_api_generate_stream(self, params):
+        start = time.perf_counter()
         worker_addr = self.get_worker_address(params["model"])
+        dispatch_total.inc(model=params["model"], outcome="ok" if worker_addr else "no_worker")
         if not worker_addr:
             logger.info(f"no worker: {params['model']}")
+            relay_errors_total.inc(reason="no_worker")
             ret = {
                 "text": server_error_msg,
                 "error_code": 2,
             }
             yield json.dumps(ret).encode() + b"\0"
+            return
 
         try:
             response = requests.post(worker_addr + "/worker_generate_stream",
                 json=params, stream=True, timeout=5)
-            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+            # Relay the bytes as they arrive without splitting or parsing frames,
+            # so both the full and the delta stream formats pass through unchanged
+            first_chunk = True
+            for chunk in response.iter_content(chunk_size=None):
                 if chunk:
-                    yield chunk + b"\0"
+                    if first_chunk:
+                        relay_first_chunk_seconds.observe(time.perf_counter() - start)
+                        first_chunk = False
+                    yield chunk
         except requests.exceptions.RequestException as e:
             logger.info(f"worker timeout: {worker_addr}")
+            relay_errors_total.inc(reason="worker_timeout")
             ret = {
                 "text": server_error_msg,
                 "error_code": 3,
@@ -217,13 +342,13 @@ def worker_api_generate_stream(self, params):
 
     # Let the controller act as a worker to achieve hierarchical
     # management. This can be used to connect isolated sub networks.
-    def worker_api_get_status(self):
+    async def worker_api_get_status(self):
         model_names = set()
         speed = 0
         queue_length = 0
 
-        for w_name in self.worker_info:
-            worker_status = self.get_worker_status(w_name)
+        statuses = await self.probe_workers(list(self.worker_info))
+        for worker_status in statuses.values():
             if worker_status is not None:
                 model_names.update(worker_status["model_names"])
                 speed += worker_status["speed"]
@@ -237,19 +362,25 @@ def worker_api_get_status(self):
 
 
 app = FastAPI()
+instrument_app(app, metrics)
+controller = None
 
 
 @app.post("/register_worker")
 async def register_worker(request: Request):
     data = await request.json()
+    worker_status = data.get("worker_status", None)
+    if not worker_status:
+        worker_status = (await controller.probe_workers([data["worker_name"]]))[data["worker_name"]]
+        if not worker_status:
+            return
     controller.register_worker(
-        data["worker_name"], data["check_heart_beat"],
-        data.get("worker_status", None))
+        data["worker_name"], data["check_heart_beat"], worker_status)
 
 
 @app.post("/refresh_all_workers")
 async def refresh_all_workers():
-    models = controller.refresh_all_workers()
+    await controller.refresh_all_workers()
 
 
 @app.post("/list_models")
@@ -262,6 +393,7 @@ async def list_models():
 async def get_worker_address(request: Request):
     data = await request.json()
     addr = controller.get_worker_address(data["model"])
+    dispatch_total.inc(model=data["model"], outcome="ok" if addr else "no_worker")
     return {"address": addr}
 
 
@@ -269,7 +401,7 @@ async def get_worker_address(request: Request):
 async def receive_heart_beat(request: Request):
     data = await request.json()
     exist = controller.receive_heart_beat(
-        data["worker_name"], data["queue_length"])
+        data["worker_name"], data["queue_length"], data.get("queue_state"))
     return {"exist": exist}
 
 
@@ -280,9 +412,15 @@ async def worker_api_generate_stream(request: Request):
     return StreamingResponse(generator)
 
 
+@app.post("/list_worker_queues")
+async def list_worker_queues():
+    return {w_name: {"queue_length": w_info.queue_length, "queue_state": w_info.queue_state}
+            for w_name, w_info in controller.worker_info.items()}
+
+
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
-    return controller.worker_api_get_status()
+    return await controller.worker_api_get_status()
 
 
 if __name__ == "__main__":
@@ -291,8 +429,10 @@ async def worker_api_get_status(request: Request):
     parser.add_argument("--port", type=int, default=21001)
     parser.add_argument("--dispatch-method", type=str, choices=[
         "lottery", "shortest_queue"], default="shortest_queue")
+    parser.add_argument("--probe-concurrency", type=int, default=128,
+        help="Workers probed at once by refresh_all_workers and worker_get_status.")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
-    controller = Controller(args.dispatch_method)
+    controller = Controller(args.dispatch_method, probe_concurrency=args.probe_concurrency)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -0,0 +1,153 @@
+"""
+Per-model dispatch structures for the controller.
+
+Each model keeps one structure over its workers, updated when a worker
+registers, reports a heart beat or is removed, so choosing a worker for a
+request is O(log n) and does not rebuild anything.
+"""
+import heapq
+import itertools
+import random
+
+
+class FenwickTree:
+    """Prefix sums over `size` non-negative weights, with O(log n) point updates and weighted search."""
+
+    def __init__(self, size=0):
+        self.size = size
+        self.tree = [0.0] * (size + 1)
+        self.weights = [0.0] * size
+
+    def grow(self, size):
+        """Extend to `size` slots with zero weight, rebuilding the tree in O(n)."""
+        self.weights.extend([0.0] * (size - self.size))
+        self.size = size
+        self.tree = [0.0] + list(self.weights)
+        for i in range(1, size + 1):
+            j = i + (i & -i)
+            if j <= size:
+                self.tree[j] += self.tree[i]
+
+    def update(self, index, weight):
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def total(self):
+        total, i = 0.0, self.size
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, value):
+        """Smallest index whose prefix sum (inclusive) exceeds `value`."""
+        pos = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and self.tree[nxt] <= value:
+                pos = nxt
+                value -= self.tree[nxt]
+            step >>= 1
+        return min(pos, self.size - 1)
+
+
+class LotteryDispatcher:
+    """Pick a worker with probability proportional to its speed."""
+
+    def __init__(self, rng=None):
+        self.rng = rng or random.Random()
+        self.tree = FenwickTree()
+        self.slots = {}
+        self.names = []
+        self.free = []
+
+    def __len__(self):
+        return len(self.slots)
+
+    def update(self, worker_name, speed, queue_length=None):
+        slot = self.slots.get(worker_name)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+                self.names[slot] = worker_name
+            else:
+                slot = len(self.names)
+                self.names.append(worker_name)
+                if slot >= self.tree.size:
+                    self.tree.grow(max(8, 2 * self.tree.size))
+            self.slots[worker_name] = slot
+        self.tree.update(slot, max(float(speed), 0.0))
+
+    def remove(self, worker_name):
+        slot = self.slots.pop(worker_name, None)
+        if slot is not None:
+            self.tree.update(slot, 0.0)
+            self.names[slot] = None
+            self.free.append(slot)
+
+    def pick(self):
+        total = self.tree.total()
+        if total < 1e-4:
+            return ""
+        return self.names[self.tree.find(self.rng.random() * total)]
+
+
+class ShortestQueueDispatcher:
+    """
+    Pick the worker with the smallest `queue_length / speed` and count the
+    request against it until its next heart beat.
+
+    The heap holds (score, tiebreak, version, worker) entries. Updates push a
+    new entry and bump the worker's version, so outdated entries are skipped
+    when they reach the top, and the heap is rebuilt once stale entries
+    outnumber live ones.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.workers = {}
+        self.order = itertools.count()
+        self.version = itertools.count()
+
+    def __len__(self):
+        return len(self.workers)
+
+    def _push(self, worker_name, state):
+        state["version"] = next(self.version)
+        heapq.heappush(self.heap, (state["queue_length"] / state["speed"], state["order"], state["version"], worker_name))
+        if len(self.heap) > 2 * len(self.workers) + 64:
+            self._rebuild()
+
+    def _rebuild(self):
+        self.heap = [(s["queue_length"] / s["speed"], s["order"], s["version"], name) for name, s in self.workers.items()]
+        heapq.heapify(self.heap)
+
+    def update(self, worker_name, speed, queue_length):
+        state = self.workers.get(worker_name)
+        if state is None:
+            state = self.workers[worker_name] = {"order": next(self.order)}
+        state["speed"] = speed if speed > 0 else 1e-6
+        state["queue_length"] = queue_length
+        self._push(worker_name, state)
+
+    def remove(self, worker_name):
+        # Its heap entries are skipped lazily
+        self.workers.pop(worker_name, None)
+
+    def pick(self):
+        while self.heap:
+            _, _, version, worker_name = self.heap[0]
+            state = self.workers.get(worker_name)
+            if state is None or state["version"] != version:
+                heapq.heappop(self.heap)
+                continue
+            heapq.heappop(self.heap)
+            state["queue_length"] += 1
+            self._push(worker_name, state)
+            return worker_name
+        return ""
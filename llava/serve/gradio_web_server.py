@@ -236,6 +236,8 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request:
         "max_new_tokens": min(int(max_new_tokens), 1536),
         "stop": state.sep if state.sep_style in [SeparatorStyle.SINGLE, SeparatorStyle.MPT] else state.sep2,
         "images": f'List of {len(state.get_images())} images: {all_image_hash}',
+        # Ask for new text only instead of the whole conversation in every frame
+        "stream_format": "delta",
     }
     logger.info(f"==== request ====\n{pload}")
 
@@ -248,11 +250,20 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request:
         # Stream output
         response = requests.post(worker_addr + "/worker_generate_stream",
             headers=headers, json=pload, stream=True, timeout=10)
+        output = ""
+        generated = ""
         for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
             if chunk:
                 data = json.loads(chunk.decode())
                 if data["error_code"] == 0:
-                    output = data["text"][len(prompt):].strip()
+                    if data.get("done"):
+                        break
+                    if "delta" in data:
+                        generated += data["delta"]
+                    else:
+                        # Workers that predate the delta format send the full text
+                        generated = data["text"][len(prompt):]
+                    output = generated.strip()
                     state.messages[-1][-1] = output + "▌"
                     yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
                 else:
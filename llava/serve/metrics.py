@@ -0,0 +1,223 @@
+"""
+In-process metrics for the serving components, exposed at `/metrics` in the
+Prometheus text format.
+
+Counters, gauges and histograms are plain Python numbers behind a lock, so
+recording a value costs a dict lookup and an addition.
+"""
+import bisect
+import os
+import resource
+import sys
+import threading
+import time
+
+from fastapi import Request
+from fastapi.responses import Response
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from sub-millisecond steps up to long generations
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5,
+                   0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 7.5, 10.0, 20.0, 30.0, 60.0)
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 50, 75, 100, 150, 200, 300, 500)
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    render = Counter.render
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        self.observe_many((value,), **labels)
+
+    def observe_many(self, values, **labels):
+        """Record several observations under one lock acquisition, e.g. every inter-token gap of a request."""
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # per-bucket counts (the last one is +Inf), sum, count
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts = state[0]
+            for value in values:
+                counts[bisect.bisect_left(self.buckets, value)] += 1
+                state[1] += value
+                state[2] += 1
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            items = [(key, list(state[0]), state[1], state[2]) for key, state in self.values.items()]
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = _format_labels(self.labelnames, key, [("le", _format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(float(total))}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """A set of metrics plus callbacks that refresh gauges when `/metrics` is scraped."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.metrics = []
+        self.collectors = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(f"{self.prefix}_{name}", documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Gauge(f"{self.prefix}_{name}", documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(f"{self.prefix}_{name}", documentation, labelnames, buckets))
+
+    def add_collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        for fn in self.collectors:
+            fn()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def add_process_metrics(registry):
+    """CPU resident memory of this process and, if torch has been loaded, CUDA memory per device."""
+    cpu_rss = registry.gauge("process_resident_memory_bytes", "Resident memory of the process.")
+    cpu_peak = registry.gauge("process_peak_resident_memory_bytes", "Peak resident memory of the process.")
+    gpu_memory = registry.gauge("gpu_memory_bytes", "CUDA memory held by the process.", ("device", "kind"))
+    page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    @registry.add_collector
+    def collect():
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        cpu_peak.set(peak if sys.platform == "darwin" else peak * 1024)
+        try:
+            with open("/proc/self/statm") as f:
+                cpu_rss.set(int(f.read().split()[1]) * page_size)
+        except OSError:
+            cpu_rss.set(peak if sys.platform == "darwin" else peak * 1024)
+
+        # Never import torch from here, the controller does not need it
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+            for i in range(torch.cuda.device_count()):
+                gpu_memory.set(torch.cuda.memory_allocated(i), device=str(i), kind="allocated")
+                gpu_memory.set(torch.cuda.memory_reserved(i), device=str(i), kind="reserved")
+                gpu_memory.set(torch.cuda.max_memory_allocated(i), device=str(i), kind="peak_allocated")
+
+
+def instrument_app(app, registry):
+    """Count requests per endpoint and status, time them up to the response headers, and serve `/metrics`."""
+    requests_total = registry.counter("http_requests_total", "HTTP requests handled.", ("path", "status"))
+    request_seconds = registry.histogram(
+        "http_request_duration_seconds", "Time until the response headers are sent.", ("path",))
+
+    @app.middleware("http")
+    async def record_request(request: Request, call_next):
+        path = request.url.path
+        if path == "/metrics":
+            return await call_next(request)
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            request_seconds.observe(time.perf_counter() - start, path=path)
+            requests_total.inc(path=path, status=str(status))
+
+    @app.get("/metrics")
+    async def metrics():
+        return Response(registry.render(), media_type=CONTENT_TYPE)
+
+    return app
@@ -4,20 +4,25 @@
 import argparse
 import asyncio
 import json
+import os
 import time
 import threading
 import uuid
 
 from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from PIL import Image
 import requests
 import torch
 import uvicorn
 from functools import partial
 
-from llava.constants import WORKER_HEART_BEAT_INTERVAL
-from llava.utils import (build_logger, server_error_msg,
-    pretty_print_semaphore)
+from llava.constants import LOGDIR, WORKER_HEART_BEAT_INTERVAL
+from llava.utils import build_logger, server_error_msg
+from llava.serve.admission import AdmissionController, AdmissionRejected
+from llava.serve.batch_jobs import BatchJobManager
+from llava.serve.metrics import (Registry, add_process_metrics, instrument_app,
+    THROUGHPUT_BUCKETS)
 from llava.model.builder import load_pretrained_model
 from llava.mm_utils import process_images, load_image_from_base64, tokenizer_image_token
 from llava.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
@@ -31,7 +36,178 @@
 logger = build_logger("model_worker", f"model_worker_{worker_id}.log")
 global_counter = 0
 
-model_semaphore = None
+metrics = Registry("llava_worker")
+add_process_metrics(metrics)
+requests_total = metrics.counter("requests_total", "Generation requests by outcome.", ("outcome",))
+prompt_tokens_total = metrics.counter("prompt_tokens_total", "Prompt tokens processed, including image tokens.")
+generated_tokens_total = metrics.counter("generated_tokens_total", "Tokens generated.")
+queue_length_gauge = metrics.gauge("queue_length", "Requests running or waiting for the model.")
+admission_wait_seconds = metrics.histogram("admission_wait_seconds", "Time from arrival until admitted to the model.")
+inflight_prompt_tokens = metrics.gauge("inflight_prompt_tokens", "Prompt tokens of the running requests.")
+waiting_prompt_tokens = metrics.gauge("waiting_prompt_tokens", "Prompt tokens of the queued requests.")
+predicted_wait_seconds = metrics.gauge("predicted_wait_seconds", "Predicted queueing delay for a new request.")
+time_to_first_token_seconds = metrics.histogram(
+    "time_to_first_token_seconds", "Time from request arrival to the first generated token.")
+inter_token_latency_seconds = metrics.histogram(
+    "inter_token_latency_seconds", "Time between consecutive generated tokens.")
+tokens_per_second = metrics.histogram(
+    "tokens_per_second", "Decode throughput of each request.", buckets=THROUGHPUT_BUCKETS)
+image_preprocess_seconds = metrics.histogram(
+    "image_preprocess_seconds", "Image decoding, preprocessing and host-to-device copy per request.")
+vision_encode_seconds = metrics.histogram("vision_encode_seconds", "Vision tower forward time per request.")
+prefill_seconds = metrics.histogram("prefill_seconds", "Prompt prefill time per request, excluding the vision tower.")
+decode_seconds = metrics.histogram("decode_seconds", "Time from the first to the last generated token.")
+batch_jobs_total = metrics.counter("batch_jobs_total", "Offline batch jobs by outcome.", ("outcome",))
+batch_size = metrics.histogram(
+    "batch_size", "Batch jobs per batched generate call.", buckets=THROUGHPUT_BUCKETS)
+batch_generate_seconds = metrics.histogram("batch_generate_seconds", "Time per batched generate call.")
+
+
+@metrics.add_collector
+def collect_queue_length():
+    if worker is not None:
+        state = worker.get_queue_state()
+        queue_length_gauge.set(state["running"] + state["waiting"])
+        inflight_prompt_tokens.set(state["inflight_tokens"])
+        waiting_prompt_tokens.set(state["waiting_tokens"])
+        predicted_wait_seconds.set(state["predicted_wait"])
+
+
+class TimedTextIteratorStreamer(TextIteratorStreamer):
+    """
+    `TextIteratorStreamer` that also records the id and arrival time of each
+    generated token. Iterating yields `(text, num_tokens)`, where `num_tokens`
+    is how many tokens had been generated when `text` was decoded.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_ids = []
+        self.token_times = []
+
+    def put(self, value):
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            self.token_ids.extend(value.reshape(-1).tolist())
+            self.token_times.append(time.perf_counter())
+        super().put(value)
+
+    def on_finalized_text(self, text, stream_end=False):
+        self.text_queue.put((text, len(self.token_ids)), timeout=self.timeout)
+        if stream_end:
+            self.text_queue.put(self.stop_signal, timeout=self.timeout)
+
+
+def _stop_prefix_length(text, stop_str):
+    """Length of the longest suffix of `text` that is a proper prefix of `stop_str`."""
+    for k in range(min(len(stop_str) - 1, len(text)), 0, -1):
+        if text.endswith(stop_str[:k]):
+            return k
+    return 0
+
+
+def stream_deltas(streamer, stop_str, num_prompt_tokens, max_new_tokens):
+    """
+    Frames of the `delta` stream format.
+
+    Each frame carries only the new text (`delta`), its character `offset` in
+    the generated text (the prompt is not repeated), and the ids of the tokens
+    generated since the previous frame starting at `token_offset`. Text that
+    may be the beginning of `stop_str` is held back until it is resolved. The
+    last frame has `done: true`, the finish reason and token counts.
+    """
+    text = ""
+    emitted = 0
+    sent_tokens = 0
+    stopped = False
+    stop_tokens = 0
+    for new_text, num_tokens in streamer:
+        if stopped:
+            # Keep draining so the generation thread can finish
+            continue
+        text += new_text
+        end = len(text)
+        if stop_str:
+            index = text.find(stop_str, emitted)
+            if index >= 0:
+                text = text[:index]
+                end = index
+                stopped = True
+                # Tokens generated after the stop string are not part of the output
+                stop_tokens = num_tokens
+            else:
+                end -= _stop_prefix_length(text, stop_str)
+        if end > emitted:
+            yield {"delta": text[emitted:end], "offset": emitted,
+                   "token_ids": streamer.token_ids[sent_tokens:num_tokens], "token_offset": sent_tokens,
+                   "error_code": 0}
+            emitted, sent_tokens = end, num_tokens
+
+    num_generated = stop_tokens if stopped else len(streamer.token_ids)
+    if emitted < len(text) or sent_tokens < num_generated:
+        yield {"delta": text[emitted:], "offset": emitted,
+               "token_ids": streamer.token_ids[sent_tokens:num_generated], "token_offset": sent_tokens,
+               "error_code": 0}
+    if stopped:
+        finish_reason = "stop"
+    elif num_generated >= max_new_tokens:
+        finish_reason = "length"
+    else:
+        finish_reason = "eos"
+    yield {"done": True, "finish_reason": finish_reason, "text_length": len(text),
+           "num_prompt_tokens": num_prompt_tokens, "num_generated_tokens": num_generated,
+           "error_code": 0}
+
+
+class VisionEncodeTimer:
+    """
+    Times the vision tower forward that runs inside `model.generate`.
+
+    Each request generates in its own thread, so spans are collected in a
+    thread-local list. On CUDA the spans are events, which are only read after
+    the request has finished and never stall generation.
+    """
+
+    def __init__(self, vision_tower, use_cuda):
+        self.local = threading.local()
+        self.use_cuda = use_cuda
+        vision_tower.register_forward_pre_hook(self._start)
+        vision_tower.register_forward_hook(self._end)
+
+    def _mark(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _start(self, module, inputs):
+        spans = getattr(self.local, "spans", None)
+        if spans is not None:
+            spans.append([self._mark(), None])
+
+    def _end(self, module, inputs, output):
+        spans = getattr(self.local, "spans", None)
+        if spans:
+            spans[-1][1] = self._mark()
+
+    def run(self, spans, fn, **kwargs):
+        self.local.spans = spans
+        try:
+            return fn(**kwargs)
+        finally:
+            self.local.spans = None
+
+    def elapsed(self, spans):
+        total = 0.0
+        for start, end in spans:
+            if end is None:
+                continue
+            if self.use_cuda:
+                end.synchronize()
+                total += start.elapsed_time(end) / 1000
+            else:
+                total += end - start
+        return total
 
 
 def heart_beat_worker(controller):
@@ -45,7 +221,8 @@ class ModelWorker:
     def __init__(self, controller_addr, worker_addr,
                  worker_id, no_register,
                  model_path, model_base, model_name,
-                 load_8bit, load_4bit, device, use_flash_attn=False):
+                 load_8bit, load_4bit, device, use_flash_attn=False,
+                 limit_model_concurrency=5, max_inflight_prompt_tokens=None, queue_slo=None):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
         self.worker_id = worker_id
@@ -65,6 +242,13 @@ def __init__(self, controller_addr, worker_addr,
         self.tokenizer, self.model, self.image_processor, self.context_len = load_pretrained_model(
             model_path, model_base, self.model_name, load_8bit, load_4bit, device=self.device, use_flash_attn=use_flash_attn)
         self.is_multimodal = 'llava' in self.model_name.lower()
+        self.admission = AdmissionController(
+            max_inflight_prompt_tokens or 2 * self.context_len,
+            max_concurrency=limit_model_concurrency, slo=queue_slo)
+        self.vision_timer = None
+        if self.is_multimodal:
+            self.vision_timer = VisionEncodeTimer(
+                self.model.get_vision_tower(), use_cuda=str(self.model.device).startswith("cuda"))
 
         if not no_register:
             self.register_to_controller()
@@ -86,7 +270,7 @@ def register_to_controller(self):
 
     def send_heart_beat(self):
         logger.info(f"Send heart beat. Models: {[self.model_name]}. "
-                    f"Semaphore: {pretty_print_semaphore(model_semaphore)}. "
+                    f"Queue: {self.get_queue_state()}. "
                     f"global_counter: {global_counter}")
 
         url = self.controller_addr + "/receive_heart_beat"
@@ -95,7 +279,8 @@ def send_heart_beat(self):
             try:
                 ret = requests.post(url, json={
                     "worker_name": self.worker_addr,
-                    "queue_length": self.get_queue_length()}, timeout=5)
+                    "queue_length": self.get_queue_length(),
+                    "queue_state": self.get_queue_state()}, timeout=5)
                 exist = ret.json()["exist"]
                 break
             except requests.exceptions.RequestException as e:
@@ -106,22 +291,34 @@ def send_heart_beat(self):
             self.register_to_controller()
 
     def get_queue_length(self):
-        if model_semaphore is None:
-            return 0
-        else:
-            return args.limit_model_concurrency - model_semaphore._value + (len(
-                model_semaphore._waiters) if model_semaphore._waiters is not None else 0)
+        return self.admission.queue_length()
+
+    def get_queue_state(self):
+        return self.admission.queue_state()
 
     def get_status(self):
         return {
             "model_names": [self.model_name],
             "speed": 1,
             "queue_length": self.get_queue_length(),
+            "queue_state": self.get_queue_state(),
         }
 
+    def estimate_prompt_tokens(self, params):
+        """Prompt tokens of a request, including image tokens, as counted against the admission budget."""
+        prompt = params["prompt"]
+        num_images = len(params.get("images") or []) if self.is_multimodal else 0
+        if num_images > 0 and getattr(self.model.config, 'mm_use_im_start_end', False):
+            prompt = prompt.replace(DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN)
+        num_tokens = len(tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX))
+        if num_images > 0:
+            num_tokens += num_images * (self.model.get_vision_tower().num_patches - 1)
+        return num_tokens
+
     @torch.inference_mode()
-    def generate_stream(self, params):
+    def generate_stream(self, params, arrival_time=None):
         tokenizer, model, image_processor = self.tokenizer, self.model, self.image_processor
+        arrival_time = arrival_time if arrival_time is not None else time.perf_counter()
 
         prompt = params["prompt"]
         ori_prompt = prompt
@@ -132,14 +329,16 @@ def generate_stream(self, params):
                 if len(images) != prompt.count(DEFAULT_IMAGE_TOKEN):
                     raise ValueError("Number of images does not match number of <image> tokens in prompt")
 
+                preprocess_start = time.perf_counter()
                 images = [load_image_from_base64(image) for image in images]
                 image_sizes = [image.size for image in images]
                 images = process_images(images, image_processor, model.config)
 
                 if type(images) is list:
-                    images = [image.to(self.model.device, dtype=torch.float16) for image in images]
+                    images = [image.to(self.model.device, dtype=self.model.dtype) for image in images]
                 else:
-                    images = images.to(self.model.device, dtype=torch.float16)
+                    images = images.to(self.model.device, dtype=self.model.dtype)
+                image_preprocess_seconds.observe(time.perf_counter() - preprocess_start)
 
                 replace_token = DEFAULT_IMAGE_TOKEN
                 if getattr(self.model.config, 'mm_use_im_start_end', False):
@@ -165,15 +364,29 @@ def generate_stream(self, params):
         input_ids = tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).to(self.device)
         keywords = [stop_str]
         # stopping_criteria = KeywordsStoppingCriteria(keywords, tokenizer, input_ids)
-        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=15)
+        streamer = TimedTextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=15)
 
         max_new_tokens = min(max_new_tokens, max_context_length - input_ids.shape[-1] - num_image_tokens)
 
+        delta_format = params.get("stream_format", "full") == "delta"
         if max_new_tokens < 1:
-            yield json.dumps({"text": ori_prompt + "Exceeds max token length. Please start a new conversation, thanks.", "error_code": 0}).encode() + b"\0"
+            requests_total.inc(outcome="too_long")
+            message = "Exceeds max token length. Please start a new conversation, thanks."
+            if delta_format:
+                yield json.dumps({"delta": message, "offset": 0, "token_ids": [], "token_offset": 0, "error_code": 0}).encode() + b"\0"
+                yield json.dumps({"done": True, "finish_reason": "prompt_too_long", "text_length": len(message),
+                                  "num_prompt_tokens": input_ids.shape[-1] + num_image_tokens, "num_generated_tokens": 0,
+                                  "error_code": 0}).encode() + b"\0"
+            else:
+                yield json.dumps({"text": ori_prompt + message, "error_code": 0}).encode() + b"\0"
             return
 
-        thread = Thread(target=model.generate, kwargs=dict(
+        vision_spans = []
+        generate = model.generate
+        if self.vision_timer is not None:
+            generate = partial(self.vision_timer.run, vision_spans, model.generate)
+        generate_start = time.perf_counter()
+        thread = Thread(target=generate, kwargs=dict(
             inputs=input_ids,
             do_sample=do_sample,
             temperature=temperature,
@@ -185,19 +398,45 @@ def generate_stream(self, params):
         ))
         thread.start()
 
-        generated_text = ori_prompt
-        for new_text in streamer:
-            generated_text += new_text
-            if generated_text.endswith(stop_str):
-                generated_text = generated_text[:-len(stop_str)]
-            yield json.dumps({"text": generated_text, "error_code": 0}).encode() + b"\0"
-
-    def generate_stream_gate(self, params):
+        if delta_format:
+            for frame in stream_deltas(streamer, stop_str, input_ids.shape[-1] + num_image_tokens, max_new_tokens):
+                yield json.dumps(frame).encode() + b"\0"
+        else:
+            # Every frame repeats the prompt and all text so far
+            generated_text = ori_prompt
+            for new_text, _ in streamer:
+                generated_text += new_text
+                if stop_str and generated_text.endswith(stop_str):
+                    generated_text = generated_text[:-len(stop_str)]
+                yield json.dumps({"text": generated_text, "error_code": 0}).encode() + b"\0"
+
+        self.record_generation(arrival_time, generate_start, streamer.token_times, vision_spans,
+                               input_ids.shape[-1] + num_image_tokens)
+
+    def record_generation(self, arrival_time, generate_start, token_times, vision_spans, num_prompt_tokens):
+        requests_total.inc(outcome="ok")
+        prompt_tokens_total.inc(num_prompt_tokens)
+        if not token_times:
+            return
+        generated_tokens_total.inc(len(token_times))
+        vision_time = self.vision_timer.elapsed(vision_spans) if self.vision_timer is not None else 0.0
+        if vision_spans:
+            vision_encode_seconds.observe(vision_time)
+        time_to_first_token_seconds.observe(token_times[0] - arrival_time)
+        prefill_seconds.observe(max(0.0, token_times[0] - generate_start - vision_time))
+        decode_time = token_times[-1] - token_times[0]
+        decode_seconds.observe(decode_time)
+        if len(token_times) > 1:
+            inter_token_latency_seconds.observe_many([b - a for a, b in zip(token_times, token_times[1:])])
+            tokens_per_second.observe((len(token_times) - 1) / max(decode_time, 1e-6))
+
+    def generate_stream_gate(self, params, arrival_time=None):
         try:
-            for x in self.generate_stream(params):
+            for x in self.generate_stream(params, arrival_time):
                 yield x
         except ValueError as e:
             print("Caught ValueError:", e)
+            requests_total.inc(outcome="error")
             ret = {
                 "text": server_error_msg,
                 "error_code": 1,
@@ -205,6 +444,7 @@ def generate_stream_gate(self, params):
             yield json.dumps(ret).encode() + b"\0"
         except torch.cuda.CudaError as e:
             print("Caught torch.cuda.CudaError:", e)
+            requests_total.inc(outcome="error")
             ret = {
                 "text": server_error_msg,
                 "error_code": 1,
@@ -212,35 +452,205 @@ def generate_stream_gate(self, params):
             yield json.dumps(ret).encode() + b"\0"
         except Exception as e:
             print("Caught Unknown Error", e)
+            requests_total.inc(outcome="error")
             ret = {
                 "text": server_error_msg,
                 "error_code": 1,
             }
             yield json.dumps(ret).encode() + b"\0"
 
+    def estimate_batch_job_tokens(self, job):
+        return self.estimate_prompt_tokens({"prompt": job["prompt"], "images": job["images"] + job["image_files"]})
+
+    def prepare_batch_job(self, job):
+        """Tokenize a batch job and preprocess its images, one tensor per image."""
+        prompt = job["prompt"]
+        images = []
+        if self.is_multimodal:
+            images = [load_image_from_base64(image) for image in job["images"]]
+            images += [Image.open(path) for path in job["image_files"]]
+        image_sizes = [image.size for image in images]
+        num_image_tokens = 0
+        if images:
+            processed = process_images([image.convert("RGB") for image in images], self.image_processor, self.model.config)
+            images = list(processed)
+            if getattr(self.model.config, 'mm_use_im_start_end', False):
+                prompt = prompt.replace(DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN)
+            num_image_tokens = len(images) * self.model.get_vision_tower().num_patches
+        input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt')
+        return input_ids, images, image_sizes, num_image_tokens
+
+    @torch.inference_mode()
+    def generate_batch(self, jobs):
+        """
+        Run batch jobs (see `llava.serve.batch_jobs`) as one left-padded `generate`
+        call. Jobs share the sampling settings of the first job; a job whose images
+        fail to load or whose prompt does not fit in the context fails alone.
+
+        Returns:
+            list: one result per job, in the format `BatchJobManager` expects.
+        """
+        start = time.perf_counter()
+        max_context_length = getattr(self.model.config, 'max_position_embeddings', 2048)
+        results = [None] * len(jobs)
+        prepared = []
+        for i, job in enumerate(jobs):
+            try:
+                input_ids, images, image_sizes, num_image_tokens = self.prepare_batch_job(job)
+            except Exception as e:
+                results[i] = {"error": f"{type(e).__name__}: {e}"}
+                continue
+            num_prompt_tokens = input_ids.shape[-1] + num_image_tokens
+            max_new_tokens = min(job["max_new_tokens"], max_context_length - num_prompt_tokens)
+            if max_new_tokens < 1:
+                results[i] = {"error": "Exceeds max token length."}
+                continue
+            prepared.append((i, input_ids, images, image_sizes, num_prompt_tokens, max_new_tokens))
+
+        if prepared:
+            try:
+                for (i, *_), output_ids in zip(prepared, self._generate_padded(prepared, jobs[0])):
+                    results[i] = output_ids
+            except Exception as e:
+                logger.exception(f"Batched generate of {len(prepared)} jobs failed")
+                for i, *_ in prepared:
+                    results[i] = {"error": f"{type(e).__name__}: {e}"}
+
+        for (i, *_, num_prompt_tokens, max_new_tokens) in prepared:
+            if isinstance(results[i], dict):
+                continue
+            results[i] = self._batch_result(results[i], jobs[i]["stop"], num_prompt_tokens, max_new_tokens)
+            prompt_tokens_total.inc(num_prompt_tokens)
+            generated_tokens_total.inc(results[i]["num_generated_tokens"])
+        for result in results:
+            batch_jobs_total.inc(outcome="error" if "error" in result else "ok")
+        batch_size.observe(len(jobs))
+        batch_generate_seconds.observe(time.perf_counter() - start)
+        return results
+
+    def _generate_padded(self, prepared, sampling):
+        """Output ids per job. Splits the batch in halves when it runs out of CUDA memory."""
+        try:
+            return self._generate_padded_once(prepared, sampling)
+        except torch.cuda.OutOfMemoryError:
+            if len(prepared) == 1:
+                raise
+            torch.cuda.empty_cache()
+            half = len(prepared) // 2
+            logger.warning(f"Out of memory with {len(prepared)} batch jobs, retrying as {half} + {len(prepared) - half}")
+            return self._generate_padded(prepared[:half], sampling) + self._generate_padded(prepared[half:], sampling)
+
+    def _generate_padded_once(self, prepared, sampling):
+        tokenizer, model = self.tokenizer, self.model
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.unk_token_id
+        max_len = max(input_ids.shape[-1] for _, input_ids, *_ in prepared)
+        input_ids = torch.full((len(prepared), max_len), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(prepared), max_len), dtype=torch.long)
+        for b, (_, ids, *_) in enumerate(prepared):
+            input_ids[b, max_len - ids.shape[-1]:] = ids
+            attention_mask[b, max_len - ids.shape[-1]:] = 1
+
+        image_args = {}
+        if any(images for _, _, images, *_ in prepared):
+            # A job without images still takes one image, which the splice drops
+            dummy = None
+            images, image_sizes = [], []
+            for _, _, job_images, job_image_sizes, *_ in prepared:
+                if not job_images:
+                    if dummy is None:
+                        shape = next(x for _, _, x, *_ in prepared if x)[0].shape[-3:]
+                        dummy = torch.zeros(shape)
+                    job_images, job_image_sizes = [dummy], [(shape[-1], shape[-2])]
+                images += job_images
+                image_sizes += job_image_sizes
+            # Image features are spliced in after the left padding
+            image_args = {"images": [image.to(self.device, dtype=model.dtype) for image in images],
+                          "image_sizes": image_sizes, "padding_side": "left"}
+
+        temperature = sampling["temperature"]
+        output_ids = model.generate(
+            inputs=input_ids.to(self.device),
+            attention_mask=attention_mask.to(self.device),
+            do_sample=temperature > 0.001,
+            temperature=temperature,
+            top_p=sampling["top_p"],
+            max_new_tokens=max(x[-1] for x in prepared),
+            pad_token_id=pad_token_id,
+            use_cache=True,
+            **image_args)
+        return [ids.tolist() for ids in output_ids.cpu()]
+
+    def _batch_result(self, output_ids, stop_str, num_prompt_tokens, max_new_tokens):
+        output_ids = output_ids[:max_new_tokens]
+        finish_reason = "length"
+        if self.tokenizer.eos_token_id in output_ids:
+            output_ids = output_ids[:output_ids.index(self.tokenizer.eos_token_id) + 1]
+            finish_reason = "eos"
+        text = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+        if stop_str and stop_str in text:
+            # The shortest prefix whose text contains the stop string: tokens after it are not part of the answer
+            lo, hi = 1, len(output_ids)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if stop_str in self.tokenizer.decode(output_ids[:mid], skip_special_tokens=True):
+                    hi = mid
+                else:
+                    lo = mid + 1
+            output_ids = output_ids[:lo]
+            text = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+            text = text[:text.index(stop_str)]
+            finish_reason = "stop"
+        return {"text": text.strip(), "finish_reason": finish_reason,
+                "num_prompt_tokens": num_prompt_tokens, "num_generated_tokens": len(output_ids)}
+
 
 app = FastAPI()
+instrument_app(app, metrics)
+worker = None
+batch_manager = None
+batch_task = None
+
+
+def send_heart_beat_in_background():
+    # Runs the blocking heart beat request off the event loop
+    if not args.no_register:
+        asyncio.get_running_loop().run_in_executor(None, worker.send_heart_beat)
 
 
-def release_model_semaphore(fn=None):
-    model_semaphore.release()
-    if fn is not None:
-        fn()
+async def release_admission(ticket):
+    worker.admission.release(ticket)
+    send_heart_beat_in_background()
 
 
 @app.post("/worker_generate_stream")
 async def generate_stream(request: Request):
-    global model_semaphore, global_counter
+    global global_counter
     global_counter += 1
+    arrival_time = time.perf_counter()
     params = await request.json()
 
-    if model_semaphore is None:
-        model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
-    await model_semaphore.acquire()
-    worker.send_heart_beat()
-    generator = worker.generate_stream_gate(params)
+    # Optional per-request scheduling hints: lower `priority` is served first,
+    # and a request still queued `timeout` seconds after arrival is dropped.
+    timeout = params.get("timeout", args.request_timeout)
+    deadline = time.monotonic() + float(timeout) if timeout is not None else None
+    try:
+        ticket = await worker.admission.acquire(
+            worker.estimate_prompt_tokens(params), priority=int(params.get("priority", 0)), deadline=deadline)
+    except AdmissionRejected as e:
+        requests_total.inc(outcome=f"rejected_{e.reason}")
+        logger.warning(f"Rejected request ({e.reason}), queue: {worker.get_queue_state()}")
+        ret = {
+            "text": server_error_msg,
+            "error_code": 4,
+        }
+        headers = {"Retry-After": str(max(1, int(e.predicted_wait or 1)))}
+        return Response(json.dumps(ret).encode() + b"\0", status_code=503, headers=headers)
+
+    admission_wait_seconds.observe(time.perf_counter() - arrival_time)
+    send_heart_beat_in_background()
+    generator = worker.generate_stream_gate(params, arrival_time)
     background_tasks = BackgroundTasks()
-    background_tasks.add_task(partial(release_model_semaphore, fn=worker.send_heart_beat))
+    background_tasks.add_task(release_admission, ticket)
     return StreamingResponse(generator, background=background_tasks)
 
 
@@ -249,6 +659,84 @@ async def get_status(request: Request):
     return worker.get_status()
 
 
+@app.post("/worker_get_queue_state")
+async def get_queue_state(request: Request):
+    return worker.get_queue_state()
+
+
+@app.on_event("startup")
+async def start_batch_jobs():
+    global batch_task
+    if batch_manager is not None:
+        batch_task = asyncio.get_running_loop().create_task(batch_manager.run())
+
+
+def _batch_error(message, status_code):
+    return JSONResponse({"error": {"message": message}}, status_code=status_code)
+
+
+def _read_lines(path):
+    # Opened lazily, so the file is read in the executor
+    with open(path) as f:
+        yield from f
+
+
+@app.post("/v1/batches")
+async def create_batch(request: Request):
+    """
+    Submit a batch of jobs, see `llava.serve.batch_jobs` for the line format.
+
+    The body is either a JSON object with `input_file` (a JSONL path on the
+    worker) or `requests` (a list of jobs) and the optional batch settings
+    `conv_mode`, `image_folder`, `max_new_tokens`, `temperature` and `metadata`;
+    or, with an `application/jsonl` content type, the JSONL itself with the
+    settings as query parameters.
+    """
+    content_type = request.headers.get("content-type", "")
+    if "jsonl" in content_type or "ndjson" in content_type:
+        options = dict(request.query_params)
+        lines = (await request.body()).splitlines()
+    else:
+        options = await request.json()
+        if options.get("input_file") is not None:
+            lines = _read_lines(options["input_file"])
+        else:
+            lines = options.get("requests") or []
+    try:
+        return await batch_manager.create(lines, options)
+    except (ValueError, OSError) as e:
+        return _batch_error(str(e), 400)
+
+
+@app.get("/v1/batches")
+async def list_batches():
+    return {"object": "list", "data": batch_manager.list()}
+
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str):
+    info = batch_manager.get(batch_id)
+    return info if info is not None else _batch_error(f"No batch {batch_id}", 404)
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str):
+    info = batch_manager.cancel(batch_id)
+    return info if info is not None else _batch_error(f"No batch {batch_id}", 404)
+
+
+@app.get("/v1/batches/{batch_id}/output")
+async def get_batch_output(batch_id: str, errors: bool = False):
+    """The results written so far, or the failed jobs with `?errors=true`."""
+    info = batch_manager.get(batch_id)
+    if info is None:
+        return _batch_error(f"No batch {batch_id}", 404)
+    path = info["error_file" if errors else "output_file"]
+    if not os.path.exists(path):
+        return Response(b"", media_type="application/jsonl")
+    return FileResponse(path, media_type="application/jsonl")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, default="localhost")
@@ -263,11 +751,22 @@ async def get_status(request: Request):
     parser.add_argument("--device", type=str, default="cuda")
     parser.add_argument("--multi-modal", action="store_true", help="Multimodal mode is automatically detected with model name, please make sure `llava` is included in the model path.")
     parser.add_argument("--limit-model-concurrency", type=int, default=5)
+    parser.add_argument("--max-inflight-prompt-tokens", type=int, default=None,
+        help="Prompt tokens (including image tokens) allowed in flight, defaults to twice the context length.")
+    parser.add_argument("--queue-slo", type=float, default=None,
+        help="Reject requests whose predicted queueing delay exceeds this many seconds.")
+    parser.add_argument("--request-timeout", type=float, default=None,
+        help="Drop requests still queued this many seconds after arrival, unless the request sets `timeout`.")
     parser.add_argument("--stream-interval", type=int, default=1)
     parser.add_argument("--no-register", action="store_true")
     parser.add_argument("--load-8bit", action="store_true")
     parser.add_argument("--load-4bit", action="store_true")
     parser.add_argument("--use-flash-attn", action="store_true")
+    parser.add_argument("--batch-dir", type=str, default=os.path.join(LOGDIR, "batches"),
+        help="Where `/v1/batches` jobs and results are stored.")
+    parser.add_argument("--batch-size", type=int, default=32, help="Batch jobs per batched generate call.")
+    parser.add_argument("--batch-max-tokens", type=int, default=None,
+        help="Bound on batch jobs x (longest prompt + max_new_tokens) per call, defaults to half of max-inflight-prompt-tokens.")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
@@ -284,5 +783,11 @@ async def get_status(request: Request):
                          args.load_8bit,
                          args.load_4bit,
                          args.device,
-                         use_flash_attn=args.use_flash_attn)
+                         use_flash_attn=args.use_flash_attn,
+                         limit_model_concurrency=args.limit_model_concurrency,
+                         max_inflight_prompt_tokens=args.max_inflight_prompt_tokens,
+                         queue_slo=args.queue_slo)
+    batch_manager = BatchJobManager(args.batch_dir, worker.generate_batch, worker.estimate_batch_job_tokens,
+                                    worker.admission, max_batch_size=args.batch_size,
+                                    max_batch_tokens=args.batch_max_tokens)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -0,0 +1,142 @@
+"""
+Build a tiny LLaVA checkpoint with random weights, for exercising the serving
+stack (and `llava.serve.bench`) on a CPU-only machine.
+
+The checkpoint is a float32 serving snapshot with a 2-layer Llama, a 2-layer
+CLIP vision tower and a small SentencePiece tokenizer trained on the fly, so
+nothing is downloaded. Its outputs are meaningless; only the shapes and the
+amount of work per token resemble a real model.
+
+Usage:
+    python -m llava.serve.tiny_model --output-dir ./checkpoints/llava-tiny-random
+    python -m llava.serve.model_worker --model-path ./checkpoints/llava-tiny-random --device cpu
+"""
+import argparse
+import io
+import json
+import os
+import random
+
+import torch
+
+
+TINY_LLAMA_CONFIG = dict(
+    hidden_size=64,
+    intermediate_size=128,
+    num_hidden_layers=2,
+    num_attention_heads=4,
+    num_key_value_heads=4,
+    max_position_embeddings=2048,
+    max_sequence_length=2048,
+    rms_norm_eps=1e-5,
+    tie_word_embeddings=False,
+)
+
+TINY_VISION_CONFIG = dict(
+    hidden_size=32,
+    intermediate_size=64,
+    num_hidden_layers=2,
+    num_attention_heads=2,
+    image_size=56,
+    patch_size=14,
+    projection_dim=32,
+)
+
+TINY_MM_CONFIG = dict(
+    mm_hidden_size=TINY_VISION_CONFIG["hidden_size"],
+    mm_projector_type="mlp2x_gelu",
+    mm_vision_select_layer=-2,
+    mm_vision_select_feature="patch",
+    mm_patch_merge_type="flat",
+    mm_use_im_start_end=False,
+    mm_use_im_patch_token=False,
+    image_aspect_ratio="pad",
+    tokenizer_padding_side="right",
+    tokenizer_model_max_length=2048,
+)
+
+_WORDS = (
+    "a about above after again all an and any are as at be because been before below between both but by can "
+    "could describe detail did do does doing down during each few for from further had has have having he her "
+    "here hers him his how i if image in into is it its just me more most my no nor not now of off on once only "
+    "or other our out over own picture please same she should show so some such than that the their them then "
+    "there these they this those through to too under until up very was we were what when where which while who "
+    "whom why will with would you your assistant user human question answer color left right top bottom person "
+    "car tree sky water building table dog cat red blue green white black small large many one two three"
+).split()
+
+
+def train_tokenizer(output_dir, vocab_size=1000, num_sentences=20000, seed=0):
+    """Train a byte-fallback SentencePiece model in memory and save it as a Llama tokenizer."""
+    import sentencepiece as spm
+    from transformers import LlamaTokenizer
+
+    rng = random.Random(seed)
+    sentences = [" ".join(rng.choice(_WORDS) for _ in range(rng.randint(4, 24))) for _ in range(num_sentences)]
+    model = io.BytesIO()
+    spm.SentencePieceTrainer.train(
+        sentence_iterator=iter(sentences), model_writer=model, vocab_size=vocab_size, model_type="bpe",
+        byte_fallback=True, character_coverage=1.0, hard_vocab_limit=False,
+        unk_id=0, bos_id=1, eos_id=2, pad_id=-1, minloglevel=2)
+
+    os.makedirs(output_dir, exist_ok=True)
+    vocab_file = os.path.join(output_dir, "tokenizer.model")
+    with open(vocab_file, "wb") as f:
+        f.write(model.getvalue())
+    tokenizer = LlamaTokenizer(vocab_file, legacy=False)
+    tokenizer.pad_token = tokenizer.unk_token
+    return tokenizer
+
+
+def build_tiny_model(output_dir, seed=0):
+    """
+    Write a random-weight LLaVA serving snapshot to `output_dir`. The directory
+    name should contain `llava` so the model worker treats it as multimodal.
+    """
+    from transformers import CLIPImageProcessor, CLIPVisionConfig, CLIPVisionModel
+    from llava.model.builder import SERVING_SNAPSHOT_FILE, save_serving_snapshot
+    from llava.model.language_model.llava_llama import LlavaConfig, LlavaLlamaForCausalLM
+
+    torch.manual_seed(seed)
+    output_dir = os.path.abspath(output_dir)
+    tokenizer = train_tokenizer(output_dir, seed=seed)
+
+    vision_dir = os.path.join(output_dir, "vision_tower")
+    CLIPVisionModel(CLIPVisionConfig(**TINY_VISION_CONFIG)).save_pretrained(vision_dir, safe_serialization=True)
+    image_size = TINY_VISION_CONFIG["image_size"]
+    CLIPImageProcessor(
+        size={"shortest_edge": image_size}, crop_size={"height": image_size, "width": image_size},
+    ).save_pretrained(vision_dir)
+
+    config = LlavaConfig(
+        vocab_size=len(tokenizer),
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        mm_vision_tower=vision_dir,
+        **TINY_LLAMA_CONFIG,
+        **TINY_MM_CONFIG,
+    )
+    config.architectures = ["LlavaLlamaForCausalLM"]
+    model = LlavaLlamaForCausalLM(config)
+    model.eval()
+
+    # The vision tower stays unloaded (its weights are already in vision_dir),
+    # so the snapshot does not re-save it; point the snapshot at it instead.
+    save_serving_snapshot(model, tokenizer, output_dir, dtype=torch.float32)
+    snapshot_file = os.path.join(output_dir, SERVING_SNAPSHOT_FILE)
+    with open(snapshot_file) as f:
+        snapshot = json.load(f)
+    snapshot["vision_tower"] = "vision_tower"
+    with open(snapshot_file, "w") as f:
+        json.dump(snapshot, f, indent=2)
+    return output_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output-dir", type=str, default="./checkpoints/llava-tiny-random")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"Tiny random-weight LLaVA written to {build_tiny_model(args.output_dir, args.seed)}")
@@ -0,0 +1,223 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+
+import torch
+from transformers import TrainerCallback
+
+
+SAFE_WEIGHTS_NAME = "model.safetensors"
+SAFE_WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+CHECKPOINT_MANIFEST_NAME = "checkpoint_manifest.json"
+
+
+def parse_size(size):
+    if isinstance(size, int):
+        return size
+    units = {"KB": 2**10, "MB": 2**20, "GB": 2**30, "TB": 2**40}
+    size = size.strip().upper()
+    for unit, scale in units.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * scale)
+    return int(size)
+
+
+def _atomic_write(path, write_fn):
+    tmp_path = path + ".tmp"
+    write_fn(tmp_path)
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def is_complete_checkpoint(checkpoint_dir):
+    """Whether `AsyncCheckpointWriter.finalize` wrote the manifest of `checkpoint_dir`, i.e. all its writes finished."""
+    return os.path.isfile(os.path.join(checkpoint_dir, CHECKPOINT_MANIFEST_NAME))
+
+
+def list_checkpoints(output_dir):
+    """(step, path) of every `checkpoint-N` folder in `output_dir`, by increasing step."""
+    if not os.path.isdir(output_dir):
+        return []
+    checkpoints = []
+    for name in os.listdir(output_dir):
+        match = re.fullmatch(r"checkpoint-(\d+)", name)
+        path = os.path.join(output_dir, name)
+        if match is not None and os.path.isdir(path):
+            checkpoints.append((int(match.group(1)), path))
+    return sorted(checkpoints)
+
+
+def last_complete_checkpoint(output_dir):
+    """Path of the highest `checkpoint-N` in `output_dir` that has a manifest, or None."""
+    complete = [path for _, path in list_checkpoints(output_dir) if is_complete_checkpoint(path)]
+    return complete[-1] if complete else None
+
+
+def resolve_checkpoint_dir(output_dir, timeout=600):
+    """
+    The Trainer writes each checkpoint to `tmp-checkpoint-N` and renames it to
+    `checkpoint-N` after its synchronous writes. Background writes must land in
+    the renamed folder, so wait for the rename to happen.
+    """
+    parent, name = os.path.split(output_dir.rstrip("/"))
+    if not name.startswith("tmp-"):
+        return output_dir
+    final_dir = os.path.join(parent, name[len("tmp-"):])
+    deadline = time.time() + timeout
+    while os.path.exists(output_dir) and not os.path.exists(final_dir):
+        if time.time() > deadline:
+            return output_dir
+        time.sleep(0.1)
+    return final_dir if os.path.exists(final_dir) else output_dir
+
+
+def save_safetensors_shards(state_dict, output_dir, max_shard_size="5GB"):
+    """Write `state_dict` in the HF sharded safetensors layout, with the index written last."""
+    from safetensors.torch import save_file
+
+    max_shard_bytes = parse_size(max_shard_size)
+    shards, current, current_bytes = [], {}, 0
+    for name, tensor in state_dict.items():
+        nbytes = tensor.numel() * tensor.element_size()
+        if len(current) > 0 and current_bytes + nbytes > max_shard_bytes:
+            shards.append(current)
+            current, current_bytes = {}, 0
+        current[name] = tensor
+        current_bytes += nbytes
+    shards.append(current)
+
+    if len(shards) == 1:
+        _atomic_write(os.path.join(output_dir, SAFE_WEIGHTS_NAME),
+                      lambda path: save_file(shards[0], path, metadata={"format": "pt"}))
+        return [SAFE_WEIGHTS_NAME]
+
+    weight_map, files = {}, []
+    for idx, shard in enumerate(shards):
+        shard_name = f"model-{idx + 1:05d}-of-{len(shards):05d}.safetensors"
+        _atomic_write(os.path.join(output_dir, shard_name),
+                      lambda path: save_file(shard, path, metadata={"format": "pt"}))
+        weight_map.update({name: shard_name for name in shard})
+        files.append(shard_name)
+
+    total_size = sum(t.numel() * t.element_size() for t in state_dict.values())
+    index = {"metadata": {"total_size": total_size}, "weight_map": weight_map}
+
+    def write_index(path):
+        with open(path, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+    _atomic_write(os.path.join(output_dir, SAFE_WEIGHTS_INDEX_NAME), write_index)
+    return files + [SAFE_WEIGHTS_INDEX_NAME]
+
+
+def save_torch(obj, output_dir, filename):
+    _atomic_write(os.path.join(output_dir, filename), lambda path: torch.save(obj, path))
+    return [filename]
+
+
+class AsyncCheckpointWriter:
+    """
+    Write checkpoints from a background thread.
+
+    `snapshot` copies tensors to CPU (one device sync per snapshot), and
+    `submit` queues a write job that runs on a single writer thread in FIFO
+    order. Device tensors go to pinned buffers allocated for that snapshot and
+    dropped once its job has run, so no host memory is held between saves.
+    Each job writes its files atomically, and `finalize` adds a manifest listing
+    them, so a checkpoint without a manifest is known to be incomplete. Call
+    `wait` before exiting.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._files = {}
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="llava-checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if self._error is None:
+                    job()
+            except Exception as e:
+                self._error = e
+            finally:
+                # Drop the job's snapshot before waiting for the next one
+                job = None
+                self._queue.task_done()
+                self._release_pinned_memory()
+
+    @staticmethod
+    def _release_pinned_memory():
+        # The caching host allocator keeps freed pinned blocks; return them when torch exposes a way to.
+        empty_cache = getattr(torch._C, "_host_emptyCache", None)
+        if empty_cache is not None and torch.cuda.is_available():
+            empty_cache()
+
+    def _snapshot(self, obj):
+        if torch.is_tensor(obj):
+            obj = obj.detach()
+            if obj.device.type == "cpu":
+                return obj.clone()
+            buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+            buf.copy_(obj, non_blocking=True)
+            return buf
+        if isinstance(obj, dict):
+            return {k: self._snapshot(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v) for v in obj)
+        return obj
+
+    def snapshot(self, obj):
+        """Copy every tensor in a (nested) state dict to CPU memory owned by the snapshot."""
+        obj = self._snapshot(obj)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return obj
+
+    def submit(self, output_dir, write_fn):
+        """Queue `write_fn(target_dir)`, which returns the names of the files it wrote."""
+        def job():
+            target_dir = resolve_checkpoint_dir(output_dir)
+            os.makedirs(target_dir, exist_ok=True)
+            files = write_fn(target_dir)
+            self._files.setdefault(target_dir, []).extend(files)
+        self._queue.put(job)
+
+    def finalize(self, output_dir):
+        """Queue the manifest for `output_dir`, written once all earlier jobs for it are done."""
+        def job():
+            target_dir = resolve_checkpoint_dir(output_dir)
+            files = self._files.pop(target_dir, [])
+            manifest = {
+                "complete": True,
+                "time": time.time(),
+                "files": {name: os.path.getsize(os.path.join(target_dir, name)) for name in files},
+            }
+
+            def write_manifest(path):
+                with open(path, "w") as f:
+                    json.dump(manifest, f, indent=2)
+            _atomic_write(os.path.join(target_dir, CHECKPOINT_MANIFEST_NAME), write_manifest)
+        self._queue.put(job)
+
+    def wait(self):
+        self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Asynchronous checkpoint write failed") from error
+
+
+class AsyncCheckpointCallback(TrainerCallback):
+    """Wait for pending checkpoint writes before training returns."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.writer.wait()
@@ -0,0 +1,205 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+
+
+@dataclass
+class MixtureSource:
+    name: str
+    data_path: str
+    image_folder: Optional[str] = None
+    weight: float = 1.0
+    num_samples: Optional[int] = None
+
+
+def load_mixture_spec(spec_path):
+    """
+    Load a data mixture spec from YAML or JSON.
+
+    Example (YAML):
+        seed: 42
+        num_samples: 600000        # optional, defaults to the sum of all source sizes
+        index_dir: /data/.index    # optional, where per-source length/offset indices are cached
+        sources:
+          - name: cholec80
+            data_path: /data/cholec80_llava.jsonl
+            image_folder: /data/cholec80/frames
+            weight: 2.0
+          - name: llava_665k
+            data_path: /data/llava_v1_5_mix665k.json
+            image_folder: /data/llava
+            num_samples: 200000    # an exact count overrides the weight
+
+    Returns:
+        tuple: (list of MixtureSource, dict of global options).
+    """
+    with open(spec_path, 'r') as f:
+        if spec_path.endswith(('.yaml', '.yml')):
+            import yaml
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    sources = [MixtureSource(**source) for source in spec.pop('sources')]
+    if len(set(source.name for source in sources)) != len(sources):
+        raise ValueError(f'Source names in {spec_path} must be unique')
+    return sources, spec
+
+
+def _record_stats(record):
+    num_words = sum(len(conv['value'].split()) for conv in record['conversations'])
+    return num_words, 'image' in record
+
+
+class SourceRecords:
+    """
+    Lazy, random-access view of one source file.
+
+    JSONL files are scanned once to build a byte-offset index, and records are
+    read with a seek on access, so a source is never fully materialized. JSON
+    arrays are only loaded on their first access. The offsets and per-record
+    length stats are cached next to the data (or in `index_dir`), keyed by file
+    size and mtime, so adding a source or changing weights does not rescan the
+    others.
+    """
+
+    def __init__(self, source: MixtureSource, index_dir=None):
+        self.source = source
+        self.is_jsonl = source.data_path.endswith('.jsonl')
+        self._records = None
+        self._file = None
+        self._pid = None
+
+        stat = os.stat(source.data_path)
+        index_name = os.path.basename(source.data_path) + '.idx.npz'
+        index_path = os.path.join(index_dir or os.path.dirname(os.path.abspath(source.data_path)), index_name)
+        signature = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+        if os.path.isfile(index_path):
+            # Arrays are copied out so the file is closed before a stale index is rewritten.
+            with np.load(index_path) as index:
+                if np.array_equal(index['signature'], signature):
+                    self.offsets, self.num_words, self.has_image = index['offsets'], index['num_words'], index['has_image']
+                    return
+
+        self.offsets, self.num_words, self.has_image = self._build_index()
+        try:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            np.savez(index_path, signature=signature, offsets=self.offsets, num_words=self.num_words, has_image=self.has_image)
+        except OSError:
+            pass
+
+    def _build_index(self):
+        offsets, num_words, has_image = [], [], []
+        if self.is_jsonl:
+            with open(self.source.data_path, 'rb') as f:
+                offset = f.tell()
+                for line in iter(f.readline, b''):
+                    if line.strip():
+                        words, image = _record_stats(json.loads(line))
+                        offsets.append(offset)
+                        num_words.append(words)
+                        has_image.append(image)
+                    offset = f.tell()
+        else:
+            for record in self._load_json():
+                words, image = _record_stats(record)
+                num_words.append(words)
+                has_image.append(image)
+        return np.array(offsets, dtype=np.int64), np.array(num_words, dtype=np.int32), np.array(has_image, dtype=bool)
+
+    def _load_json(self):
+        if self._records is None:
+            with open(self.source.data_path, 'r') as f:
+                self._records = json.load(f)
+        return self._records
+
+    def __len__(self):
+        return len(self.num_words)
+
+    def __getitem__(self, i):
+        if self.is_jsonl:
+            # File handles are not shared across dataloader worker processes.
+            if self._file is None or self._pid != os.getpid():
+                self._file = open(self.source.data_path, 'rb')
+                self._pid = os.getpid()
+            self._file.seek(int(self.offsets[i]))
+            record = json.loads(self._file.readline())
+        else:
+            record = dict(self._load_json()[i])
+        if 'image' in record and self.source.image_folder is not None:
+            record['image'] = os.path.join(self.source.image_folder, record['image'].strip('", '))
+        return record
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
+
+
+class MixtureRecords:
+    """
+    Deterministic weighted interleaving of several `SourceRecords`.
+
+    Each source contributes `weight / sum(weights) * num_samples` records (or its
+    explicit `num_samples`), drawn from a per-source permutation that wraps around
+    when a source is upsampled. The sources are then interleaved with a seeded
+    shuffle. The mapping depends only on the spec and seed, so every rank builds
+    the same global order and the distributed sampler shards it consistently.
+    """
+
+    def __init__(self, sources: List[MixtureSource], seed=42, num_samples=None, index_dir=None):
+        self.sources = [SourceRecords(source, index_dir=index_dir) for source in sources]
+        sizes = np.array([len(x) for x in self.sources], dtype=np.int64)
+        if num_samples is None:
+            num_samples = int(sizes.sum())
+
+        weights = np.array([source.weight for source in sources], dtype=np.float64)
+        counts = np.floor(weights / weights.sum() * num_samples).astype(np.int64)
+        for k, source in enumerate(sources):
+            if source.num_samples is not None:
+                counts[k] = source.num_samples
+
+        source_ids, record_ids = [], []
+        for k, (size, count) in enumerate(zip(sizes, counts)):
+            if size == 0 or count == 0:
+                continue
+            rng = np.random.default_rng([seed, k])
+            num_rounds = -(-count // size)
+            perm = np.concatenate([rng.permutation(size) for _ in range(num_rounds)])[:count]
+            source_ids.append(np.full(count, k, dtype=np.int32))
+            record_ids.append(perm)
+
+        if len(source_ids) == 0:
+            raise ValueError('Data mixture is empty')
+        order = np.random.default_rng(seed).permutation(int(counts[sizes > 0].sum()))
+        self.source_ids = np.concatenate(source_ids)[order]
+        self.record_ids = np.concatenate(record_ids)[order]
+
+    def __len__(self):
+        return len(self.source_ids)
+
+    def __getitem__(self, i):
+        return self.sources[self.source_ids[i]][int(self.record_ids[i])]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _gather(self, name):
+        per_source = [getattr(source, name) for source in self.sources]
+        out = np.empty(len(self), dtype=per_source[0].dtype)
+        for k, values in enumerate(per_source):
+            mask = self.source_ids == k
+            out[mask] = values[self.record_ids[mask]]
+        return out
+
+    @property
+    def num_words(self):
+        return self._gather('num_words')
+
+    @property
+    def has_image(self):
+        return self._gather('has_image')
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+def resolve_image_path(image_file, image_folder=None):
+    """Strip stray quotes/commas, join relative paths with `image_folder` and make the path absolute."""
+    image_file = image_file.strip('", ')
+    if image_folder is not None:
+        image_file = os.path.join(image_folder, image_file)
+    return os.path.abspath(image_file)
+
+
+def probe_image(path, compute_hash=False):
+    """
+    Returns:
+        tuple: (file size, mtime in ns, width, height, blake2b-128 hex digest or '' without `compute_hash`),
+            or None if the file is missing or unreadable.
+    """
+    try:
+        stat = os.stat(path)
+        # Image.open only parses the header, the pixels are not decoded.
+        with Image.open(path) as img:
+            width, height = img.size
+        digest = hash_image(path) if compute_hash else ''
+        return stat.st_size, stat.st_mtime_ns, width, height, digest
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def hash_image(path):
+    """blake2b-128 hex digest of the file at `path`."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageIndex:
+    """
+    Resolved path, file size, mtime, dimensions and optionally content hash of
+    every image in a dataset.
+
+    Each unique path is probed once, in parallel, before training starts, so
+    missing or corrupt images are reported up front instead of mid-epoch, and
+    `__getitem__` reads the resolved path without touching the string or the
+    filesystem. Probing stats the file and parses the image header; reading and
+    hashing the whole file is opt-in (`compute_hash`). The index is cached next
+    to the data file and reused while the data file, `image_folder` and
+    `compute_hash` are unchanged.
+    """
+
+    FIELDS = ('paths', 'file_size', 'mtime_ns', 'width', 'height', 'digest', 'valid', 'record_ids')
+
+    def __init__(self, paths, file_size, mtime_ns, width, height, digest, valid, record_ids):
+        self.paths = paths
+        self.file_size = file_size
+        self.mtime_ns = mtime_ns
+        self.width = width
+        self.height = height
+        self.digest = digest
+        self.valid = valid
+        self.record_ids = record_ids
+
+    @staticmethod
+    def unique_paths(records, image_folder=None):
+        """Resolved image path of each record (None without an image) and the sorted unique paths."""
+        record_paths = [resolve_image_path(r['image'], image_folder) if 'image' in r else None for r in records]
+        return record_paths, sorted(set(p for p in record_paths if p is not None))
+
+    @classmethod
+    def from_probes(cls, record_paths, paths, probes):
+        path_ids = {p: k for k, p in enumerate(paths)}
+        record_ids = np.array([path_ids[p] if p is not None else -1 for p in record_paths], dtype=np.int64)
+        valid = np.array([x is not None for x in probes], dtype=bool)
+        probes = [x if x is not None else (0, 0, 0, 0, '') for x in probes]
+        return cls(
+            paths=np.array(paths, dtype=str),
+            file_size=np.array([x[0] for x in probes], dtype=np.int64),
+            mtime_ns=np.array([x[1] for x in probes], dtype=np.int64),
+            width=np.array([x[2] for x in probes], dtype=np.int32),
+            height=np.array([x[3] for x in probes], dtype=np.int32),
+            digest=np.array([x[4] for x in probes], dtype=str),
+            valid=valid,
+            record_ids=record_ids,
+        )
+
+    @classmethod
+    def build(cls, records, image_folder=None, num_workers=32, compute_hash=False):
+        record_paths, paths = cls.unique_paths(records, image_folder)
+        with ThreadPoolExecutor(num_workers) as executor:
+            probes = list(executor.map(lambda path: probe_image(path, compute_hash), paths))
+        return cls.from_probes(record_paths, paths, probes)
+
+    @classmethod
+    def load(cls, index_path, signature):
+        if not os.path.isfile(index_path):
+            return None
+        with np.load(index_path) as index:
+            if str(index['signature']) != signature or any(name not in index for name in cls.FIELDS):
+                return None
+            return cls(**{name: index[name] for name in cls.FIELDS})
+
+    def save(self, index_path, signature):
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        tmp_path = index_path + '.tmp.npz'
+        np.savez(tmp_path, signature=np.array(signature), **{name: getattr(self, name) for name in self.FIELDS})
+        os.replace(tmp_path, index_path)
+
+    def __len__(self):
+        return len(self.record_ids)
+
+    def image_path(self, i):
+        k = self.record_ids[i]
+        return str(self.paths[k]) if k >= 0 else None
+
+    def image_size(self, i):
+        k = self.record_ids[i]
+        return (int(self.width[k]), int(self.height[k])) if k >= 0 else None
+
+    def content_hash(self, i):
+        """blake2b-128 hex digest of the image of record `i`, or None if the index was built without hashes."""
+        k = self.record_ids[i]
+        return (str(self.digest[k]) or None) if k >= 0 else None
+
+    def missing_records(self):
+        """Indices of records whose image is missing or unreadable."""
+        has_image = self.record_ids >= 0
+        bad = np.zeros(len(self.record_ids), dtype=bool)
+        bad[has_image] = ~self.valid[self.record_ids[has_image]]
+        return np.nonzero(bad)[0]
+
+    def select(self, keep):
+        """Keep only the records in `keep` (indices into the current records)."""
+        self.record_ids = self.record_ids[keep]
+
+
+def image_index_signature(data_path, image_folder, num_records, compute_hash):
+    stat = os.stat(data_path)
+    image_folder = os.path.abspath(image_folder) if image_folder is not None else None
+    return json.dumps([os.path.abspath(data_path), stat.st_size, stat.st_mtime_ns, image_folder, num_records,
+                       compute_hash])
+
+
+def load_or_build_image_index(records, data_path, image_folder=None, index_path=None, num_workers=32,
+                              compute_hash=False):
+    """
+    Load the cached `ImageIndex` for `data_path`, or build and cache it.
+
+    Under torch.distributed every rank probes its own shard of the paths and
+    the shards are exchanged with `all_gather_object`, so no rank sits idle at a
+    barrier while another one does all the probing. Rank 0 writes the cache.
+    """
+    import torch.distributed as dist
+
+    index_path = index_path or data_path + '.images.npz'
+    signature = image_index_signature(data_path, image_folder, len(records), compute_hash)
+    distributed = dist.is_available() and dist.is_initialized()
+
+    index = ImageIndex.load(index_path, signature)
+    if not distributed:
+        if index is None:
+            index = ImageIndex.build(records, image_folder, num_workers, compute_hash)
+            try:
+                index.save(index_path, signature)
+            except OSError:
+                pass
+        return index
+
+    # Ranks may see different caches (e.g. node-local disks); build unless all of them loaded one.
+    loaded = [None] * dist.get_world_size()
+    dist.all_gather_object(loaded, index is not None)
+    if all(loaded):
+        return index
+
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    record_paths, paths = ImageIndex.unique_paths(records, image_folder)
+    with ThreadPoolExecutor(num_workers) as executor:
+        shard = list(executor.map(lambda path: probe_image(path, compute_hash), paths[rank::world_size]))
+    shards = [None] * world_size
+    dist.all_gather_object(shards, shard)
+    probes = [None] * len(paths)
+    for r, shard in enumerate(shards):
+        probes[r::world_size] = shard
+    index = ImageIndex.from_probes(record_paths, paths, probes)
+    if rank == 0:
+        try:
+            index.save(index_path, signature)
+        except OSError:
+            pass
+    return index
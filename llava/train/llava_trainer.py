@@ -1,18 +1,28 @@
 import os
+import shutil
+import heapq
+import numpy as np
 import torch
 import torch.nn as nn
 
 from torch.utils.data import Sampler
 
-from transformers import Trainer
+from transformers import PreTrainedModel, Trainer, TrainerCallback
 from transformers.trainer import (
     is_sagemaker_mp_enabled,
     get_parameter_names,
     has_length,
     ALL_LAYERNORM_LAYERS,
+    OPTIMIZER_NAME,
+    SCHEDULER_NAME,
+    TRAINING_ARGS_NAME,
     logger,
 )
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Union
+
+from llava.train.async_checkpoint import AsyncCheckpointWriter, AsyncCheckpointCallback, is_complete_checkpoint, \
+    list_checkpoints, save_safetensors_shards, save_torch
+from llava.train.step_profiler import StepProfiler, StepProfilerCallback
 
 
 def maybe_zero_3(param, ignore_status=False, name=None):
@@ -45,61 +55,77 @@ def split_to_even_chunks(indices, lengths, num_chunks):
 
     num_indices_per_chunk = len(indices) // num_chunks
 
+    # Min-heap of (total length, chunk index): ties go to the lowest chunk index,
+    # and full chunks are simply not pushed back.
     chunks = [[] for _ in range(num_chunks)]
-    chunks_lengths = [0 for _ in range(num_chunks)]
+    heap = [(0, i) for i in range(num_chunks)]
     for index in indices:
-        shortest_chunk = chunks_lengths.index(min(chunks_lengths))
+        chunk_length, shortest_chunk = heapq.heappop(heap)
         chunks[shortest_chunk].append(index)
-        chunks_lengths[shortest_chunk] += lengths[index]
-        if len(chunks[shortest_chunk]) == num_indices_per_chunk:
-            chunks_lengths[shortest_chunk] = float("inf")
+        if len(chunks[shortest_chunk]) < num_indices_per_chunk:
+            heapq.heappush(heap, (chunk_length + lengths[index], shortest_chunk))
 
     return chunks
 
 
 def get_modality_length_grouped_indices(lengths, batch_size, world_size, generator=None):
     # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    assert all(l != 0 for l in lengths), "Should not have zero length."
-    if all(l > 0 for l in lengths) or all(l < 0 for l in lengths):
+    lengths = np.asarray(lengths)
+    assert (lengths != 0).all(), "Should not have zero length."
+    if (lengths > 0).all() or (lengths < 0).all():
         # all samples are in the same modality
         return get_length_grouped_indices(lengths, batch_size, world_size, generator=generator)
-    mm_indices, mm_lengths = zip(*[(i, l) for i, l in enumerate(lengths) if l > 0])
-    lang_indices, lang_lengths = zip(*[(i, -l) for i, l in enumerate(lengths) if l < 0])
+    mm_indices = np.nonzero(lengths > 0)[0]
+    lang_indices = np.nonzero(lengths < 0)[0]
 
-    mm_shuffle = [mm_indices[i] for i in get_length_grouped_indices(mm_lengths, batch_size, world_size, generator=None)]
-    lang_shuffle = [lang_indices[i] for i in get_length_grouped_indices(lang_lengths, batch_size, world_size, generator=None)]
+    mm_shuffle = mm_indices[get_length_grouped_indices(lengths[mm_indices], batch_size, world_size, generator=generator)]
+    lang_shuffle = lang_indices[get_length_grouped_indices(-lengths[lang_indices], batch_size, world_size, generator=generator)]
     megabatch_size = world_size * batch_size
     mm_megabatches = [mm_shuffle[i : i + megabatch_size] for i in range(0, len(mm_shuffle), megabatch_size)]
     lang_megabatches = [lang_shuffle[i : i + megabatch_size] for i in range(0, len(lang_shuffle), megabatch_size)]
 
     last_mm = mm_megabatches[-1]
     last_lang = lang_megabatches[-1]
-    additional_batch = last_mm + last_lang
+    additional_batch = np.concatenate([last_mm, last_lang])
     megabatches = mm_megabatches[:-1] + lang_megabatches[:-1]
-    megabatch_indices = torch.randperm(len(megabatches), generator=generator)
+    megabatch_indices = torch.randperm(len(megabatches), generator=generator).numpy()
     megabatches = [megabatches[i] for i in megabatch_indices]
 
     if len(additional_batch) > 0:
-        megabatches.append(sorted(additional_batch))
+        megabatches.append(np.sort(additional_batch))
 
-    return [i for megabatch in megabatches for i in megabatch]
+    if len(megabatches) == 0:
+        return []
+    return np.concatenate(megabatches).tolist()
 
 
 def get_length_grouped_indices(lengths, batch_size, world_size, generator=None, merge=True):
     # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    indices = torch.randperm(len(lengths), generator=generator)
+    lengths = np.asarray(lengths)
+    indices = torch.randperm(len(lengths), generator=generator).numpy()
     megabatch_size = world_size * batch_size
-    megabatches = [indices[i : i + megabatch_size].tolist() for i in range(0, len(lengths), megabatch_size)]
-    megabatches = [sorted(megabatch, key=lambda i: lengths[i], reverse=True) for megabatch in megabatches]
-    megabatches = [split_to_even_chunks(megabatch, lengths, world_size) for megabatch in megabatches]
 
-    return [i for megabatch in megabatches for batch in megabatch for i in batch]
+    # Sort every megabatch by decreasing length in one stable lexsort, which keeps
+    # the original order of equal lengths like `sorted(..., reverse=True)` does.
+    megabatch_ids = np.arange(len(indices)) // megabatch_size
+    indices = indices[np.lexsort((-lengths[indices], megabatch_ids))]
+    if world_size == 1:
+        return indices.tolist()
+
+    indices = indices.tolist()
+    lengths = lengths.tolist()
+    return [i for start in range(0, len(indices), megabatch_size)
+            for batch in split_to_even_chunks(indices[start : start + megabatch_size], lengths, world_size)
+            for i in batch]
 
 
 class LengthGroupedSampler(Sampler):
     r"""
     Sampler that samples indices in a way that groups together features of the dataset of roughly the same length while
     keeping a bit of randomness.
+
+    With a `seed`, the order only depends on the seed, the epoch and `world_size`, and `fast_forward` jumps to any
+    global step without iterating (or loading) the skipped samples.
     """
 
     def __init__(
@@ -109,6 +135,7 @@ def __init__(
         lengths: Optional[List[int]] = None,
         generator=None,
         group_by_modality: bool = False,
+        seed: Optional[int] = None,
     ):
         if lengths is None:
             raise ValueError("Lengths must be provided.")
@@ -118,32 +145,136 @@ def __init__(
         self.lengths = lengths
         self.generator = generator
         self.group_by_modality = group_by_modality
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
 
     def __len__(self):
-        return len(self.lengths)
+        return len(self.lengths) - self.start_index
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def fast_forward(self, global_step: int, steps_per_epoch: Optional[int] = None):
+        """
+        Resume the next `__iter__` at `global_step`, given `batch_size * world_size` samples per step. Pass the
+        trainer's `steps_per_epoch` so the epoch matches the one it passes to `set_epoch`.
+        """
+        samples_per_step = self.batch_size * self.world_size
+        if steps_per_epoch is None:
+            steps_per_epoch = max(len(self.lengths) // samples_per_step, 1)
+        self.epoch, step = divmod(global_step, steps_per_epoch)
+        self.start_index = min(step * samples_per_step, len(self.lengths))
 
     def __iter__(self):
+        generator = self.generator
+        if self.seed is not None:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
         if self.group_by_modality:
-            indices = get_modality_length_grouped_indices(self.lengths, self.batch_size, self.world_size, generator=self.generator)
+            indices = get_modality_length_grouped_indices(self.lengths, self.batch_size, self.world_size, generator=generator)
         else:
-            indices = get_length_grouped_indices(self.lengths, self.batch_size, self.world_size, generator=self.generator)
-        return iter(indices)
+            indices = get_length_grouped_indices(self.lengths, self.batch_size, self.world_size, generator=generator)
+        start_index, self.start_index = self.start_index, 0
+        return iter(indices[start_index:])
+
+
+class SamplerFastForwardCallback(TrainerCallback):
+    """
+    Fast-forwards the trainer's `LengthGroupedSampler` to `state.global_step` when a resumed run starts, in place of
+    the Trainer iterating over the already trained batches (`LLaVATrainer.train` sets `ignore_data_skip` for the run).
+    """
+
+    def __init__(self, trainer):
+        self.trainer = trainer
+
+    def on_train_begin(self, args, state, control, train_dataloader=None, **kwargs):
+        sampler = self.trainer.length_grouped_sampler
+        if (not self.trainer.fast_forward_sampler or sampler is None or state.global_step == 0
+                or train_dataloader is None):
+            return
+        # Same count the Trainer uses for `epochs_trained`
+        steps_per_epoch = max(len(train_dataloader) // args.gradient_accumulation_steps, 1)
+        sampler.fast_forward(state.global_step, steps_per_epoch)
 
 
 class LLaVATrainer(Trainer):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.step_profiler = None
+        step_profile_path = getattr(self.args, 'step_profile_path', None)
+        torch_profile_steps = getattr(self.args, 'torch_profile_steps', None)
+        if step_profile_path is not None or torch_profile_steps is not None:
+            self.step_profiler = StepProfiler(
+                output_path=step_profile_path if self.args.process_index == 0 else None,
+                interval=getattr(self.args, 'step_profile_interval', 10),
+                torch_profile_steps=torch_profile_steps,
+                torch_profile_dir=os.path.join(self.args.output_dir, 'torch_profile'),
+            )
+            self.step_profiler.attach(self.model)
+            self.add_callback(StepProfilerCallback(self.step_profiler))
+
+        self.checkpoint_writer = None
+        self._saving_checkpoint = False
+        self._mm_adapter_params = {}
+        if getattr(self.args, 'async_checkpoint', False):
+            if is_sagemaker_mp_enabled() or self.is_fsdp_enabled:
+                logger.warning("async_checkpoint is not supported with SageMaker MP or FSDP, saving synchronously.")
+            else:
+                self.checkpoint_writer = AsyncCheckpointWriter()
+                self.add_callback(AsyncCheckpointCallback(self.checkpoint_writer))
+
+        self.length_grouped_sampler = None
+        self.fast_forward_sampler = False
+        if self.args.group_by_modality_length:
+            self.add_callback(SamplerFastForwardCallback(self))
+
+    def train(self, resume_from_checkpoint=None, trial=None, ignore_keys_for_eval=None, **kwargs):
+        # An explicit `ignore_data_skip` means no skipping at all, so the sampler is not fast-forwarded either.
+        if not resume_from_checkpoint or not self.args.group_by_modality_length or self.args.ignore_data_skip:
+            return super().train(resume_from_checkpoint, trial, ignore_keys_for_eval, **kwargs)
+
+        # The sampler jumps straight to the resumed step, the Trainer must not skip the trained batches as well.
+        logger.warning("Resuming with group_by_modality_length: fast-forwarding the sampler and setting "
+                       "ignore_data_skip=True for this run.")
+        self.args.ignore_data_skip = True
+        self.fast_forward_sampler = True
+        try:
+            return super().train(resume_from_checkpoint, trial, ignore_keys_for_eval, **kwargs)
+        finally:
+            self.args.ignore_data_skip = False
+            self.fast_forward_sampler = False
+
+    def training_step(self, model: nn.Module, inputs: Dict[str, Union[torch.Tensor, Any]]) -> torch.Tensor:
+        if self.step_profiler is None:
+            return super().training_step(model, inputs)
+        self.step_profiler.on_microbatch_begin()
+        loss = super().training_step(model, inputs)
+        self.step_profiler.on_microbatch_end()
+        return loss
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        if self.step_profiler is None:
+            return super().compute_loss(model, inputs, return_outputs=return_outputs)
+        with self.step_profiler.phase('forward'):
+            return super().compute_loss(model, inputs, return_outputs=return_outputs)
+
     def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
         if self.train_dataset is None or not has_length(self.train_dataset):
             return None
 
         if self.args.group_by_modality_length:
             lengths = self.train_dataset.modality_lengths
-            return LengthGroupedSampler(
+            self.length_grouped_sampler = LengthGroupedSampler(
                 self.args.train_batch_size,
                 world_size=self.args.world_size * self.args.gradient_accumulation_steps,
                 lengths=lengths,
                 group_by_modality=True,
+                seed=self.args.data_seed if self.args.data_seed is not None else self.args.seed,
             )
+            return self.length_grouped_sampler
         else:
             return super()._get_train_sampler()
 
@@ -227,29 +358,113 @@ def create_optimizer(self):
 
         return self.optimizer
 
+    def get_mm_adapter_params(self, keys_to_match):
+        """Named parameters matching `keys_to_match`, looked up once and cached."""
+        keys_to_match = tuple(keys_to_match)
+        if keys_to_match not in self._mm_adapter_params:
+            self._mm_adapter_params[keys_to_match] = [
+                (k, t) for k, t in self.model.named_parameters() if any(key_match in k for key_match in keys_to_match)
+            ]
+        return self._mm_adapter_params[keys_to_match]
+
+    def wait_for_checkpoints(self):
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait()
+
+    def _async_model_save_enabled(self):
+        return self.checkpoint_writer is not None and self._saving_checkpoint and isinstance(self.model, PreTrainedModel)
+
     def _save_checkpoint(self, model, trial, metrics=None):
-        if getattr(self.args, 'tune_mm_mlp_adapter', False):
-            from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
-            checkpoint_folder = f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}"
+        from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+        checkpoint_folder = f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}"
+
+        run_dir = self._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, checkpoint_folder)
 
-            run_dir = self._get_output_dir(trial=trial)
-            output_dir = os.path.join(run_dir, checkpoint_folder)
+        # Bound host memory to one snapshot, and keep checkpoint rotation behind the previous writes.
+        self.wait_for_checkpoints()
 
+        if getattr(self.args, 'tune_mm_mlp_adapter', False):
             # Only save Adapter
             keys_to_match = ['mm_projector', 'vision_resampler']
             if getattr(self.args, "use_im_start_end", False):
                 keys_to_match.extend(['embed_tokens', 'embed_in'])
 
-            weight_to_save = get_mm_adapter_state_maybe_zero_3(self.model.named_parameters(), keys_to_match)
+            named_params = self.get_mm_adapter_params(keys_to_match)
+            if self.checkpoint_writer is not None and not any(hasattr(t, "ds_id") for _, t in named_params):
+                if self.args.should_save:
+                    weight_to_save = self.checkpoint_writer.snapshot(dict(named_params))
+                    self.model.config.save_pretrained(output_dir)
+                    self.checkpoint_writer.submit(output_dir, lambda target_dir: save_torch(weight_to_save, target_dir, 'mm_projector.bin'))
+            else:
+                weight_to_save = get_mm_adapter_state_maybe_zero_3(named_params, keys_to_match)
 
-            if self.args.local_rank == 0 or self.args.local_rank == -1:
-                self.model.config.save_pretrained(output_dir)
-                torch.save(weight_to_save, os.path.join(output_dir, f'mm_projector.bin'))
+                if self.args.local_rank == 0 or self.args.local_rank == -1:
+                    self.model.config.save_pretrained(output_dir)
+                    torch.save(weight_to_save, os.path.join(output_dir, f'mm_projector.bin'))
+
+            if self.args.should_save:
+                self._rotate_checkpoints(use_mtime=False, output_dir=run_dir)
         else:
-            super(LLaVATrainer, self)._save_checkpoint(model, trial, metrics)
+            self._saving_checkpoint = True
+            try:
+                super(LLaVATrainer, self)._save_checkpoint(model, trial, metrics)
+            finally:
+                self._saving_checkpoint = False
+
+        if self.checkpoint_writer is not None and self.args.should_save:
+            self.checkpoint_writer.finalize(output_dir)
+
+    def _rotate_checkpoints(self, use_mtime=False, output_dir=None) -> None:
+        if self.checkpoint_writer is not None and self.args.should_save:
+            # Earlier writes were waited for, so a checkpoint other than the one being saved that has no manifest
+            # was left incomplete by a crash; remove it so it is neither kept nor counted.
+            run_dir = output_dir if output_dir is not None else self.args.output_dir
+            for step, path in list_checkpoints(run_dir):
+                if step != self.state.global_step and not is_complete_checkpoint(path):
+                    logger.warning(f"Deleting incomplete checkpoint [{path}]")
+                    shutil.rmtree(path, ignore_errors=True)
+        super(LLaVATrainer, self)._rotate_checkpoints(use_mtime=use_mtime, output_dir=output_dir)
 
     def _save(self, output_dir: Optional[str] = None, state_dict=None):
         if getattr(self.args, 'tune_mm_mlp_adapter', False):
             pass
+        elif self._async_model_save_enabled() and (state_dict is None or len(state_dict) > 0):
+            # Under DeepSpeed `state_dict` is already gathered by `save_model`; an empty one means the engine
+            # could not gather ZeRO-3 weights and writes its own checkpoint instead.
+            output_dir = output_dir if output_dir is not None else self.args.output_dir
+            os.makedirs(output_dir, exist_ok=True)
+            if state_dict is None:
+                state_dict = self.model.state_dict()
+
+            # Tied weights share storage and are written once, as in `save_pretrained`.
+            seen, unique_state_dict = set(), {}
+            for k, t in state_dict.items():
+                ptr = (t.device, t.data_ptr(), t.shape)
+                if t.numel() > 0 and ptr in seen:
+                    continue
+                seen.add(ptr)
+                unique_state_dict[k] = t
+
+            weight_to_save = self.checkpoint_writer.snapshot(unique_state_dict)
+            max_shard_size = self.args.checkpoint_max_shard_size
+            self.checkpoint_writer.submit(output_dir, lambda target_dir: save_safetensors_shards(weight_to_save, target_dir, max_shard_size))
+
+            self.model.config.save_pretrained(output_dir)
+            if self.model.can_generate() and self.model.generation_config is not None:
+                self.model.generation_config.save_pretrained(output_dir)
+            if self.tokenizer is not None:
+                self.tokenizer.save_pretrained(output_dir)
+            torch.save(self.args, os.path.join(output_dir, TRAINING_ARGS_NAME))
         else:
             super(LLaVATrainer, self)._save(output_dir, state_dict)
+
+    def _save_optimizer_and_scheduler(self, output_dir):
+        # The DeepSpeed engine saves its partitioned optimizer and model states itself
+        if self.is_deepspeed_enabled or not self._async_model_save_enabled():
+            return super(LLaVATrainer, self)._save_optimizer_and_scheduler(output_dir)
+
+        if self.args.should_save:
+            optimizer_state = self.checkpoint_writer.snapshot(self.optimizer.state_dict())
+            self.checkpoint_writer.submit(output_dir, lambda target_dir: save_torch(optimizer_state, target_dir, OPTIMIZER_NAME))
+            torch.save(self.lr_scheduler.state_dict(), os.path.join(output_dir, SCHEDULER_NAME))
@@ -0,0 +1,147 @@
+import functools
+import math
+from dataclasses import dataclass, field
+from typing import List
+
+import torch
+from torch.utils.checkpoint import checkpoint
+from transformers import TrainerCallback
+
+from llava.model.llava_arch import LlavaMetaForCausalLM
+
+
+@dataclass
+class ActivationPlan:
+    """Which decoder layers to checkpoint (or offload) and the predicted activation memory in bytes."""
+    num_layers: int
+    layer_bytes: int
+    layer_checkpointed_bytes: int
+    budget_bytes: int
+    strategy: str = 'checkpoint'
+    layers: List[int] = field(default_factory=list)
+
+    @property
+    def predicted_bytes(self):
+        num_full = self.num_layers - len(self.layers)
+        # A checkpointed layer keeps only its input, but its activations are rebuilt
+        # in full during its backward, one layer at a time.
+        recompute = self.layer_bytes if len(self.layers) > 0 and self.strategy == 'checkpoint' else 0
+        return num_full * self.layer_bytes + len(self.layers) * self.layer_checkpointed_bytes + recompute
+
+    def __str__(self):
+        return (f"ActivationPlan({self.strategy} {len(self.layers)}/{self.num_layers} layers, "
+                f"predicted {self.predicted_bytes / 2**30:.2f} GiB, budget {self.budget_bytes / 2**30:.2f} GiB)")
+
+
+def estimate_layer_activation_bytes(config, seq_len, micro_batch_size, dtype_bytes=2):
+    """
+    Estimate the activation memory saved for backward by one decoder layer.
+
+    Counts the tensors a LLaMA-style block keeps alive: norm inputs, q/k/v and
+    the rotary outputs, the attention output, and the SwiGLU gate/up/product.
+    Eager attention also keeps the (heads x seq x seq) scores and probabilities.
+    Flash and SDPA attention do not.
+
+    Returns:
+        tuple: (bytes for a regular layer, bytes for a checkpointed layer).
+    """
+    hidden = getattr(config, 'hidden_size', None) or getattr(config, 'd_model')
+    intermediate = getattr(config, 'intermediate_size', None) or getattr(config, 'expansion_ratio', 4) * hidden
+    num_heads = getattr(config, 'num_attention_heads', None) or getattr(config, 'n_heads')
+
+    tokens = seq_len * micro_batch_size
+    # RMSNorm upcasts its input to fp32, so the two norm inputs count twice.
+    per_token = 12 * hidden + 4 * intermediate
+    total = tokens * per_token * dtype_bytes
+    if getattr(config, '_attn_implementation', 'eager') == 'eager':
+        total += 2 * micro_batch_size * num_heads * seq_len * seq_len * dtype_bytes
+    return total, tokens * hidden * dtype_bytes
+
+
+def plan_activation_checkpointing(config, num_layers, seq_len, micro_batch_size, budget_bytes, dtype_bytes=2, strategy='checkpoint'):
+    """
+    Pick the fewest decoder layers to checkpoint (or offload) so the predicted
+    activation memory fits in `budget_bytes`.
+
+    The earliest layers are chosen, since their activations stay alive the longest.
+    If checkpointing every layer still exceeds the budget, every layer is selected.
+    """
+    layer_bytes, layer_checkpointed_bytes = estimate_layer_activation_bytes(config, seq_len, micro_batch_size, dtype_bytes)
+    if strategy == 'offload':
+        layer_checkpointed_bytes = 0
+
+    plan = ActivationPlan(num_layers, layer_bytes, layer_checkpointed_bytes, budget_bytes, strategy=strategy)
+    saved_per_layer = layer_bytes - layer_checkpointed_bytes
+    excess = num_layers * layer_bytes - budget_bytes
+    if excess <= 0 or saved_per_layer <= 0:
+        return plan
+
+    num_selected = math.ceil(excess / saved_per_layer)
+    if strategy == 'checkpoint':
+        # Recomputing a checkpointed layer rematerializes one full layer.
+        num_selected = math.ceil((excess + layer_bytes) / saved_per_layer)
+    plan.layers = list(range(min(num_selected, num_layers)))
+    return plan
+
+
+def get_decoder_layers(model):
+    base_model = next((m for m in model.modules() if isinstance(m, LlavaMetaForCausalLM)), None)
+    inner = base_model.get_model() if base_model is not None else getattr(model, 'model', model)
+    layers = getattr(inner, 'layers', None)
+    if layers is None:
+        layers = getattr(inner, 'blocks', None)
+    if layers is None:
+        raise ValueError(f'Cannot find decoder layers in {type(inner).__name__}')
+    return layers
+
+
+def _checkpointed_forward(layer, forward):
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        if layer.training and torch.is_grad_enabled():
+            return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+        return forward(*args, **kwargs)
+    return wrapper
+
+
+def _offloaded_forward(layer, forward):
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        if layer.training and torch.is_grad_enabled():
+            with torch.autograd.graph.save_on_cpu(pin_memory=torch.cuda.is_available()):
+                return forward(*args, **kwargs)
+        return forward(*args, **kwargs)
+    return wrapper
+
+
+def apply_activation_plan(model, plan):
+    """Wrap the planned decoder layers with non-reentrant checkpointing or pinned-CPU activation offload."""
+    layers = get_decoder_layers(model)
+    wrap = _offloaded_forward if plan.strategy == 'offload' else _checkpointed_forward
+    for idx in plan.layers:
+        layers[idx].forward = wrap(layers[idx], layers[idx].forward)
+    return model
+
+
+class ActivationMemoryReportCallback(TrainerCallback):
+    """Log predicted against measured activation peak after the first optimizer step this process runs."""
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.baseline = None
+        self.reported = False
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        if self.baseline is None and torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+            self.baseline = torch.cuda.memory_allocated()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        # Keyed on this process, not `global_step`, so resumed runs report too
+        if self.baseline is None or self.reported:
+            return
+        self.reported = True
+        measured = torch.cuda.max_memory_allocated() - self.baseline
+        if args.local_rank in (0, -1):
+            print(f"{self.plan}: measured activation peak {measured / 2**30:.2f} GiB "
+                  f"(includes gradients and optimizer temporaries)")
@@ -0,0 +1,244 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import torch
+from transformers import TrainerCallback
+
+from llava.constants import IMAGE_TOKEN_INDEX
+from llava.model.llava_arch import LlavaMetaForCausalLM
+
+
+class StepProfiler:
+    """
+    Lightweight per-step phase timer for LLaVA training.
+
+    Phases are timed with CUDA events (or `time.perf_counter` on CPU) and wrapped
+    in NVTX ranges so they show up by name in Nsight traces. Timers are only
+    recorded on every `interval`-th optimizer step and resolved once at the end of
+    that step, so unsampled steps pay nothing but the NVTX push/pop.
+
+    Reported phases:
+        data_wait:          host time spent outside training_step before each micro-batch (dataloader,
+                            plus logging and checkpointing when they fall on the step).
+        prepare_multimodal: `prepare_inputs_labels_for_multimodal`, including the vision tower.
+        vision_tower:       the frozen vision encoder.
+        mm_projector:       the vision-language projector.
+        forward:            the whole forward pass and loss; the LLM share is forward - prepare_multimodal.
+        backward:           training_step - forward; includes DeepSpeed gradient reduction that overlaps backward.
+        optimizer:          from the last micro-batch to the end of the step (clipping, optimizer, scheduler,
+                            and DeepSpeed communication at the accumulation boundary).
+    """
+
+    def __init__(self, output_path=None, interval=10, torch_profile_steps=None, torch_profile_dir=None, enabled=True):
+        self.output_path = output_path
+        self.interval = max(1, interval)
+        self.enabled = enabled
+        self.use_cuda = torch.cuda.is_available()
+
+        self.torch_profile_window = None
+        if torch_profile_steps:
+            start, end = (int(x) for x in torch_profile_steps.split(','))
+            self.torch_profile_window = (start, end)
+        self.torch_profile_dir = torch_profile_dir
+        self.torch_profiler = None
+
+        self.sampled = False
+        self.step = 0
+        self._open = {}
+        self._active = set()
+        self._timers = []
+        self._counters = []
+        self._data_wait = 0.0
+        self._last_host_mark = None
+        self._file = None
+        if self.enabled and self.output_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.output_path)), exist_ok=True)
+            self._file = open(self.output_path, 'a', buffering=1)
+
+    def _mark(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    @staticmethod
+    def _elapsed_ms(start, end):
+        if isinstance(start, float):
+            return (end - start) * 1000
+        return start.elapsed_time(end)
+
+    def start(self, name):
+        if name in self._active:
+            return
+        self._active.add(name)
+        if self.use_cuda:
+            torch.cuda.nvtx.range_push(name)
+        if self.sampled:
+            self._open[name] = self._mark()
+
+    def stop(self, name):
+        if name not in self._active:
+            return
+        self._active.remove(name)
+        if self.sampled and name in self._open:
+            self._timers.append((name, self._open.pop(name), self._mark()))
+        if self.use_cuda:
+            torch.cuda.nvtx.range_pop()
+
+    def cancel(self, name):
+        if name not in self._active:
+            return
+        self._active.remove(name)
+        self._open.pop(name, None)
+        if self.use_cuda:
+            torch.cuda.nvtx.range_pop()
+
+    @contextmanager
+    def phase(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def attach(self, model):
+        """Time the multimodal preparation, vision tower and projector of `model` (unwrapping PEFT if needed)."""
+        base_model = next((m for m in model.modules() if isinstance(m, LlavaMetaForCausalLM)), None)
+        if base_model is None:
+            return
+
+        prepare_fn = base_model.prepare_inputs_labels_for_multimodal
+
+        def prepare_inputs_labels_for_multimodal(input_ids, position_ids, attention_mask, *args, **kwargs):
+            with self.phase('prepare_multimodal'):
+                outputs = prepare_fn(input_ids, position_ids, attention_mask, *args, **kwargs)
+            if self.sampled and base_model.training and outputs[4] is not None:
+                self._count_tokens(input_ids, attention_mask, outputs[2], outputs[4])
+            return outputs
+
+        base_model.prepare_inputs_labels_for_multimodal = prepare_inputs_labels_for_multimodal
+
+        def register(module, name):
+            if module is None or not isinstance(module, torch.nn.Module):
+                return
+            module.register_forward_pre_hook(lambda *_: self.start(name))
+            module.register_forward_hook(lambda *_: self.stop(name))
+
+        register(base_model.get_vision_tower(), 'vision_tower')
+        register(getattr(base_model.get_model(), 'mm_projector', None), 'mm_projector')
+
+    def _count_tokens(self, input_ids, attention_mask, new_attention_mask, new_input_embeds):
+        # Kept as tensors and resolved at the end of the step to avoid host syncs.
+        if attention_mask is None:
+            text_tokens = (input_ids != IMAGE_TOKEN_INDEX).sum()
+        else:
+            text_tokens = ((input_ids != IMAGE_TOKEN_INDEX) & attention_mask.bool()).sum()
+        batch_size, padded_len = new_input_embeds.shape[:2]
+        if new_attention_mask is None:
+            total_tokens = torch.tensor(batch_size * padded_len, device=new_input_embeds.device)
+        else:
+            total_tokens = new_attention_mask.sum()
+        self._counters.append((text_tokens, total_tokens, batch_size * padded_len))
+
+    def on_step_begin(self, step):
+        self.step = step
+        self.sampled = self.enabled and step % self.interval == 0
+        self._timers = []
+        self._counters = []
+        self._data_wait = 0.0
+        if self.sampled:
+            self._step_start = self._mark()
+
+        if self.torch_profile_window is not None and step == self.torch_profile_window[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(
+                activities=activities,
+                record_shapes=True,
+                with_stack=False,
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(self.torch_profile_dir),
+            )
+            self.torch_profiler.__enter__()
+
+    def on_microbatch_begin(self):
+        if self._last_host_mark is not None:
+            self._data_wait += time.perf_counter() - self._last_host_mark
+        # Only the gap after the last micro-batch of the step counts as optimizer time.
+        self.cancel('optimizer')
+        self.start('training_step')
+
+    def on_microbatch_end(self):
+        self.stop('training_step')
+        self.start('optimizer')
+        self._last_host_mark = time.perf_counter()
+
+    def on_step_end(self):
+        """Ends the step started by `on_step_begin`, which records its number."""
+        step = self.step
+        self.stop('optimizer')
+        self._last_host_mark = time.perf_counter()
+
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+            if step >= self.torch_profile_window[1]:
+                self.torch_profiler.__exit__(None, None, None)
+                self.torch_profiler = None
+
+        if not self.sampled:
+            return
+        step_end = self._mark()
+        if self.use_cuda:
+            step_end.synchronize()
+        self.sampled = False
+        step_ms = self._elapsed_ms(self._step_start, step_end)
+
+        record = {'step': step, 'time': time.time(), 'step_ms': step_ms, 'data_wait_ms': self._data_wait * 1000}
+        phases = {}
+        for name, start, end in self._timers:
+            phases[name] = phases.get(name, 0.0) + self._elapsed_ms(start, end)
+        if 'training_step' in phases:
+            phases['backward'] = phases.pop('training_step') - phases.get('forward', 0.0)
+        record.update({f'{name}_ms': value for name, value in phases.items()})
+
+        if len(self._counters) > 0:
+            text_tokens = sum(int(x[0]) for x in self._counters)
+            total_tokens = sum(int(x[1]) for x in self._counters)
+            padded_tokens = sum(x[2] for x in self._counters)
+            seconds = max(step_ms / 1000, 1e-9)
+            record.update({
+                'tokens_per_sec': total_tokens / seconds,
+                'text_tokens_per_sec': text_tokens / seconds,
+                'image_tokens_per_sec': (total_tokens - text_tokens) / seconds,
+                'padding_ratio': 1 - total_tokens / max(padded_tokens, 1),
+            })
+
+        if self._file is not None:
+            self._file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self.torch_profiler is not None:
+            self.torch_profiler.__exit__(None, None, None)
+            self.torch_profiler = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class StepProfilerCallback(TrainerCallback):
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self.profiler.on_step_begin(state.global_step)
+
+    def on_step_end(self, args, state, control, **kwargs):
+        # `state.global_step` is already incremented here, the step number is kept from `on_step_begin`
+        self.profiler.on_step_end()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.profiler.close()
@@ -22,6 +22,7 @@
 import pathlib
 from typing import Dict, Optional, Sequence, List
 
+import numpy as np
 import torch
 
 import transformers
@@ -31,10 +32,15 @@
     DEFAULT_IM_END_TOKEN
 from torch.utils.data import Dataset
 from llava.train.llava_trainer import LLaVATrainer
+from llava.train.memory_planner import plan_activation_checkpointing, apply_activation_plan, \
+    get_decoder_layers, ActivationMemoryReportCallback
 
 from llava import conversation as conversation_lib
-from llava.model import *
-from llava.mm_utils import tokenizer_image_token
+from llava.model import LlavaLlamaForCausalLM
+from llava.mm_utils import tokenizer_image_token, tokenizer_image_token_batch
+from llava.train.data_mixture import load_mixture_spec, MixtureRecords
+from llava.train.image_index import load_or_build_image_index, resolve_image_path
+from llava.train.async_checkpoint import last_complete_checkpoint
 
 from PIL import Image
 
@@ -70,11 +76,27 @@ class ModelArguments:
 @dataclass
 class DataArguments:
     data_path: str = field(default=None,
-                           metadata={"help": "Path to the training data."})
+                           metadata={"help": "Path to the training data, a JSON list or a `.jsonl` file with one record per line."})
     lazy_preprocess: bool = False
     is_multimodal: bool = False
-    image_folder: Optional[str] = field(default=None)
+    image_folder: Optional[str] = field(default=None,
+                                        metadata={"help": "Folder that relative image paths in the data are joined with; "
+                                                          "absolute paths are used as they are."})
     image_aspect_ratio: str = 'square'
+    data_mixture: Optional[str] = field(default=None,
+                                        metadata={"help": "Path to a YAML/JSON data mixture spec; replaces `data_path`."})
+    image_index: bool = field(default=False,
+                              metadata={"help": "Resolve and validate every image path before training and cache the "
+                                                "result as `<data_path>.images.npz`. Each image is stat'ed and its "
+                                                "header parsed, with the work split across ranks."})
+    image_index_path: Optional[str] = field(default=None)
+    image_index_hash: bool = field(default=False,
+                                   metadata={"help": "Also read every image and store its content hash in the image "
+                                                     "index."})
+    image_index_workers: int = 32
+    skip_missing_images: bool = field(default=False,
+                                      metadata={"help": "Drop samples whose image is missing or unreadable instead of "
+                                                        "failing before training."})
 
 
 @dataclass
@@ -111,6 +133,39 @@ class TrainingArguments(transformers.TrainingArguments):
     lora_bias: str = "none"
     mm_projector_lr: Optional[float] = None
     group_by_modality_length: bool = field(default=False)
+    step_profile_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "Write per-step phase timings, tokens/sec and padding ratio as JSONL to this file."}
+    )
+    step_profile_interval: int = field(
+        default=10,
+        metadata={"help": "Record step-phase timings every N optimizer steps."}
+    )
+    activation_memory_budget_gb: Optional[float] = field(
+        default=None,
+        metadata={"help": "Checkpoint only as many decoder layers as needed to fit activations in this budget (GiB). "
+                          "Replaces full `gradient_checkpointing`."}
+    )
+    activation_offload: bool = field(
+        default=False,
+        metadata={"help": "With `activation_memory_budget_gb`, offload the planned layers' activations to pinned CPU "
+                          "memory instead of recomputing them."}
+    )
+    torch_profile_steps: Optional[str] = field(
+        default=None,
+        metadata={"help": "Run torch.profiler for global steps `start,end`; traces go to `<output_dir>/torch_profile`."}
+    )
+    async_checkpoint: bool = field(
+        default=False,
+        metadata={"help": "Snapshot checkpoints to CPU memory and write them from a background thread. Under "
+                          "DeepSpeed only the consolidated model weights are written in the background; the engine's "
+                          "checkpoint (optimizer states and ZeRO partitions) is still saved synchronously, and with "
+                          "ZeRO-3 without `stage3_gather_16bit_weights_on_model_save` the option has no effect."}
+    )
+    checkpoint_max_shard_size: str = field(
+        default="5GB",
+        metadata={"help": "Maximum safetensors shard size for asynchronous checkpoints."}
+    )
 
 
 def maybe_zero_3(param, ignore_status=False, name=None):
@@ -186,6 +241,7 @@ def find_all_linear_names(model):
 def safe_save_model_for_hf_trainer(trainer: transformers.Trainer,
                                    output_dir: str):
     """Collects the state dict and dump to disk."""
+    trainer.wait_for_checkpoints()
 
     if getattr(trainer.args, "tune_mm_mlp_adapter", False):
         # Only save Adapter
@@ -193,7 +249,7 @@ def safe_save_model_for_hf_trainer(trainer: transformers.Trainer,
         if getattr(trainer.args, "use_im_start_end", False):
             keys_to_match.extend(['embed_tokens', 'embed_in'])
 
-        weight_to_save = get_mm_adapter_state_maybe_zero_3(trainer.model.named_parameters(), keys_to_match)
+        weight_to_save = get_mm_adapter_state_maybe_zero_3(trainer.get_mm_adapter_params(keys_to_match), keys_to_match)
         trainer.model.config.save_pretrained(output_dir)
 
         current_folder = output_dir.split('/')[-1]
@@ -356,8 +412,7 @@ def preprocess_llama_2(
     # Tokenize conversations
 
     if has_image:
-        input_ids = torch.stack(
-            [tokenizer_image_token(prompt, tokenizer, return_tensors='pt') for prompt in conversations], dim=0)
+        input_ids = tokenizer_image_token_batch(conversations, tokenizer, return_tensors='pt')['input_ids']
     else:
         input_ids = tokenizer(
             conversations,
@@ -439,8 +494,7 @@ def preprocess_v1(
     # Tokenize conversations
 
     if has_image:
-        input_ids = torch.stack(
-            [tokenizer_image_token(prompt, tokenizer, return_tensors='pt') for prompt in conversations], dim=0)
+        input_ids = tokenizer_image_token_batch(conversations, tokenizer, return_tensors='pt')['input_ids']
     else:
         input_ids = tokenizer(
             conversations,
@@ -526,8 +580,7 @@ def preprocess_mpt(
     # Tokenize conversations
 
     if has_image:
-        input_ids = torch.stack(
-            [tokenizer_image_token(prompt, tokenizer, return_tensors='pt') for prompt in conversations], dim=0)
+        input_ids = tokenizer_image_token_batch(conversations, tokenizer, return_tensors='pt')['input_ids']
     else:
         input_ids = tokenizer(
             conversations,
@@ -668,13 +721,37 @@ def __init__(self, data_path: str,
                  tokenizer: transformers.PreTrainedTokenizer,
                  data_args: DataArguments):
         super(LazySupervisedDataset, self).__init__()
-        list_data_dict = json.load(open(data_path, "r"))
+        with open(data_path, "r") as f:
+            if data_path.endswith('.jsonl'):
+                list_data_dict = [json.loads(line) for line in f if line.strip()]
+            else:
+                list_data_dict = json.load(f)
 
         rank0_print("Formatting inputs...Skip in lazy mode")
         self.tokenizer = tokenizer
         self.list_data_dict = list_data_dict
         self.data_args = data_args
 
+        self.image_index = None
+        if data_args.image_index and any('image' in sample for sample in list_data_dict):
+            self.image_index = load_or_build_image_index(
+                list_data_dict, data_path,
+                image_folder=data_args.image_folder,
+                index_path=data_args.image_index_path,
+                num_workers=data_args.image_index_workers,
+                compute_hash=data_args.image_index_hash,
+            )
+            missing = self.image_index.missing_records()
+            if len(missing) > 0:
+                examples = ", ".join(self.image_index.image_path(i) for i in missing[:5])
+                if not data_args.skip_missing_images:
+                    raise ValueError(f"{len(missing)} samples have missing or unreadable images, e.g. {examples}. "
+                                     f"Pass --skip_missing_images to drop them.")
+                rank0_print(f"Dropping {len(missing)} samples with missing or unreadable images, e.g. {examples}")
+                keep = np.setdiff1d(np.arange(len(list_data_dict)), missing)
+                self.list_data_dict = [list_data_dict[i] for i in keep]
+                self.image_index.select(keep)
+
     def __len__(self):
         return len(self.list_data_dict)
 
@@ -696,18 +773,18 @@ def modality_lengths(self):
         return length_list
 
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
-        sources = self.list_data_dict[i]
+        record = self.list_data_dict[i]
+        sources = record
         if isinstance(i, int):
             sources = [sources]
         assert len(sources) == 1, "Don't know why it is wrapped to a list"  # FIXME
         if 'image' in sources[0]:
-            image_file = self.list_data_dict[i]['image']
-            image_folder = self.data_args.image_folder
             processor = self.data_args.image_processor
-            cleaned_path = image_file.strip('", ')
-            # 2. 强制转换为绝对路径（无论原始路径是相对还是绝对）
-            absolute_path = os.path.abspath(cleaned_path)
-            image = Image.open(absolute_path).convert('RGB')
+            if self.image_index is not None:
+                image_path = self.image_index.image_path(i)
+            else:
+                image_path = resolve_image_path(record['image'], self.data_args.image_folder)
+            image = Image.open(image_path).convert('RGB')
             if self.data_args.image_aspect_ratio == 'pad':
                 def expand2square(pil_img, background_color):
                     width, height = pil_img.size
@@ -734,13 +811,13 @@ def expand2square(pil_img, background_color):
         data_dict = preprocess(
             sources,
             self.tokenizer,
-            has_image=('image' in self.list_data_dict[i]))
+            has_image=('image' in record))
         if isinstance(i, int):
             data_dict = dict(input_ids=data_dict["input_ids"][0],
                              labels=data_dict["labels"][0])
 
         # image exist in the data
-        if 'image' in self.list_data_dict[i]:
+        if 'image' in record:
             data_dict['image'] = image
         elif self.data_args.is_multimodal:
             # image does not exist in the data, but the model is multimodal
@@ -749,6 +826,38 @@ def expand2square(pil_img, background_color):
         return data_dict
 
 
+class MixtureSupervisedDataset(LazySupervisedDataset):
+    """Dataset for supervised fine-tuning on a weighted mixture of sources, see `llava.train.data_mixture`."""
+
+    def __init__(self, mixture_path: str,
+                 tokenizer: transformers.PreTrainedTokenizer,
+                 data_args: DataArguments):
+        Dataset.__init__(self)
+        sources, options = load_mixture_spec(mixture_path)
+        self.list_data_dict = MixtureRecords(
+            sources,
+            seed=options.get('seed', 42),
+            num_samples=options.get('num_samples'),
+            index_dir=options.get('index_dir'),
+        )
+        rank0_print(f"Data mixture: {len(self.list_data_dict)} samples from "
+                    + ", ".join(f"{x.source.name} ({len(x)})" for x in self.list_data_dict.sources))
+        self.tokenizer = tokenizer
+        self.data_args = data_args
+        # Mixture records carry paths already joined with their source's image folder.
+        self.image_index = None
+
+    @property
+    def lengths(self):
+        num_words, has_image = self.list_data_dict.num_words, self.list_data_dict.has_image
+        return (num_words + 128 * has_image).tolist()
+
+    @property
+    def modality_lengths(self):
+        num_words, has_image = self.list_data_dict.num_words, self.list_data_dict.has_image
+        return np.where(has_image, num_words, -num_words).tolist()
+
+
 @dataclass
 class DataCollatorForSupervisedDataset(object):
     """Collate examples for supervised fine-tuning."""
@@ -786,9 +895,14 @@ def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
 def make_supervised_data_module(tokenizer: transformers.PreTrainedTokenizer,
                                 data_args) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
-    train_dataset = LazySupervisedDataset(tokenizer=tokenizer,  # 通过LazySupervisedDataset类初始化训练数据：
-                                          data_path=data_args.data_path,  # llava_instruct_80k.json
-                                          data_args=data_args)
+    if data_args.data_mixture is not None:
+        train_dataset = MixtureSupervisedDataset(tokenizer=tokenizer,
+                                                 mixture_path=data_args.data_mixture,
+                                                 data_args=data_args)
+    else:
+        train_dataset = LazySupervisedDataset(tokenizer=tokenizer,  # 通过LazySupervisedDataset类初始化训练数据：
+                                              data_path=data_args.data_path,  # llava_instruct_80k.json
+                                              data_args=data_args)
     data_collator = DataCollatorForSupervisedDataset(
         tokenizer=tokenizer)  # 初始化DataCollatorForSupervisedDataset#负责将多个样本打包成批次（batch）。
     # 对文本序列进行填充（用[PAD]）和截断（按模型最大长度），确保批次内序列长度一致。
@@ -831,6 +945,7 @@ def train(attn_implementation=None):
     # Tokenizer 初始化
     if model_args.vision_tower is not None:  # 有东西，就是clip 14
         if 'mpt' in model_args.model_name_or_path:  # 这是Mpt 架构，现在不加载这个架构，
+            from llava.model import LlavaMptForCausalLM
             config = transformers.AutoConfig.from_pretrained(model_args.model_name_or_path, trust_remote_code=True)
             config.attn_config['attn_impl'] = training_args.mpt_attn_impl
             model = LlavaMptForCausalLM.from_pretrained(
@@ -861,6 +976,12 @@ def train(attn_implementation=None):
     if model_args.freeze_backbone:  # 目前是False是否冻结 LLM 主干网络，仅训练视觉 - 语言连接器等组件。
         model.model.requires_grad_(False)
 
+    # Before the k-bit preparation, which would otherwise turn on full
+    # checkpointing underneath the planner's own layers
+    if training_args.activation_memory_budget_gb is not None and training_args.gradient_checkpointing:
+        rank0_print("`activation_memory_budget_gb` is set, replacing full gradient checkpointing with the memory planner.")
+        training_args.gradient_checkpointing = False
+
     if training_args.bits in [4, 8]:  # training_args.bits 是16
         from peft import prepare_model_for_kbit_training
         model.config.torch_dtype = (
@@ -976,6 +1097,20 @@ def make_inputs_require_grad(module, input, output):
                 if hasattr(module, 'weight'):
                     if training_args.bf16 and module.weight.dtype == torch.float32:
                         module = module.to(torch.bfloat16)
+    activation_plan = None
+    if training_args.activation_memory_budget_gb is not None:
+        activation_plan = plan_activation_checkpointing(
+            model.config,
+            num_layers=len(get_decoder_layers(model)),
+            seq_len=training_args.model_max_length,
+            micro_batch_size=training_args.per_device_train_batch_size,
+            budget_bytes=int(training_args.activation_memory_budget_gb * 2**30),
+            dtype_bytes=2 if (training_args.bf16 or training_args.fp16) else 4,
+            strategy='offload' if training_args.activation_offload else 'checkpoint',
+        )
+        apply_activation_plan(model, activation_plan)
+        rank0_print(f"Planned activations: {activation_plan}, layers {activation_plan.layers}")
+
     # 数据模块准备
     data_module = make_supervised_data_module(tokenizer=tokenizer,
                                               data_args=data_args)
@@ -983,8 +1118,13 @@ def make_inputs_require_grad(module, input, output):
                            tokenizer=tokenizer,
                            args=training_args,
                            **data_module)
+    if activation_plan is not None:
+        trainer.add_callback(ActivationMemoryReportCallback(activation_plan))
 
-    if list(pathlib.Path(training_args.output_dir).glob("checkpoint-*")):  # 若输出目录存在 checkpoint，从断点恢复训练。
+    if training_args.async_checkpoint:
+        # Only resume from a checkpoint whose background writes all finished (it has a manifest).
+        trainer.train(resume_from_checkpoint=last_complete_checkpoint(training_args.output_dir))
+    elif list(pathlib.Path(training_args.output_dir).glob("checkpoint-*")):  # 若输出目录存在 checkpoint，从断点恢复训练。
         trainer.train(resume_from_checkpoint=True)
     else:
         trainer.train()
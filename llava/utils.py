@@ -1,8 +1,13 @@
+import atexit
 import datetime
+import json
 import logging
 import logging.handlers
 import os
+import queue
 import sys
+import threading
+import time
 
 import requests
 
@@ -12,20 +17,66 @@
 moderation_msg = "YOUR INPUT VIOLATES OUR CONTENT MODERATION GUIDELINES. PLEASE TRY AGAIN."
 
 handler = None
+listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including any `extra=` fields."""
+
+    _reserved = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({k: v for k, v in record.__dict__.items() if k not in self._reserved})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
 
 
 def build_logger(logger_name, logger_filename):
-    global handler
+    """
+    Loggers put records on an in-memory queue, and a background listener thread
+    writes them to the console and to `LOGDIR/logger_filename` (one JSON object
+    per line), so request threads never block on log I/O.
+    """
+    global handler, listener
 
     formatter = logging.Formatter(
         fmt="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
     )
 
-    # Set the format of root handlers
-    if not logging.getLogger().handlers:
-        logging.basicConfig(level=logging.INFO)
-    logging.getLogger().handlers[0].setFormatter(formatter)
+    if handler is None:
+        # Write the console to the real stderr, before it is redirected below
+        console_handler = logging.StreamHandler(sys.__stderr__)
+        console_handler.setFormatter(formatter)
+
+        os.makedirs(LOGDIR, exist_ok=True)
+        filename = os.path.join(LOGDIR, logger_filename)
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            filename, when='D', utc=True, encoding='UTF-8')
+        file_handler.setFormatter(JsonFormatter())
+
+        handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+        listener = logging.handlers.QueueListener(handler.queue, console_handler, file_handler)
+        listener.start()
+        atexit.register(listener.stop)
+
+        root = logging.getLogger()
+        for h in list(root.handlers):
+            root.removeHandler(h)
+        root.addHandler(handler)
+        root.setLevel(logging.INFO)
+
+        # Loggers that do not propagate to the root (e.g. uvicorn's) log to the file directly
+        for name, item in logging.root.manager.loggerDict.items():
+            if isinstance(item, logging.Logger) and not item.propagate:
+                item.addHandler(handler)
 
     # Redirect stdout and stderr to loggers
     stdout_logger = logging.getLogger("stdout")
@@ -42,18 +93,6 @@ def build_logger(logger_name, logger_filename):
     logger = logging.getLogger(logger_name)
     logger.setLevel(logging.INFO)
 
-    # Add a file handler for all loggers
-    if handler is None:
-        os.makedirs(LOGDIR, exist_ok=True)
-        filename = os.path.join(LOGDIR, logger_filename)
-        handler = logging.handlers.TimedRotatingFileHandler(
-            filename, when='D', utc=True, encoding='UTF-8')
-        handler.setFormatter(formatter)
-
-        for name, item in logging.root.manager.loggerDict.items():
-            if isinstance(item, logging.Logger):
-                item.addHandler(handler)
-
     return logger
 
 
@@ -62,7 +101,7 @@ class StreamToLogger(object):
     Fake file-like stream object that redirects writes to a logger instance.
     """
     def __init__(self, logger, log_level=logging.INFO):
-        self.terminal = sys.stdout
+        self.terminal = sys.__stdout__
         self.logger = logger
         self.log_level = log_level
         self.linebuf = ''
@@ -90,6 +129,34 @@ def flush(self):
         self.linebuf = ''
 
 
+class RateLimitedLog:
+    """
+    Log a hot-path message at most once per `interval` seconds per key, e.g. one
+    heart beat line per worker. The next line that gets through reports how many
+    were suppressed.
+    """
+    def __init__(self, logger, interval=60.0, level=logging.INFO):
+        self.logger = logger
+        self.interval = interval
+        self.level = level
+        self.state = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, key, msg, **extra):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        now = time.monotonic()
+        with self.lock:
+            last, suppressed = self.state.get(key, (None, 0))
+            if last is not None and now - last < self.interval:
+                self.state[key] = (last, suppressed + 1)
+                return
+            self.state[key] = (now, 0)
+        if suppressed > 0:
+            msg = f"{msg} ({suppressed} similar messages suppressed)"
+        self.logger.log(self.level, msg, extra=dict(extra, suppressed=suppressed))
+
+
 def disable_torch_init():
     """
     Disable the redundant torch default initialization to accelerate model creation.
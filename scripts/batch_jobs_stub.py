@@ -0,0 +1,151 @@
+"""
+Exercise the model worker's batch job scheduler with a stub model, without a GPU.
+
+A stub `run_jobs` sleeps `--call-latency` plus `--job-latency` per job and
+echoes the prompts. While a batch runs, simulated interactive requests arrive
+at `--interactive-rate` and go through the same admission controller. The
+script checks that every job is answered exactly once and in order, that a
+batch interrupted mid-way resumes without repeating jobs, and reports batch
+throughput and how long interactive requests waited for admission.
+
+Example:
+    python scripts/batch_jobs_stub.py --num-jobs 2000 --batch-size 32 --interactive-rate 10
+"""
+
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from llava.serve.admission import AdmissionController
+from llava.serve.batch_jobs import BatchJobManager
+
+
+class StubModel:
+    def __init__(self, args):
+        self.args = args
+        self.calls = []
+
+    def estimate_tokens(self, job):
+        return len(job["prompt"].split()) + 576 * len(job["images"] + job["image_files"])
+
+    def run_jobs(self, jobs):
+        self.calls.append(len(jobs))
+        time.sleep(self.args.call_latency + self.args.job_latency * len(jobs))
+        return [{"text": f"caption of {job['custom_id']}", "finish_reason": "eos",
+                 "num_prompt_tokens": self.estimate_tokens(job), "num_generated_tokens": 8} for job in jobs]
+
+
+def make_jobs(num_jobs, seed):
+    rng = random.Random(seed)
+    return [{"custom_id": f"frame-{i:06d}",
+             "body": {"prompt": "Describe the surgical phase in this frame " * rng.randint(1, 4),
+                      "image": f"video01/{i:06d}.png", "max_new_tokens": 32}}
+            for i in range(num_jobs)]
+
+
+async def interactive_traffic(admission, args, waits, stop):
+    rng = random.Random(args.seed + 1)
+
+    async def one_request():
+        start = time.perf_counter()
+        ticket = await admission.acquire(rng.randint(600, 1200))
+        waits.append(time.perf_counter() - start)
+        await asyncio.sleep(args.interactive_latency)
+        admission.release(ticket)
+
+    tasks = []
+    while not stop.is_set():
+        await asyncio.sleep(rng.expovariate(args.interactive_rate))
+        tasks.append(asyncio.create_task(one_request()))
+    await asyncio.gather(*tasks)
+
+
+async def wait_for(manager, batch_id, status=("completed", "failed", "cancelled"), min_done=None):
+    while True:
+        info = manager.get(batch_id)
+        counts = info["request_counts"]
+        if info["status"] in status or (min_done is not None and counts["completed"] + counts["failed"] >= min_done):
+            return info
+        await asyncio.sleep(0.01)
+
+
+def read_custom_ids(path):
+    with open(path) as f:
+        return [json.loads(line)["custom_id"] for line in f]
+
+
+async def run(args, storage_dir):
+    admission = AdmissionController(args.max_inflight_tokens, max_concurrency=args.max_concurrency)
+    model = StubModel(args)
+    manager = BatchJobManager(storage_dir, model.run_jobs, model.estimate_tokens, admission,
+                              max_batch_size=args.batch_size, idle_interval=0.01)
+    task = asyncio.create_task(manager.run())
+
+    # Throughput with interactive traffic arriving meanwhile
+    jobs = make_jobs(args.num_jobs, args.seed)
+    start = time.perf_counter()
+    options = {"conv_mode": "llava_v1", "image_folder": "/data/cholec80/frames"}
+    info = await manager.create(jobs, options)
+    waits, stop = [], asyncio.Event()
+    traffic = asyncio.create_task(interactive_traffic(admission, args, waits, stop))
+    info = await wait_for(manager, info["id"])
+    duration = time.perf_counter() - start
+    stop.set()
+    await traffic
+    assert info["status"] == "completed", info
+    assert read_custom_ids(info["output_file"]) == [job["custom_id"] for job in jobs]
+
+    # Interrupt a batch and resume it with a new manager on the same directory
+    resume_jobs = make_jobs(args.num_jobs // 4, args.seed + 2)
+    resumed = await manager.create(resume_jobs, options)
+    await wait_for(manager, resumed["id"], min_done=len(resume_jobs) // 2)
+    task.cancel()
+    done_before_restart = manager.get(resumed["id"])["request_counts"]["completed"]
+    manager = BatchJobManager(storage_dir, model.run_jobs, model.estimate_tokens, admission,
+                              max_batch_size=args.batch_size, idle_interval=0.01)
+    task = asyncio.create_task(manager.run())
+    resumed = await wait_for(manager, resumed["id"])
+    assert read_custom_ids(resumed["output_file"]) == [job["custom_id"] for job in resume_jobs]
+
+    # Cancel before anything runs
+    cancelled = await manager.create(make_jobs(10, args.seed + 3), options)
+    cancelled = manager.cancel(cancelled["id"])
+    task.cancel()
+
+    return {
+        "num_jobs": args.num_jobs,
+        "duration_s": duration,
+        "jobs_per_second": args.num_jobs / duration,
+        "num_calls": len(model.calls),
+        "mean_batch_size": sum(model.calls) / len(model.calls),
+        "interactive_requests": len(waits),
+        "interactive_wait_mean_s": sum(waits) / max(len(waits), 1),
+        "interactive_wait_max_s": max(waits, default=0.0),
+        "resumed_after_jobs": done_before_restart,
+        "cancelled_status": cancelled["status"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-jobs", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--call-latency", type=float, default=0.02, help="seconds per stub generate call")
+    parser.add_argument("--job-latency", type=float, default=0.001, help="extra seconds per job in a call")
+    parser.add_argument("--interactive-rate", type=float, default=10.0, help="interactive requests per second")
+    parser.add_argument("--interactive-latency", type=float, default=0.05, help="seconds per interactive request")
+    parser.add_argument("--max-inflight-tokens", type=int, default=5 * 2048 * 4)
+    parser.add_argument("--max-concurrency", type=int, default=5)
+    parser.add_argument("--storage-dir", type=str, default=None, help="defaults to a temporary directory")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        summary = asyncio.run(run(args, args.storage_dir or os.path.join(tmp, "batches")))
+    sys.__stdout__.write(json.dumps(summary, indent=2) + "\n")
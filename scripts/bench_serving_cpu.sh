@@ -0,0 +1,35 @@
+#!/bin/bash
+# Smoke-test and benchmark the serving stack on CPU with a tiny random-weight model.
+# Usage: bash scripts/bench_serving_cpu.sh [output.json]
+
+set -e
+
+OUTPUT=${1:-./bench_serving_cpu.json}
+MODEL_DIR=./checkpoints/llava-tiny-random
+CONTROLLER=http://localhost:21001
+WORKER=http://localhost:21002
+
+if [ ! -f $MODEL_DIR/serving_snapshot.json ]; then
+    python -m llava.serve.tiny_model --output-dir $MODEL_DIR
+fi
+
+python -m llava.serve.controller --host localhost --port 21001 &
+CONTROLLER_PID=$!
+trap "kill $CONTROLLER_PID \$WORKER_PID 2>/dev/null" EXIT
+sleep 5
+
+python -m llava.serve.model_worker --host localhost --port 21002 \
+    --controller-address $CONTROLLER --worker-address $WORKER \
+    --model-path $MODEL_DIR --device cpu &
+WORKER_PID=$!
+
+for i in $(seq 1 120); do
+    if curl -s -X POST $CONTROLLER/list_models | grep -q llava-tiny-random; then
+        break
+    fi
+    sleep 1
+done
+
+python -m llava.serve.bench --controller-address $CONTROLLER --model-name llava-tiny-random \
+    --num-requests 32 --request-rate 4 --num-images 0-1 --prompt-len 8-32 --max-new-tokens 16-64 \
+    --image-size 56 --tokenizer $MODEL_DIR --output $OUTPUT
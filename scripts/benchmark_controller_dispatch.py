@@ -0,0 +1,95 @@
+"""
+Measure controller dispatch decisions per second for both dispatch methods,
+against the previous implementation that rescanned every worker and built
+NumPy arrays on each request.
+
+Example:
+    python scripts/benchmark_controller_dispatch.py --num-models 8 --workers-per-model 64
+"""
+
+
+import argparse
+import logging
+import random
+import sys
+import time
+
+import numpy as np
+
+
+def scan_dispatch(worker_info, model_name, method):
+    """The per-request scan `Controller.get_worker_address` used to do."""
+    if method == "lottery":
+        worker_names, worker_speeds = [], []
+        for w_name, w_info in worker_info.items():
+            if model_name in w_info.model_names:
+                worker_names.append(w_name)
+                worker_speeds.append(w_info.speed)
+        worker_speeds = np.array(worker_speeds, dtype=np.float32)
+        norm = np.sum(worker_speeds)
+        if norm < 1e-4:
+            return ""
+        worker_speeds = worker_speeds / norm
+        return worker_names[np.random.choice(np.arange(len(worker_names)), p=worker_speeds)]
+    worker_names, worker_qlen = [], []
+    for w_name, w_info in worker_info.items():
+        if model_name in w_info.model_names:
+            worker_names.append(w_name)
+            worker_qlen.append(w_info.queue_length / w_info.speed)
+    if len(worker_names) == 0:
+        return ""
+    w_name = worker_names[np.argmin(worker_qlen)]
+    worker_info[w_name].queue_length += 1
+    return w_name
+
+
+def rate(fn, models, num_requests):
+    start = time.perf_counter()
+    for i in range(num_requests):
+        fn(models[i % len(models)])
+    return num_requests / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-models", type=int, default=8)
+    parser.add_argument("--workers-per-model", type=int, default=64)
+    parser.add_argument("--num-requests", type=int, default=50000)
+    parser.add_argument("--heart-beat-every", type=int, default=16,
+                        help="interleave one heart beat per this many dispatches")
+    args = parser.parse_args()
+
+    from llava.serve.controller import Controller
+
+    logging.disable(logging.CRITICAL)
+    models = [f"model-{i}" for i in range(args.num_models)]
+    rows = []
+    for method in ("lottery", "shortest_queue"):
+        controller = Controller(method)
+        rng = random.Random(0)
+        for m, model_name in enumerate(models):
+            for i in range(args.workers_per_model):
+                controller.register_worker(f"http://worker-{m}-{i}", True, {
+                    "model_names": [model_name], "speed": rng.choice([1, 2, 4]), "queue_length": rng.randint(0, 8)})
+        workers = list(controller.worker_info)
+
+        def indexed(model_name, counter=[0]):
+            counter[0] += 1
+            if counter[0] % args.heart_beat_every == 0:
+                controller.receive_heart_beat(workers[counter[0] % len(workers)], rng.randint(0, 8))
+            return controller.get_worker_address(model_name)
+
+        def scanned(model_name, counter=[0]):
+            counter[0] += 1
+            if counter[0] % args.heart_beat_every == 0:
+                controller.worker_info[workers[counter[0] % len(workers)]].queue_length = rng.randint(0, 8)
+            return scan_dispatch(controller.worker_info, model_name, method)
+
+        rows.append((method, rate(indexed, models, args.num_requests), rate(scanned, models, args.num_requests)))
+    logging.disable(logging.NOTSET)
+
+    # stdout is redirected to the logger by build_logger
+    num_workers = args.num_models * args.workers_per_model
+    sys.__stdout__.write(f"{args.num_models} models x {args.workers_per_model} workers = {num_workers} workers\n")
+    for method, new, old in rows:
+        sys.__stdout__.write(f"{method:15s} indexed: {new:10.0f}/s  full scan: {old:10.0f}/s  ({new / old:.1f}x)\n")
@@ -0,0 +1,93 @@
+"""
+Measure controller throughput (calls/sec) for heart beats and worker dispatch,
+with logging enabled and with logging disabled.
+
+Workers are registered with a fixed status, so no model workers need to be
+running. `--http` drives the FastAPI app in-process through its test client
+instead of calling the `Controller` methods directly.
+
+Example:
+    python scripts/benchmark_controller_logging.py --num-workers 16 --num-requests 50000
+    python scripts/benchmark_controller_logging.py --http --dispatch-method lottery
+"""
+
+
+import argparse
+import logging
+import random
+import sys
+import time
+
+
+def make_controller(module, args):
+    controller = module.Controller(args.dispatch_method)
+    for i in range(args.num_workers):
+        controller.register_worker(
+            f"http://localhost:{40000 + i}", check_heart_beat=True,
+            worker_status={"model_names": [f"model-{i % args.num_models}"], "speed": 1, "queue_length": 0})
+    return controller
+
+
+def bench_direct(controller, args):
+    workers = list(controller.worker_info)
+    models = [f"model-{i}" for i in range(args.num_models)]
+    results = {}
+
+    start = time.perf_counter()
+    for i in range(args.num_requests):
+        controller.receive_heart_beat(workers[i % len(workers)], random.randint(0, 8))
+    results["heart_beat"] = args.num_requests / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(args.num_requests):
+        controller.get_worker_address(models[i % len(models)])
+    results["get_worker_address"] = args.num_requests / (time.perf_counter() - start)
+    return results
+
+
+def bench_http(module, controller, args):
+    from fastapi.testclient import TestClient
+
+    module.controller = controller
+    client = TestClient(module.app)
+    workers = list(controller.worker_info)
+    models = [f"model-{i}" for i in range(args.num_models)]
+    results = {}
+
+    start = time.perf_counter()
+    for i in range(args.num_requests):
+        client.post("/receive_heart_beat", json={"worker_name": workers[i % len(workers)], "queue_length": 0})
+    results["heart_beat"] = args.num_requests / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(args.num_requests):
+        client.post("/get_worker_address", json={"model": models[i % len(models)]})
+    results["get_worker_address"] = args.num_requests / (time.perf_counter() - start)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-workers", type=int, default=16)
+    parser.add_argument("--num-models", type=int, default=2)
+    parser.add_argument("--num-requests", type=int, default=20000)
+    parser.add_argument("--dispatch-method", type=str, choices=["lottery", "shortest_queue"], default="shortest_queue")
+    parser.add_argument("--http", action="store_true")
+    args = parser.parse_args()
+
+    from llava.serve import controller as module
+
+    rows = []
+    for mode in ("logging on", "logging off"):
+        logging.disable(logging.NOTSET if mode == "logging on" else logging.CRITICAL)
+        controller = make_controller(module, args)
+        if args.http:
+            results = bench_http(module, controller, args)
+        else:
+            results = bench_direct(controller, args)
+        rows.append((mode, results))
+    logging.disable(logging.NOTSET)
+
+    # stdout is redirected to the logger by build_logger
+    for mode, results in rows:
+        sys.__stdout__.write(f"{mode:12s} " + "  ".join(f"{k}: {v:10.0f}/s" for k, v in results.items()) + "\n")
@@ -0,0 +1,103 @@
+"""
+Time controller registry operations against a simulated fleet of workers.
+
+A single local HTTP server plays every worker: worker `i` is
+`http://localhost:<port>/w<i>` and answers `/worker_get_status` after
+`--latency` seconds. A fraction of the workers (`--dead-fraction`) answer 503
+and should be removed by the refresh.
+
+Example:
+    python scripts/benchmark_controller_registry.py --num-workers 500 --latency 0.05
+    python scripts/benchmark_controller_registry.py --num-workers 50 --serial-baseline
+"""
+
+
+import argparse
+import asyncio
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FleetHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("content-length", 0))
+        self.rfile.read(length)
+        time.sleep(self.server.args.latency)
+        worker_id = int(self.path.split("/")[1][1:])
+        if worker_id in self.server.dead:
+            self.send_response(503)
+            self.send_header("content-length", "0")
+            self.end_headers()
+            return
+        body = json.dumps({
+            "model_names": [f"model-{worker_id % self.server.args.num_models}"],
+            "speed": 1,
+            "queue_length": worker_id % 7,
+        }).encode()
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FleetServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 4096
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-workers", type=int, default=500)
+    parser.add_argument("--num-models", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--dead-fraction", type=float, default=0.02)
+    parser.add_argument("--probe-concurrency", type=int, default=128)
+    parser.add_argument("--serial-baseline", action="store_true",
+                        help="also time one blocking get_worker_status call per worker, as the old refresh did")
+    args = parser.parse_args()
+
+    from llava.serve.controller import Controller
+
+    server = FleetServer(("localhost", 0), FleetHandler)
+    server.args = args
+    server.dead = set(range(0, args.num_workers, max(1, int(1 / args.dead_fraction)))) if args.dead_fraction > 0 else set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://localhost:{server.server_address[1]}"
+
+    controller = Controller("shortest_queue", probe_concurrency=args.probe_concurrency)
+    names = [f"{base}/w{i}" for i in range(args.num_workers)]
+    for i, name in enumerate(names):
+        controller.register_worker(name, True, {"model_names": [f"model-{i % args.num_models}"], "speed": 1, "queue_length": 0})
+
+    rows = []
+    _, elapsed = timed(lambda: asyncio.run(controller.refresh_all_workers()))
+    rows.append(("refresh_all_workers", elapsed, f"{len(controller.worker_info)} workers left"))
+    _, elapsed = timed(lambda: asyncio.run(controller.worker_api_get_status()))
+    rows.append(("worker_api_get_status", elapsed, ""))
+    models, elapsed = timed(lambda: [controller.list_models() for _ in range(10000)])
+    rows.append(("list_models x10000", elapsed, f"{len(models[0])} models"))
+    _, elapsed = timed(controller.remove_expired_workers)
+    rows.append(("remove_expired_workers", elapsed, f"{len(controller.expiry_heap)} heap entries"))
+    if args.serial_baseline:
+        _, elapsed = timed(lambda: [controller.get_worker_status(name) for name in names])
+        rows.append(("serial get_worker_status", elapsed, ""))
+
+    # stdout is redirected to the logger by build_logger
+    for name, elapsed, note in rows:
+        sys.__stdout__.write(f"{name:26s} {elapsed * 1000:10.1f} ms  {note}\n")
+    server.shutdown()
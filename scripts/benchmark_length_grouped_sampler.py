@@ -0,0 +1,88 @@
+"""
+Benchmark the vectorized LengthGroupedSampler against the previous pure-Python implementation.
+
+Example:
+    python scripts/benchmark_length_grouped_sampler.py --num-samples 1000000 --world-size 8
+"""
+
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from llava.train.llava_trainer import LengthGroupedSampler, get_length_grouped_indices
+
+
+def reference_split_to_even_chunks(indices, lengths, num_chunks):
+    if len(indices) % num_chunks != 0:
+        return [indices[i::num_chunks] for i in range(num_chunks)]
+
+    num_indices_per_chunk = len(indices) // num_chunks
+
+    chunks = [[] for _ in range(num_chunks)]
+    chunks_lengths = [0 for _ in range(num_chunks)]
+    for index in indices:
+        shortest_chunk = chunks_lengths.index(min(chunks_lengths))
+        chunks[shortest_chunk].append(index)
+        chunks_lengths[shortest_chunk] += lengths[index]
+        if len(chunks[shortest_chunk]) == num_indices_per_chunk:
+            chunks_lengths[shortest_chunk] = float("inf")
+
+    return chunks
+
+
+def reference_get_length_grouped_indices(lengths, batch_size, world_size, generator=None):
+    indices = torch.randperm(len(lengths), generator=generator)
+    megabatch_size = world_size * batch_size
+    megabatches = [indices[i : i + megabatch_size].tolist() for i in range(0, len(lengths), megabatch_size)]
+    megabatches = [sorted(megabatch, key=lambda i: lengths[i], reverse=True) for megabatch in megabatches]
+    megabatches = [reference_split_to_even_chunks(megabatch, lengths, world_size) for megabatch in megabatches]
+
+    return [i for megabatch in megabatches for batch in megabatch for i in batch]
+
+
+def main(args):
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(16, 2048, size=args.num_samples)
+    signs = np.where(rng.random(args.num_samples) < 0.8, 1, -1)
+    modality_lengths = (lengths * signs).tolist()
+    lengths = lengths.tolist()
+
+    start = time.perf_counter()
+    reference = reference_get_length_grouped_indices(lengths, args.batch_size, args.world_size, generator=torch.Generator().manual_seed(0))
+    t_reference = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectorized = get_length_grouped_indices(lengths, args.batch_size, args.world_size, generator=torch.Generator().manual_seed(0))
+    t_vectorized = time.perf_counter() - start
+
+    assert reference == vectorized, "vectorized order differs from reference"
+    print(f"length grouped, {args.num_samples} samples: reference {t_reference:.2f}s, vectorized {t_vectorized:.2f}s "
+          f"({t_reference / t_vectorized:.1f}x)")
+
+    sampler = LengthGroupedSampler(args.batch_size, args.world_size, lengths=modality_lengths, group_by_modality=True, seed=0)
+    start = time.perf_counter()
+    full = list(sampler)
+    t_modality = time.perf_counter() - start
+    assert full == list(sampler), "ordering is not deterministic for a fixed seed"
+
+    step = len(full) // (2 * args.batch_size * args.world_size)
+    sampler.fast_forward(step)
+    assert len(sampler) == len(full) - step * args.batch_size * args.world_size, "length ignores the fast-forward"
+    start = time.perf_counter()
+    resumed = next(iter(sampler))
+    t_resume = time.perf_counter() - start
+    assert resumed == full[step * args.batch_size * args.world_size], "fast-forward resumed at the wrong sample"
+    print(f"modality grouped: {t_modality:.2f}s per epoch, fast-forward to step {step} in {t_resume:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-samples", type=int, default=1000000)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--world-size", type=int, default=8)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,61 @@
+"""
+Benchmark `tokenizer_image_token_batch` against per-prompt `tokenizer_image_token`.
+
+Example:
+    python scripts/benchmark_tokenizer_image_token.py --model-path liuhaotian/llava-v1.5-7b
+"""
+
+
+import argparse
+import time
+
+from transformers import AutoTokenizer
+
+from llava import conversation as conversation_lib
+from llava.mm_utils import tokenizer_image_token, tokenizer_image_token_batch
+
+
+def build_prompts(num_prompts, conv_mode):
+    prompts = []
+    for i in range(num_prompts):
+        conv = conversation_lib.conv_templates[conv_mode].copy()
+        conv.append_message(conv.roles[0], f"<image>\nWhat is happening in surgical frame {i}? Describe the tools.")
+        conv.append_message(conv.roles[1], f"The grasper is retracting the gallbladder in frame {i}.")
+        prompts.append(conv.get_prompt())
+    return prompts
+
+
+def timeit(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def main(args):
+    prompts = build_prompts(args.num_prompts, args.conv_mode)
+    for use_fast in (False, True):
+        tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_fast=use_fast)
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.unk_token
+
+        reference = [tokenizer_image_token(prompt, tokenizer) for prompt in prompts]
+        batched = tokenizer_image_token_batch(prompts, tokenizer, return_tensors=None)['input_ids']
+        assert [list(x) for x in reference] == [list(x) for x in batched], "batched ids differ from reference"
+
+        t_single = timeit(lambda: [tokenizer_image_token(prompt, tokenizer, return_tensors='pt') for prompt in prompts], args.repeats)
+        t_batch = timeit(lambda: tokenizer_image_token_batch(prompts, tokenizer, return_tensors='pt'), args.repeats)
+        print(f"use_fast={use_fast}: per-prompt {t_single * 1000:.2f} ms, batched {t_batch * 1000:.2f} ms, "
+              f"speedup {t_single / t_batch:.2f}x ({len(prompts)} prompts)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, default="liuhaotian/llava-v1.5-7b")
+    parser.add_argument("--conv-mode", type=str, default="vicuna_v1")
+    parser.add_argument("--num-prompts", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    main(args)
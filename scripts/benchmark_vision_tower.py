@@ -0,0 +1,69 @@
+"""
+Benchmark the early-exit vision tower forward against the full `output_hidden_states=True` pass.
+
+Example:
+    python scripts/benchmark_vision_tower.py --vision-tower openai/clip-vit-large-patch14-336 --batch-size 16
+"""
+
+
+import argparse
+import time
+from types import SimpleNamespace
+
+import torch
+from transformers import CLIPVisionModel
+
+from llava.model.multimodal_encoder.clip_encoder import CLIPVisionTower
+
+
+def measure(fn, device, repeats):
+    fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeats
+    peak = torch.cuda.max_memory_allocated() - baseline if device == 'cuda' else float('nan')
+    return out, elapsed, peak
+
+
+def main(args):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    dtype = torch.float16 if device == 'cuda' else torch.float32
+    tower_args = SimpleNamespace(mm_vision_select_layer=args.select_layer, mm_vision_select_feature='patch')
+
+    full_model = CLIPVisionModel.from_pretrained(args.vision_tower).to(device=device, dtype=dtype).eval()
+    full_params = sum(p.numel() for p in full_model.parameters())
+    tower = CLIPVisionTower(args.vision_tower, tower_args).to(device=device, dtype=dtype)
+    tower_params = sum(p.numel() for p in tower.parameters())
+
+    size = full_model.config.image_size
+    images = torch.randn(args.batch_size, 3, size, size, device=device, dtype=dtype)
+
+    @torch.no_grad()
+    def full_forward():
+        outs = full_model(images, output_hidden_states=True)
+        return outs.hidden_states[args.select_layer][:, 1:]
+
+    full_out, full_time, full_peak = measure(full_forward, device, args.repeats)
+    early_out, early_time, early_peak = measure(lambda: tower(images), device, args.repeats)
+
+    print(f"max abs diff: {(full_out - early_out).abs().max().item():.3e}")
+    print(f"full:       {full_time * 1000:8.1f} ms  peak activations {full_peak / 2**20:8.1f} MiB  params {full_params / 1e6:.1f}M")
+    print(f"early exit: {early_time * 1000:8.1f} ms  peak activations {early_peak / 2**20:8.1f} MiB  params {tower_params / 1e6:.1f}M")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vision-tower", type=str, default="openai/clip-vit-large-patch14-336")
+    parser.add_argument("--select-layer", type=int, default=-2)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    main(args)
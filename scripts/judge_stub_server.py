@@ -0,0 +1,83 @@
+"""
+Local stub of an OpenAI-compatible `/chat/completions` judge for testing the GPT review evaluators.
+
+Every request gets a fixed score pair after `--latency` seconds. A fraction of the
+requests (`--error-rate`) fail with 429 or 503 so the retry and backoff path is exercised.
+
+Example:
+    python scripts/judge_stub_server.py --port 8600 --error-rate 0.2 &
+    python -m llava.eval.eval_gpt_review_bench -q question.jsonl -c context.jsonl \
+        -a answer_gpt4.jsonl answer_llava.jsonl -r rule.json -o review.jsonl \
+        --judge-base-url http://localhost:8600/v1 --concurrency 32 --requests-per-minute 6000
+"""
+
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class JudgeStubHandler(BaseHTTPRequestHandler):
+    stats = {'requests': 0, 'errors': 0, 'in_flight': 0, 'max_in_flight': 0}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length', 0))
+        payload = json.loads(self.rfile.read(length))
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['in_flight'] += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+        try:
+            time.sleep(self.server.args.latency)
+            if not self.path.endswith('/chat/completions'):
+                self.send_error(404)
+                return
+            if random.random() < self.server.args.error_rate:
+                with self.lock:
+                    self.stats['errors'] += 1
+                self.send_response(random.choice((429, 503)))
+                self.send_header('retry-after', '0.1')
+                self.end_headers()
+                return
+
+            content = f"{self.server.args.score_1} {self.server.args.score_2}\nStub review of {len(payload['messages'][-1]['content'])} characters."
+            body = json.dumps({
+                'object': 'chat.completion',
+                'model': payload.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('content-type', 'application/json')
+            self.send_header('content-length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with self.lock:
+                self.stats['in_flight'] -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--score-1", type=float, default=8)
+    parser.add_argument("--score-2", type=float, default=7)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), JudgeStubHandler)
+    server.args = args
+    print(f"judge stub listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"stats: {JudgeStubHandler.stats}")
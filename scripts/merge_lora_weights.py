@@ -1,14 +1,183 @@
+"""
+Merge LoRA weights into the base model one shard at a time.
+
+Each base shard is read, the LoRA deltas `W += B @ A * alpha / r` of the
+tensors it holds are applied on a thread pool, and the merged shard is written
+before the next one is read, so peak memory stays around one shard instead of
+the whole model. `non_lora_trainables.bin` (mm_projector and any resized
+embeddings) replaces or extends the base tensors.
+
+Example:
+    python scripts/merge_lora_weights.py --model-path ./checkpoints/llava-v1.5-13b-lora \
+        --model-base lmsys/vicuna-13b-v1.5 --save-model-path ./checkpoints/llava-v1.5-13b-merged
+"""
+
+
 import argparse
-from llava.model.builder import load_pretrained_model
-from llava.mm_utils import get_model_name_from_path
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+
+DTYPES = {'float16': torch.float16, 'bfloat16': torch.bfloat16, 'float32': torch.float32}
+
+
+def resolve_local(path):
+    if os.path.isdir(path):
+        return path
+    from huggingface_hub import snapshot_download
+    return snapshot_download(path)
+
+
+def strip_peft_prefix(key):
+    prefix = 'base_model.model.'
+    return key[len(prefix):] if key.startswith(prefix) else key
+
+
+def list_base_shards(model_base):
+    for index_name in ('model.safetensors.index.json', 'pytorch_model.bin.index.json'):
+        index_path = os.path.join(model_base, index_name)
+        if os.path.isfile(index_path):
+            with open(index_path) as f:
+                weight_map = json.load(f)['weight_map']
+            return [os.path.join(model_base, name) for name in sorted(set(weight_map.values()))]
+    for name in ('model.safetensors', 'pytorch_model.bin'):
+        if os.path.isfile(os.path.join(model_base, name)):
+            return [os.path.join(model_base, name)]
+    raise ValueError(f'No safetensors or pytorch_model.bin weights found in {model_base}')
+
+
+def load_shard(path):
+    if path.endswith('.safetensors'):
+        with safe_open(path, framework='pt') as f:
+            return {k: f.get_tensor(k) for k in f.keys()}
+    return torch.load(path, map_location='cpu')
+
+
+def load_lora(model_path):
+    """
+    Returns:
+        tuple: ({target weight name: (A, B, scale)}, {name: tensor} of non-LoRA trainables).
+    """
+    with open(os.path.join(model_path, 'adapter_config.json')) as f:
+        adapter_config = json.load(f)
+    if os.path.isfile(os.path.join(model_path, 'adapter_model.safetensors')):
+        with safe_open(os.path.join(model_path, 'adapter_model.safetensors'), framework='pt') as f:
+            adapter = {k: f.get_tensor(k) for k in f.keys()}
+    else:
+        adapter = torch.load(os.path.join(model_path, 'adapter_model.bin'), map_location='cpu')
+
+    lora_alpha = adapter_config['lora_alpha']
+    alpha_pattern = adapter_config.get('alpha_pattern') or {}
+    use_rslora = adapter_config.get('use_rslora', False)
+
+    lora_a, lora_b, extra = {}, {}, {}
+    for key, tensor in adapter.items():
+        key = strip_peft_prefix(key)
+        if '.lora_A.' in key:
+            lora_a[key.split('.lora_A.')[0]] = tensor
+        elif '.lora_B.' in key:
+            lora_b[key.split('.lora_B.')[0]] = tensor
+        else:
+            # trained biases (lora_bias != "none")
+            extra[key] = tensor
+
+    deltas = {}
+    for module, a in lora_a.items():
+        if module not in lora_b:
+            raise ValueError(f'Missing lora_B for {module}')
+        r = a.shape[0]
+        alpha = next((v for k, v in alpha_pattern.items() if module.endswith(k)), lora_alpha)
+        scale = alpha / (r ** 0.5) if use_rslora else alpha / r
+        deltas[module + '.weight'] = (a, lora_b[module], scale)
+
+    non_lora_path = os.path.join(model_path, 'non_lora_trainables.bin')
+    if os.path.isfile(non_lora_path):
+        non_lora = torch.load(non_lora_path, map_location='cpu')
+        extra.update({strip_peft_prefix(k): v for k, v in non_lora.items()})
+    return deltas, extra
+
+
+def merge_tensor(weight, lora, dtype):
+    lora_a, lora_b, scale = lora
+    merged = weight.float()
+    merged.addmm_(lora_b.float(), lora_a.float(), alpha=scale)
+    return merged.to(dtype)
 
 
 def merge_lora(args):
-    model_name = get_model_name_from_path(args.model_path)
-    tokenizer, model, image_processor, context_len = load_pretrained_model(args.model_path, args.model_base, model_name, device_map='cpu')
+    start = time.time()
+    model_path = resolve_local(args.model_path)
+    model_base = resolve_local(args.model_base)
+    dtype = DTYPES[args.dtype]
+    os.makedirs(args.save_model_path, exist_ok=True)
+
+    deltas, extra = load_lora(model_path)
+    base_shards = list_base_shards(model_base)
+    num_shards = len(base_shards) + 1
+    print(f'Merging {len(deltas)} LoRA modules into {len(base_shards)} base shards with {args.num_workers} workers')
+
+    def cast(tensor):
+        return tensor.to(dtype) if tensor.is_floating_point() else tensor
+
+    weight_map, total_size, merged_keys = {}, 0, set()
+    with ThreadPoolExecutor(args.num_workers) as executor:
+        for shard_idx, shard_path in enumerate(base_shards):
+            state_dict = load_shard(shard_path)
+            keys = list(state_dict.keys())
+            merge_keys = [k for k in keys if k in deltas]
+            merged = executor.map(lambda k: merge_tensor(state_dict[k], deltas[k], dtype), merge_keys)
+            out = dict(zip(merge_keys, merged))
+            for k in keys:
+                if k in extra:
+                    out[k] = cast(extra.pop(k))
+                elif k not in out:
+                    out[k] = cast(state_dict[k])
+            del state_dict
+
+            shard_name = f'model-{shard_idx + 1:05d}-of-{num_shards:05d}.safetensors'
+            out = {k: v.contiguous() for k, v in out.items()}
+            save_file(out, os.path.join(args.save_model_path, shard_name), metadata={'format': 'pt'})
+            weight_map.update({k: shard_name for k in out})
+            total_size += sum(v.numel() * v.element_size() for v in out.values())
+            merged_keys.update(merge_keys)
+            print(f'[{shard_idx + 1}/{len(base_shards)}] {os.path.basename(shard_path)}: '
+                  f'{len(merge_keys)} merged, {time.time() - start:.1f}s')
+            del out
+
+    missing = set(deltas) - merged_keys
+    if len(missing) > 0:
+        raise ValueError(f'{len(missing)} LoRA target weights are not in the base model, e.g. {sorted(missing)[:3]}')
+
+    # new parameters such as mm_projector go into a final shard
+    shard_name = f'model-{num_shards:05d}-of-{num_shards:05d}.safetensors'
+    out = {k: cast(v).contiguous() for k, v in extra.items()}
+    save_file(out, os.path.join(args.save_model_path, shard_name), metadata={'format': 'pt'})
+    weight_map.update({k: shard_name for k in out})
+    total_size += sum(v.numel() * v.element_size() for v in out.values())
+
+    with open(os.path.join(args.save_model_path, 'model.safetensors.index.json'), 'w') as f:
+        json.dump({'metadata': {'total_size': total_size}, 'weight_map': weight_map}, f, indent=2, sort_keys=True)
+
+    with open(os.path.join(model_path, 'config.json')) as f:
+        config = json.load(f)
+    config['architectures'] = ['LlavaLlamaForCausalLM']
+    config['torch_dtype'] = args.dtype
+    with open(os.path.join(args.save_model_path, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+    if os.path.isfile(os.path.join(model_base, 'generation_config.json')):
+        shutil.copyfile(os.path.join(model_base, 'generation_config.json'), os.path.join(args.save_model_path, 'generation_config.json'))
 
-    model.save_pretrained(args.save_model_path)
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_base, use_fast=False)
     tokenizer.save_pretrained(args.save_model_path)
+    print(f'Saved merged model to {args.save_model_path} in {time.time() - start:.1f}s')
 
 
 if __name__ == "__main__":
@@ -16,6 +185,8 @@ def merge_lora(args):
     parser.add_argument("--model-path", type=str, required=True)
     parser.add_argument("--model-base", type=str, required=True)
     parser.add_argument("--save-model-path", type=str, required=True)
+    parser.add_argument("--dtype", type=str, default="float16", choices=list(DTYPES))
+    parser.add_argument("--num-workers", type=int, default=8)
 
     args = parser.parse_args()
 
@@ -0,0 +1,93 @@
+"""
+Profile the import time of llava entry points and check the startup budget.
+
+Each module is imported in a fresh interpreter with `-X importtime`. Lightweight
+entry points (the eval scorers) must start within `--budget-ms` and must not
+import torch or transformers. Exits with a non-zero status if a check fails, so
+it can be run in CI.
+
+Example:
+    python scripts/profile_import_time.py --top 10
+"""
+
+
+import argparse
+import subprocess
+import sys
+
+
+LIGHT_MODULES = [
+    "llava",
+    "llava.constants",
+    "llava.eval.eval_pope",
+    "llava.eval.summarize_gpt_review",
+    "llava.eval.eval_science_qa",
+    "llava.eval.eval_textvqa",
+]
+
+HEAVY_MODULES = [
+    "torch",
+    "transformers",
+    "flash_attn",
+    "xformers",
+]
+
+
+def profile_module(module, top):
+    code = (
+        "import sys, time\n"
+        "t = time.perf_counter()\n"
+        f"import {module}\n"
+        "print('__elapsed__', time.perf_counter() - t)\n"
+        f"print('__heavy__', ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"Failed to import {module}:\n{proc.stderr}")
+
+    elapsed, heavy = None, []
+    for line in proc.stdout.splitlines():
+        if line.startswith("__elapsed__"):
+            elapsed = float(line.split()[1])
+        elif line.startswith("__heavy__"):
+            heavy = [x for x in line[len("__heavy__"):].strip().split(",") if x]
+
+    # -X importtime lines: "import time: self [us] | cumulative | imported package"
+    entries = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, self_us, cumulative_us, name = [x.strip() for x in line.replace("import time:", "|", 1).split("|")]
+        entries.append((int(cumulative_us), name.strip()))
+    entries.sort(reverse=True)
+    return elapsed, heavy, entries[:top]
+
+
+def main(args):
+    failures = []
+    modules = LIGHT_MODULES + args.extra
+    for module in modules:
+        elapsed, heavy, entries = profile_module(module, args.top)
+        print(f"{module}: {elapsed * 1000:.1f} ms" + (f" (imports {', '.join(heavy)})" if heavy else ""))
+        for cumulative_us, name in entries:
+            print(f"    {cumulative_us / 1000:8.1f} ms  {name}")
+        if module in LIGHT_MODULES:
+            if elapsed * 1000 > args.budget_ms:
+                failures.append(f"{module} took {elapsed * 1000:.1f} ms (budget {args.budget_ms} ms)")
+            if heavy:
+                failures.append(f"{module} imports {', '.join(heavy)}")
+
+    if failures:
+        print("\nFAILED:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+    print("\nAll import-time checks passed.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget-ms", type=float, default=200)
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--extra", nargs="*", default=[], help="additional modules to profile (not budget-checked)")
+    args = parser.parse_args()
+
+    main(args)